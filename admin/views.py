@@ -5,22 +5,29 @@ Created by Emmanouel.
 The file includes the following functionalities:
 - Role-based access control using custom decorators.
 - Viewing admin account details, including collected adverts, current adverts, and current users.
+- Viewing the daily platform statistics, as a page or as JSON.
 - Creating new admin accounts.
 - Viewing a detailed account overview for individual users, including their adverts and order history.
 - Deleting users by changing their role to 'off'.
 
 Routes:
 - /admin_account: View admin account details.
+- /adminaccount/<section>: A page of the adverts or users of a section of the admin account page.
+- /adminstats: View the daily statistics of a range of days.
+- /adminstats/data: The daily statistics of a range of days as JSON.
 - /create_admin_account: Create a new admin account.
 - /account_overview/<user>: View account overview for a specific user.
 - /delete_user/<int:user_id>: Delete a user by changing their role to 'off'.
 
 """
 
-from flask import Blueprint, render_template, flash, redirect, url_for
+from datetime import date, timedelta
 
+from flask import Blueprint, render_template, flash, redirect, url_for, request, abort, jsonify
+
+import datalink
 from app import db, app
-from models import User, Advert, Collection
+from models import User, DailyStat
 from admin.forms import AdminSignUpForm
 from flask_login import current_user, login_required
 from functools import wraps
@@ -59,32 +66,110 @@ def admin_account():
     View function for viewing the admin account details.
     Requires the user to be logged in.
     Requires 'admin' role to be authorized.
-    Created by Emmanouel.
+    Created by Emmanouel, amended to count the adverts and users in the database and load each section when it is
+    opened (see admin_section).
 
     Returns:
-        flask.Response: Renders the admin account template with collected adverts, current adverts, current users,
-        current admins and deleted adverts.
-    """
-    # get all available adverts
-    current_adverts = Advert.query.filter_by(available=True).all()
-    # get all users
-    current_users = User.query.filter_by(role='user').all()
-    # get all admins
-    current_admins = User.query.filter_by(role='admin').all()
-
-    # get all unavailable adverts
-    unavailable_adverts = Advert.query.filter_by(available=False).all()
-    # get all collected advert IDs
-    collected_advert_ids = [collection.advert for collection in Collection.query.all()]
-    # find the deleted adverts (unavailable adverts not in collected adverts)
-    deleted_adverts = [advert for advert in unavailable_adverts if advert.adID not in collected_advert_ids]
-    # find the collected adverts (unavailable adverts in collected adverts)
-    collected_adverts = [advert for advert in unavailable_adverts if advert.adID in collected_advert_ids]
-
+        flask.Response: Renders the admin account template with the number of collected, current and deleted adverts,
+        users and admins.
+    """
+    summary = datalink.get_admin_summary()
     # renders the admin account template
-    return render_template('admin/admin_account.html', current_adverts=current_adverts, current_users=current_users,
-                           current_admins=current_admins, collected_adverts=collected_adverts,
-                           deleted_adverts=deleted_adverts, current_page='admin_account')
+    return render_template('admin/admin_account.html', summary=summary, current_page='admin_account')
+
+
+@admin_blueprint.route('/adminaccount/<section>')
+@login_required
+@requires_roles('admin')
+def admin_section(section):
+    """
+    View function that returns a page of a section of the admin account page: the collected, current or deleted
+    adverts, the users or the admins. The page is chosen with the 'page' query argument.
+    Requires the user to be logged in.
+    Requires 'admin' role to be authorized.
+
+    Returns:
+        flask.Response: Renders the admin_section.html table of the section, fetched by admin_account.html.
+    """
+    page = max(request.args.get('page', 1, type=int), 1)
+    offset = (page - 1) * datalink.ADMIN_PAGE_SIZE
+    # fetch one extra row to know if there is a next page
+    if section in datalink.ADMIN_ADVERT_SECTIONS:
+        rows = datalink.get_admin_adverts(section, limit=datalink.ADMIN_PAGE_SIZE + 1, offset=offset)
+    elif section in ('users', 'admins'):
+        rows = datalink.get_users_by_role(section[:-1], limit=datalink.ADMIN_PAGE_SIZE + 1, offset=offset)
+    else:
+        abort(404)
+    return render_template('admin/admin_section.html', section=section, rows=rows[:datalink.ADMIN_PAGE_SIZE],
+                           page=page, has_next=len(rows) > datalink.ADMIN_PAGE_SIZE)
+
+
+def stats_range():
+    """
+    Reads the range of days asked for with the 'from' and 'to' query arguments (YYYY-MM-DD), by default the last
+    STATS_DEFAULT_DAYS days. Answers with 400 Bad Request if a date is invalid, the range is backwards or it is longer
+    than STATS_MAX_DAYS.
+
+    Returns:
+        tuple: the first and last day of the range
+    """
+    try:
+        last_day = date.fromisoformat(request.args['to']) if request.args.get('to') else date.today()
+        first_day = (date.fromisoformat(request.args['from']) if request.args.get('from')
+                     else last_day - timedelta(days=datalink.STATS_DEFAULT_DAYS - 1))
+    except ValueError:
+        abort(400)
+    if first_day > last_day or (last_day - first_day).days >= datalink.STATS_MAX_DAYS:
+        abort(400)
+    return first_day, last_day
+
+
+def stats_totals(stats):
+    """
+    Adds up the counters of a range of days. Active users aren't added up, as a user can be active on many days.
+
+    Returns:
+        dict: the total of each counter except active_users
+    """
+    return {counter: sum(getattr(stat, counter) for stat in stats)
+            for counter in DailyStat.COUNTERS if counter != 'active_users'}
+
+
+@admin_blueprint.route('/adminstats')
+@login_required
+@requires_roles('admin')
+def admin_stats():
+    """
+    View function for the daily statistics of the platform: adverts posted, collected and expired, active users and
+    messages sent each day of a range (see stats_range).
+    Requires the user to be logged in.
+    Requires 'admin' role to be authorized.
+
+    Returns:
+        flask.Response: Renders the admin_stats.html template with the statistics of each day and their totals.
+    """
+    first_day, last_day = stats_range()
+    stats = datalink.get_daily_stats(first_day, last_day)
+    return render_template('admin/admin_stats.html', stats=stats, totals=stats_totals(stats),
+                           first_day=first_day, last_day=last_day, current_page='admin_stats')
+
+
+@admin_blueprint.route('/adminstats/data')
+@login_required
+@requires_roles('admin')
+def admin_stats_data():
+    """
+    View function that returns the daily statistics of a range of days (see stats_range) as JSON.
+    Requires the user to be logged in.
+    Requires 'admin' role to be authorized.
+
+    Returns:
+        flask.Response: JSON with the range, the statistics of each day in order and their totals.
+    """
+    first_day, last_day = stats_range()
+    stats = datalink.get_daily_stats(first_day, last_day)
+    return jsonify({'from': first_day.isoformat(), 'to': last_day.isoformat(),
+                    'days': [stat.to_dict() for stat in stats], 'totals': stats_totals(stats)})
 
 
 @admin_blueprint.route('/create_admin_account', methods=['GET', 'POST'])
@@ -132,7 +217,7 @@ def create_admin_account():
     return render_template('admin/create_admin_account.html', form=form)
 
 
-@admin_blueprint.route('/account_overview/<user>')
+@admin_blueprint.route('/account_overview/<int:user>')
 @login_required
 @requires_roles('admin')
 def account_overview(user):
@@ -143,21 +228,21 @@ def account_overview(user):
     Created by Emmanouel.
 
     Args:
-        user (str): The ID of the user.
+        user (int): The ID of the user.
 
     Returns:
         flask.Response: Renders the account overview template with user details, adverts, and orders.
     """
     # get user from database
-    user = User.query.get(user)
+    user = datalink.get_user_from_id(user)
     # check if user exists
     if not user:
         flash('User does not exist')
         return redirect(url_for('admin.admin_account'))
-    # get all adverts created by specific user
-    adverts = Advert.query.filter_by(owner=user.id).all()
-    # get all orders collected from specific user
-    orders = Collection.query.filter_by(buyer=user.id).all()
+    # get all adverts created by specific user, with who collected them
+    adverts = datalink.get_user_adverts(user.id, with_collections=True)
+    # get all orders collected by specific user, with the adverts and who posted them
+    orders = datalink.get_user_collections(user.id)
     return render_template('admin/account_overview.html', user=user, adverts=adverts, orders=orders, admin_overview=True)
 
 
@@ -190,8 +275,8 @@ def delete_user(user_id):
     if not active_user.role == 'off':
         # change user role as offline
         active_user.role = 'off'
-        # update role change
-        db.session.commit()
+        # update role change, which the user's next request sees at once
+        datalink.update_user(active_user)
         # inform admin and redirect to admin account page
         flash("User successfully deleted")
         return redirect(url_for('admin.admin_account'))
@@ -1,18 +1,39 @@
 import datetime
 import json
+from urllib.parse import urlencode
 
-from flask import Blueprint, render_template, redirect, url_for, session, request, flash
+from flask import Blueprint, render_template, redirect, url_for, session, request, flash, abort
+from markupsafe import Markup
 
 import datalink
 from adverts.forms import AdvertForm
 from flask_login import current_user, login_required
 from app import db, app
-from models import User, Advert, Collection
+from conditional import conditional, make_etag
+from extensions import fragment_cache
+from models import Advert, Collection
 from admin.views import requires_roles
 from sqlalchemy.sql import func
 
 adverts_blueprint = Blueprint('adverts', __name__, template_folder='templates')
 
+# largest radius that can be searched around a location, so a search never scans the whole country
+MAX_RADIUS_KM = 100
+
+
+def adverts_etag(**kwargs):
+    """Function that returns the ETag of a page that only changes when the adverts do, for the logged in user,
+    without querying the database. Used with the conditional decorator. The version comes from the fragment cache, so
+    with the 'memory' cache it also changes every FRAGMENT_CACHE_TTL seconds to catch changes made by other processes
+
+    Returns:
+        tuple: the ETag and no last modified time, or None if the fragment cache doesn't keep versions
+    """
+    version = fragment_cache.version_tag(datalink.ADVERTS_CACHE)
+    if version is None:
+        return None
+    return make_etag(version, request.full_path, current_user.id, current_user.role), None
+
 
 @adverts_blueprint.route('/create_advert', methods=['GET', 'POST'])
 @login_required
@@ -29,27 +50,25 @@ def create_advert():
     """
     form = AdvertForm()
     if form.validate_on_submit():
-        with app.app_context():
-            user = User.query.filter_by(email=current_user.email).first()
-            new_advert = Advert(title=form.name.data,
-                                address=form.address.data,
-                                contents=form.contents.data,
-                                expiry=form.expiry.data,
-                                latitude=form.latitude.data,
-                                longitude=form.longitude.data,
-                                owner=user.id)
-
-            db.session.add(new_advert)
-            db.session.commit()
-
-            return redirect(url_for('adverts.advert_details', advert=new_advert.adID))
+        new_advert = Advert(title=form.name.data,
+                            address=form.address.data,
+                            contents=form.contents.data,
+                            expiry=form.expiry.data,
+                            latitude=form.latitude.data,
+                            longitude=form.longitude.data,
+                            owner=current_user.id)
+
+        datalink.create_advert(new_advert)
+
+        return redirect(url_for('adverts.advert_details', advert=new_advert.adID))
     else:
         return render_template('adverts/create_advert.html', form=form, current_page='create_advert')
 
 
 # View for user account information
-@adverts_blueprint.route('/advert_details/<advert>')
+@adverts_blueprint.route('/advert_details/<int:advert>')
 @login_required
+@conditional(adverts_etag)
 def advert_details(advert):
     """
     View function for displaying advert information.
@@ -60,25 +79,90 @@ def advert_details(advert):
         flask.Response: Renders the advert_details.html template with advert details.
     """
     # Fetch and render user details
-
-    return render_template('adverts/advert_details.html', current_advert=Advert.query.get(advert))
+    current_advert = datalink.get_advert(advert)
+    if current_advert is None:
+        abort(404)
+    return render_template('adverts/advert_details.html', current_advert=current_advert)
 
 
 @adverts_blueprint.route('/list_adverts')
 @login_required
+@conditional(adverts_etag)
 def list_adverts():
-    """Function that displays all the currently available adverts in a table
+    """Function that displays the currently available adverts in a table, a page at a time
+    The adverts are sorted by the 'sort' query argument (expiring soonest or newest first) and can be filtered to
+    one owner with 'owner' and to those containing the text 'q'. The next page starts after the advert given by
+    'after' and 'after_id', which are the expiry date and id of the last advert of the page before
+    If lat and lon are given, the adverts within radius km of that location are shown instead, nearest first
     Requires the user to be logged in
     Created by Alex, amended by Rebecca
 
     Returns:
         flask.Response: returns listedadverts.html template with the details of all the relevant adverts
     """
-    adverts = datalink.get_available_ads()
-    return render_template('adverts/listed_adverts.html', current_advert=adverts, current_page='list_adverts')
+    location = get_location()
+    filters = {'sort': request.args.get('sort', 'expiry'),
+               'owner': request.args.get('owner', type=int),
+               'q': request.args.get('q', '').strip()}
+    if filters['sort'] not in datalink.LISTING_SORTS:
+        abort(400)
+    if location:
+        nearby = datalink.get_ads_near(*location)
+        advert_table = render_template('adverts/advert_table.html', current_advert=[ad for ad, _ in nearby],
+                                       distances={ad.adID: distance for ad, distance in nearby}, location=location)
+    else:
+        after, after_id = get_cursor(filters['sort'])
+        # every user sees the same table for the same page, so it is cached until the adverts change
+        key = urlencode(sorted({**filters, 'after': after, 'after_id': after_id}.items()))
+        advert_table = fragment_cache.cached(datalink.ADVERTS_CACHE, 'list_adverts?' + key,
+                                             lambda: render_advert_table(filters, after, after_id))
+    return render_template('adverts/listed_adverts.html', advert_table=Markup(advert_table), location=location,
+                           filters=filters, current_page='list_adverts')
+
+
+def render_advert_table(filters, after, after_id):
+    """Function that renders a page of the advert listing, see list_adverts
 
+    Returns:
+        str: the advert_table.html template with the adverts of the page
+    """
+    # fetch one extra advert to know if there is a next page
+    adverts = datalink.get_ads_page(filters['sort'], filters['owner'], filters['q'], after, after_id,
+                                    limit=datalink.LISTING_PAGE_SIZE + 1)
+    next_page = None
+    if len(adverts) > datalink.LISTING_PAGE_SIZE:
+        adverts = adverts[:datalink.LISTING_PAGE_SIZE]
+        last = adverts[-1]
+        next_page = {key: value for key, value in filters.items() if value}
+        next_page['after_id'] = last.adID
+        if filters['sort'] == 'expiry':
+            next_page['after'] = last.expiry.isoformat()
+    return render_template('adverts/advert_table.html', current_advert=adverts, filters=filters,
+                           next_page=next_page, is_first_page=after_id is None)
 
-@adverts_blueprint.route('/collect_confirmation/<advert>')
+
+@adverts_blueprint.route('/search_adverts')
+@login_required
+@conditional(adverts_etag)
+def search_adverts():
+    """Function that displays the available adverts whose title or description contain every word of the 'q' query
+    argument, best match first, a page at a time chosen with the 'page' query argument
+    Requires the user to be logged in
+
+    Returns:
+        flask.Response: returns the search_adverts.html template with the matching adverts
+    """
+    search = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    # fetch one extra advert to know if there is a next page
+    adverts = datalink.search_ads(search, limit=datalink.SEARCH_PAGE_SIZE + 1,
+                                  offset=(page - 1) * datalink.SEARCH_PAGE_SIZE)
+    has_next = len(adverts) > datalink.SEARCH_PAGE_SIZE
+    return render_template('adverts/search_adverts.html', current_advert=adverts[:datalink.SEARCH_PAGE_SIZE],
+                           search=search, page=page, has_next=has_next, current_page='list_adverts')
+
+
+@adverts_blueprint.route('/collect_confirmation/<int:advert>')
 @login_required
 @requires_roles('user')
 def collect_confirmation(advert):
@@ -88,28 +172,30 @@ def collect_confirmation(advert):
     Returns:
         flask.Response: returns the collect_confirmation.html template
         """
-    current_advert = Advert.query.get(advert)
+    current_advert = datalink.get_advert(advert)
+    if current_advert is None:
+        abort(404)
     # check if current user is the owner of the advert
     if current_user.id == current_advert.owner:
         flash('You own this advert!')
         return render_template('adverts/advert_details.html', current_advert=current_advert)
+    # check the advert was still available when it was locked, so it can only be collected once
+    elif not datalink.set_advert_unavailable(current_advert.adID):
+        flash('This advert is no longer available')
+        return render_template('adverts/advert_details.html', current_advert=current_advert)
     else:
         # create a new collection object
-        with app.app_context():
+        new_collection = Collection(advert=current_advert.adID,
+                                    buyer=current_user.id,
+                                    seller=current_advert.owner,
+                                    date=datetime.datetime.now())
 
-            datalink.set_advert_unavailable(current_advert.adID)
-            new_collection = Collection(advert=current_advert.adID,
-                                        buyer=current_user.id,
-                                        seller=current_advert.owner,
-                                        date=datetime.datetime.now())
+        # save collection object to database
+        datalink.create_order(new_collection)
+        return render_template('adverts/collect_confirmation.html', current_advert=current_advert)
 
-            # save collection object to database
-            db.session.add(new_collection)
-            db.session.commit()
-            return render_template('adverts/collect_confirmation.html', current_advert=current_advert)
 
-
-@adverts_blueprint.route('/delete_advert/<advert>')
+@adverts_blueprint.route('/delete_advert/<int:advert>')
 @login_required
 def delete_advert(advert):
     """Function that allows a user to delete their advert
@@ -119,32 +205,178 @@ def delete_advert(advert):
     Returns:
         flask.Response: returns a user's account page if successful, or advert_details.html template if unsuccessful
         """
-    current_advert = Advert.query.get(advert)
+    current_advert = datalink.get_advert(advert)
+    if current_advert is None:
+        abort(404)
     if current_user.id == current_advert.owner or current_user.role == 'admin':
-        with app.app_context():
-
-            datalink.set_advert_unavailable(current_advert.adID)
-            # if the advert is deleted by an admin, redirect them to admin account page
-            if current_user.role == 'admin':
-                return redirect(url_for('admin.admin_account'))
-            # else redirect them to user account page    
-            return redirect(url_for('users.account'))
+        datalink.set_advert_unavailable(current_advert.adID)
+        # if the advert is deleted by an admin, redirect them to admin account page
+        if current_user.role == 'admin':
+            return redirect(url_for('admin.admin_account'))
+        # else redirect them to user account page
+        return redirect(url_for('users.account'))
 
     else:
         flash("You don't own this advert!")
 
-        return render_template('adverts/advert_details.html', current_advert=Advert.query.get(advert))
+        return render_template('adverts/advert_details.html', current_advert=current_advert)
 
 
 @adverts_blueprint.route('/advert_map')
 @login_required
+@conditional(adverts_etag)
 def advert_map():
-    """Function that displays the advertmap.html template
+    """Function that displays the advertmap.html template. The adverts are loaded by the map from advert_geojson for
+    the area being looked at, so the page is the same size however many adverts there are
+    If lat and lon are given, the map starts centred on that location
     Requires the user to be logged in
     Created by Alex, amended by Rebecca
 
     Returns:
         flask.Response: returns the advertmap.html template
         """
-    adverts = datalink.get_available_ads()
-    return render_template('adverts/advert_map.html', current_adverts=adverts, current_page='advert_map')
+    return render_template('adverts/advert_map.html', location=get_location(),
+                           cluster_max_zoom=datalink.CLUSTER_MAX_ZOOM, current_page='advert_map')
+
+
+@adverts_blueprint.route('/api/adverts.geojson')
+@login_required
+@conditional(adverts_etag)
+def advert_geojson():
+    """Function that returns the available adverts inside the bbox query parameter (min longitude, min latitude,
+    max longitude, max latitude) as a GeoJSON feature collection for the advert map
+    When the zoom query parameter is below CLUSTER_MAX_ZOOM, clusters of adverts are returned instead, with the
+    number of adverts in each cluster as their count property
+    Requires the user to be logged in
+
+    Returns:
+        flask.Response: returns the GeoJSON of the adverts, truncated is true if there were too many to send them all
+    """
+    min_lon, min_lat, max_lon, max_lat = get_bbox()
+    zoom = get_zoom()
+    if min_lon > max_lon or min_lat > max_lat:
+        # the box is entirely off the edge of the world map
+        body = geojson([])
+    elif zoom < datalink.CLUSTER_MAX_ZOOM:
+        precision = datalink.cluster_precision(zoom)
+        cells = datalink.cluster_cells(min_lat, min_lon, max_lat, max_lon, precision)
+        # every view of the map overlapping the same cells shows the same clusters, so they share the cached GeoJSON
+        body = fragment_cache.cached(
+            datalink.ADVERTS_CACHE, f"clusters:{precision}:{cells}",
+            lambda: geojson([cluster_feature(cluster) for cluster in
+                             datalink.get_clusters(precision, cells, limit=datalink.MAP_ADVERT_LIMIT + 1)])
+        )
+    else:
+        body = fragment_cache.cached(
+            datalink.ADVERTS_CACHE, f"adverts:{min_lon},{min_lat},{max_lon},{max_lat}",
+            lambda: geojson([advert_feature(row) for row in
+                             datalink.get_ads_in_box(min_lat, min_lon, max_lat, max_lon,
+                                                     limit=datalink.MAP_ADVERT_LIMIT + 1)])
+        )
+    return app.response_class(body, mimetype='application/json')
+
+
+def geojson(features):
+    """Function that returns the GeoJSON feature collection of at most MAP_ADVERT_LIMIT features
+
+    Returns:
+        str: the GeoJSON, truncated is true if there were more features than the limit
+    """
+    limit = datalink.MAP_ADVERT_LIMIT
+    return json.dumps({'type': 'FeatureCollection', 'features': features[:limit], 'truncated': len(features) > limit})
+
+
+def advert_feature(row):
+    """Function that returns the GeoJSON feature of an advert on the map, with what its popup shows
+
+    Returns:
+        dict: the GeoJSON feature
+    """
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [row.longitude, row.latitude]},
+        'properties': {
+            'id': row.adID,
+            'title': row.title,
+            'contents': row.contents,
+            'url': url_for('adverts.advert_details', advert=row.adID),
+        },
+    }
+
+
+def cluster_feature(cluster):
+    """Function that returns the GeoJSON feature of an advert map cluster, placed at the middle of its adverts
+
+    Returns:
+        dict: the GeoJSON feature
+    """
+    latitude, longitude = cluster.get_centre()
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+        'properties': {'cell': cluster.cell, 'count': cluster.count},
+    }
+
+
+def get_location():
+    """Function that reads the location to search around from the lat, lon and radius query parameters
+
+    Returns:
+        tuple: the latitude, longitude and radius in km, or None if no location was given
+    """
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lon', type=float)
+    radius = request.args.get('radius', datalink.NEAR_RADIUS_KM, type=float)
+    if latitude is None and longitude is None:
+        return None
+    if latitude is None or longitude is None or not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        abort(400)
+    if not 0 < radius <= MAX_RADIUS_KM:
+        abort(400)
+    return latitude, longitude, radius
+
+
+def get_cursor(sort):
+    """Function that reads where a page of the advert listing starts from the after and after_id query parameters
+
+    Returns:
+        tuple: the expiry date (None for the 'newest' sort) and id of the advert the page starts after,
+        or (None, None) for the first page
+    """
+    after_id = request.args.get('after_id', type=int)
+    if after_id is None:
+        return None, None
+    if sort == 'newest':
+        return None, after_id
+    try:
+        return datetime.datetime.fromisoformat(request.args.get('after', '')), after_id
+    except ValueError:
+        abort(400)
+
+
+def get_bbox():
+    """Function that reads the area of the map being looked at from the bbox query parameter, longitudes past the
+    edges of the world map (when the map wraps around) are cut off at the edges
+
+    Returns:
+        tuple: the minimum longitude, minimum latitude, maximum longitude and maximum latitude
+    """
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(value) for value in request.args.get('bbox', '').split(','))
+    except ValueError:
+        abort(400)
+    if not (min_lon <= max_lon and min_lat <= max_lat):
+        abort(400)
+    return max(min_lon, -180.0), max(min_lat, -90.0), min(max_lon, 180.0), min(max_lat, 90.0)
+
+
+def get_zoom():
+    """Function that reads the zoom level of the map from the zoom query parameter
+
+    Returns:
+        float: the zoom level, 0 shows the whole world
+    """
+    zoom = request.args.get('zoom', 0, type=float)
+    if not 0 <= zoom <= 24:
+        abort(400)
+    return zoom
@@ -1,7 +1,8 @@
 import os
 from flask import Flask, render_template
 from dotenv import load_dotenv
-from extensions import init_app, db, login_manager, csrf
+from extensions import init_app, db, login_manager, csrf, user_cache
+from commands import init_commands
 
 
 app = Flask(__name__)
@@ -12,13 +13,23 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 
 # Initialize extensions
 init_app(app)
+# Register command line commands
+init_commands(app)
 
 
 @login_manager.user_loader
 def load_user(id):
+    """ user loader function for LoginManager to get the logged in user on each request
+        a read only copy of the user (SessionUser) is cached between requests, so most requests, e.g. the chat
+        polls, don't query the database for it. The copy is dropped when datalink changes the user """
+    return user_cache.get(int(id), _load_session_user)
+
+
+def _load_session_user(id):
+    """ returns a copy of the user with id from the db, or None if there is no such user """
     from models import User
-    """ user loader function for LoginManager to get user instances from the db """
-    return User.query.get(int(id))
+    user = db.session.get(User, id)
+    return None if user is None else user.snapshot()
 
 
 # Define your Flask routes to render the HTML templates
@@ -69,4 +80,11 @@ if __name__ == '__main__':
     app.register_blueprint(adverts_blueprint)
     app.register_blueprint(messages_blueprint)
     app.register_blueprint(email_blueprint)
-    app.run(debug=True)
+
+    # Start the background jobs, e.g. the advert expiry sweep. With debug the reloader runs the app in a child
+    # process and only watches the files in this one, so the jobs are started in the child only
+    from scheduler import start_background_jobs
+    debug = True
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_jobs(app)
+    app.run(debug=debug)
@@ -0,0 +1,240 @@
+"""
+This python file contains the fragment cache used to avoid querying and rendering the same advert pages again.
+
+Cached values are stored under a namespace with a version counter, e.g. the advert listing is cached under the
+'adverts' namespace. datalink bumps the version of the namespace after a change is committed (a new advert, a
+collected or deleted advert, the expiry sweep), which makes every value cached for the old version unreachable, so
+nothing has to be deleted and a value is never served after the data it was built from has changed. Values also
+expire after FRAGMENT_CACHE_TTL seconds.
+
+The cache includes the following backends:
+- LRUCache: keeps values in memory in this process, dropping the least recently used ones when it is full.
+- RedisCache: keeps values and versions in Redis, so every worker process shares them.
+- NullCache: caches nothing.
+
+The backend is chosen with the FRAGMENT_CACHE setting: 'memory' (default), a redis:// url or 'none'.
+
+The file also includes the UserCache, which keeps a read only copy of each logged in user in memory so the user
+loader doesn't query the database on every request. Each user has a version, bumped when the user is changed through
+datalink (e.g. their role is set to 'off'), and a copy is only used while its version is current. The versions are
+kept by the backend named by the USER_CACHE_VERSIONS setting: 'memory' (default, for a single worker) or a redis://
+url, so a change made through one worker is seen by every other worker on their next request.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# prefix of the keys the Redis backend uses
+CACHE_PREFIX = 'feedforward:'
+
+
+class LRUCache:
+    """Backend that keeps up to max_entries values in memory, each for at most ttl seconds"""
+
+    def __init__(self, max_entries=512, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # versions only mean something within this process, and start again from 0 when it restarts
+        self.name = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+        self._versions = {}
+
+    def version(self, namespace):
+        """returns the current version of a namespace"""
+        with self._lock:
+            return self._versions.get(namespace, 0)
+
+    def bump(self, namespace):
+        """moves a namespace on to a new version"""
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+
+    def get(self, key):
+        """returns the value cached under key, or None"""
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._values[key]
+                return None
+            self._values.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """caches a value under key"""
+        with self._lock:
+            self._values[key] = (value, time.monotonic() + self.ttl)
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_entries:
+                self._values.popitem(last=False)
+
+    def delete(self, key):
+        """removes the value cached under key"""
+        with self._lock:
+            self._values.pop(key, None)
+
+
+class RedisCache:
+    """Backend that keeps the values and versions in Redis, shared by every worker"""
+
+    def __init__(self, url, ttl=60):
+        import redis
+        self.ttl = ttl
+        self.name = 'redis'
+        self._redis = redis.Redis.from_url(url)
+
+    def version(self, namespace):
+        """returns the current version of a namespace"""
+        return int(self._redis.get(f"{CACHE_PREFIX}version:{namespace}") or 0)
+
+    def bump(self, namespace):
+        """moves a namespace on to a new version"""
+        self._redis.incr(f"{CACHE_PREFIX}version:{namespace}")
+
+    def get(self, key):
+        """returns the value cached under key, or None"""
+        value = self._redis.get(CACHE_PREFIX + key)
+        return None if value is None else value.decode()
+
+    def set(self, key, value):
+        """caches a value under key"""
+        self._redis.set(CACHE_PREFIX + key, value, ex=self.ttl)
+
+    def delete(self, key):
+        """removes the value cached under key"""
+        self._redis.delete(CACHE_PREFIX + key)
+
+
+class NullCache:
+    """Backend that caches nothing, for development or debugging"""
+
+    name = None
+
+    def version(self, namespace):
+        """returns the version of a namespace, which never changes"""
+        return 0
+
+    def bump(self, namespace):
+        """does nothing, as nothing is cached"""
+
+    def get(self, key):
+        """returns None, as nothing is cached"""
+        return None
+
+    def set(self, key, value):
+        """does nothing, as nothing is cached"""
+
+    def delete(self, key):
+        """does nothing, as nothing is cached"""
+
+
+class FragmentCache:
+    """Flask extension that caches rendered fragments (strings) by namespace version.
+    The backend is set up from the app config by init_app, before that it caches in memory."""
+
+    def __init__(self, app=None):
+        self.backend = LRUCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """creates the backend named by the FRAGMENT_CACHE setting"""
+        setting = app.config.get('FRAGMENT_CACHE') or 'memory'
+        ttl = app.config.get('FRAGMENT_CACHE_TTL', 60)
+        if setting == 'memory':
+            self.backend = LRUCache(app.config.get('FRAGMENT_CACHE_SIZE', 512), ttl)
+        elif setting.startswith(('redis://', 'rediss://', 'unix://')):
+            self.backend = RedisCache(setting, ttl)
+        elif setting == 'none':
+            self.backend = NullCache()
+        else:
+            raise ValueError(f"Unknown fragment cache backend {setting}")
+
+    def bump(self, namespace):
+        """makes everything cached in a namespace out of date, call after the change is committed"""
+        self.backend.bump(namespace)
+
+    def version_tag(self, namespace):
+        """returns a tag that changes whenever the namespace is bumped, used in ETags (see conditional.py),
+        or None if the backend doesn't keep versions.
+        In memory versions don't see changes made by other processes (e.g. the expiry worker), so the tag also
+        changes every ttl seconds and an ETag is never trusted for longer than a cached fragment would be
+
+            Returns:
+                str: the backend and version of the namespace
+        """
+        if self.backend.name is None:
+            return None
+        tag = f"{self.backend.name}:{self.backend.version(namespace)}"
+        if isinstance(self.backend, LRUCache):
+            tag += f":{int(time.time() // self.backend.ttl)}"
+        return tag
+
+    def cached(self, namespace, key, render):
+        """returns the value cached under key for the current version of namespace,
+        calling render() to build and cache it if it isn't cached
+
+            Returns:
+                str: the cached or newly rendered value
+        """
+        # read the version before rendering, so a change committed while rendering isn't cached as up to date
+        full_key = f"{namespace}:{self.backend.version(namespace)}:{key}"
+        value = self.backend.get(full_key)
+        if value is None:
+            value = render()
+            self.backend.set(full_key, value)
+        return value
+
+
+class UserCache:
+    """Flask extension that keeps read only copies of users (see SessionUser in models.py) in memory for at most
+    USER_CACHE_TTL seconds, dropping the least recently used ones when more than USER_CACHE_SIZE are kept.
+    Each copy is stored with the version the user had when it was loaded, and is only returned while that is still
+    the user's version in the versions backend, which every worker shares when it is Redis. USER_CACHE_TTL = 0 turns
+    the cache off."""
+
+    def __init__(self, app=None):
+        self.backend = LRUCache(1024, 30)
+        # keeps the version of each user, the memory backend keeps them next to the copies
+        self.versions = self.backend
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """creates the backends from the USER_CACHE_SIZE, USER_CACHE_TTL and USER_CACHE_VERSIONS settings"""
+        ttl = app.config.get('USER_CACHE_TTL', 30)
+        self.backend = LRUCache(app.config.get('USER_CACHE_SIZE', 1024), ttl) if ttl > 0 else NullCache()
+        setting = app.config.get('USER_CACHE_VERSIONS') or 'memory'
+        if ttl <= 0 or setting == 'memory':
+            self.versions = self.backend
+        elif setting.startswith(('redis://', 'rediss://', 'unix://')):
+            self.versions = RedisCache(setting)
+        else:
+            raise ValueError(f"Unknown user cache versions backend {setting}")
+
+    def get(self, user_id, load):
+        """returns the copy of a user cached under their id, calling load(user_id) to get it if it isn't cached
+        or the user has changed since it was cached
+
+            Returns:
+                SessionUser: the copy of the user, or None if load finds no user
+        """
+        key = str(user_id)
+        # read the version before loading, so a copy loaded before a change was committed is out of date after it
+        version = self.versions.version(f"user:{key}")
+        entry = self.backend.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        user = load(user_id)
+        if user is not None:
+            self.backend.set(key, (version, user))
+        return user
+
+    def invalidate(self, user_id):
+        """makes the copies of a user out of date in every worker, call after a change to the user is committed"""
+        self.versions.bump(f"user:{user_id}")
+        self.backend.delete(str(user_id))
@@ -0,0 +1,98 @@
+"""
+This python file contains the flask command line commands used to maintain the database.
+
+Commands:
+- migrate-db: Bring the tables of a database created by an older version of the app up to date.
+- rebuild-conversations: Rebuild the conversation summaries from the message table.
+- rebuild-clusters: Rebuild the advert map clusters from the advert table.
+- rebuild-search-index: Rebuild the SQLite advert search table from the advert table.
+- expiry-worker: Run the advert expiry sweep in this process.
+- mail-worker: Send the queued emails from this process.
+- send-newsletter: Send a newsletter to every subscribed user.
+- reconcile-stats: Recount the daily statistics shown to admins.
+
+Run a command with: flask --app app <command>
+"""
+import click
+
+
+def init_commands(app):
+    """Function that registers the commands with the app"""
+
+    @app.cli.command('migrate-db')
+    def migrate_db_command():
+        """Create new tables and run the migrations the database still needs."""
+        from migrations import run_migrations
+        applied = run_migrations()
+        click.echo(f"Applied {', '.join(applied)}" if applied else "Database is up to date")
+
+    @app.cli.command('rebuild-conversations')
+    def rebuild_conversations_command():
+        """Rebuild the conversation summaries shown in the messages inbox from the message table."""
+        import datalink
+        count = datalink.rebuild_conversations()
+        click.echo(f"Rebuilt {count} conversations")
+
+    @app.cli.command('rebuild-clusters')
+    def rebuild_clusters_command():
+        """Rebuild the advert map clusters from the advert table."""
+        import datalink
+        count = datalink.rebuild_clusters()
+        click.echo(f"Rebuilt {count} clusters")
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index_command():
+        """Rebuild the SQLite advert search table from the advert table (Postgres keeps its own index)."""
+        import datalink
+        count = datalink.rebuild_search_index()
+        click.echo(f"Indexed {count} adverts")
+
+    @app.cli.command('expiry-worker')
+    @click.option('--once', is_flag=True, help="Sweep once and exit.")
+    def expiry_worker_command(once):
+        """Mark out of date adverts as unavailable every EXPIRY_SWEEP_INTERVAL seconds."""
+        from scheduler import expiry_sweep_job
+        job = expiry_sweep_job(app)
+        if once:
+            job.run_once()
+        else:
+            job.run()
+
+    @app.cli.command('mail-worker')
+    @click.option('--once', is_flag=True, help="Send the emails that are due and exit.")
+    def mail_worker_command(once):
+        """Send the queued emails every MAIL_QUEUE_INTERVAL seconds."""
+        from scheduler import mail_queue_job
+        job = mail_queue_job(app)
+        if once:
+            job.run_once()
+        else:
+            job.run()
+
+    @app.cli.command('send-newsletter')
+    @click.argument('subject')
+    @click.argument('body', type=click.File())
+    def send_newsletter_command(subject, body):
+        """Send a newsletter to every subscribed user, with SUBJECT and the text of the BODY file.
+        $first_name in the text is replaced with the first name of each subscriber."""
+        import datalink
+        from models import NewsletterBroadcast
+        broadcast = NewsletterBroadcast(subject, body.read())
+        datalink.create_broadcast(broadcast)
+        click.echo(f"Created broadcast {broadcast.id}, it is sent to the subscribers by the mail queue")
+
+    @app.cli.command('reconcile-stats')
+    @click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']),
+                  help="Recount every day from this date (YYYY-MM-DD), e.g. to fill in the days before the "
+                       "statistics were kept.")
+    def reconcile_stats_command(since):
+        """Recount the daily statistics of the last STATS_RECONCILE_DAYS days from the advert, foodorder and
+        message tables. Run every night by the website unless STATS_RECONCILE_THREAD is False."""
+        if since is None:
+            from scheduler import reconcile_latest_stats
+            count = reconcile_latest_stats(app)
+        else:
+            import datalink
+            from datetime import date
+            count = datalink.reconcile_stats(since.date(), date.today())
+        click.echo(f"Recounted {count} days")
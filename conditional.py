@@ -0,0 +1,75 @@
+"""
+This python file contains the helpers for answering requests with 304 Not Modified when the client is up to date.
+
+A view decorated with conditional is given a validator function, which describes the version of the response
+the view would return (an ETag built from row versions or counters, and optionally the time it last changed)
+without building the response. If the client already has that version (If-None-Match or If-Modified-Since), a
+bodiless 304 is returned and the view doesn't run. Otherwise the view runs as usual and the ETag and Last-Modified
+headers are added to its response, so the browser asks again next time.
+
+The file includes:
+- make_etag: Returns an ETag built from a list of values.
+- conditional: Decorator that answers a view with 304 Not Modified when the client's copy is up to date.
+"""
+import hashlib
+from datetime import timezone
+from functools import wraps
+
+from flask import request, session, make_response
+
+
+def make_etag(*parts):
+    """Function that returns an ETag for the values that a response depends on
+
+    Returns:
+        str: a short hash of the values
+    """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:20]
+
+
+def _is_fresh(etag, last_modified):
+    """returns if the copy the client already has is the version described by etag and last_modified"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        # the header only has whole seconds
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def _add_validators(response, etag, last_modified):
+    """adds the ETag, Last-Modified and Cache-Control headers to a response"""
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # the responses depend on who is logged in, and the browser must check they are up to date before using them
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def conditional(validator):
+    """Decorator that answers GET requests with 304 Not Modified when the client's copy of the response is up to date.
+    validator is called with the arguments of the view and returns (etag, last_modified) for the response the view
+    would return, where last_modified can be None, or returns None to always run the view.
+    Responses are always built when there are flashed messages waiting to be shown."""
+    def wrapper(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+                return f(*args, **kwargs)
+            validators = validator(*args, **kwargs)
+            if validators is None:
+                return f(*args, **kwargs)
+            etag, last_modified = validators
+            if last_modified is not None:
+                # the database stores local times
+                last_modified = last_modified.astimezone(timezone.utc)
+            if _is_fresh(etag, last_modified):
+                return _add_validators(make_response('', 304), etag, last_modified)
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                _add_validators(response, etag, last_modified)
+            return response
+        return wrapped
+    return wrapper
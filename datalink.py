@@ -1,13 +1,57 @@
+import math
 import os
-from datetime import datetime
+import re
+import uuid
+from datetime import date, datetime, time, timedelta
 
 from dotenv import load_dotenv
+from flask import current_app
 import sqlalchemy
-from sqlalchemy import and_, or_
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import and_, or_, case, func, select, insert, delete, update, literal, literal_column, true, false
+from sqlalchemy.orm import aliased, selectinload, joinedload, lazyload
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 
+import geo
 from app import db
-from models import User, Advert, Message, Collection
+from extensions import message_hub, fragment_cache, user_cache
+from models import User, Advert, Message, Collection, Conversation, AdvertCluster, OutboundEmail, NewsletterBroadcast
+from models import DailyStat, UserActivity
+from models import PREVIEW_LENGTH, CLUSTER_PRECISIONS, search_document, advert_fts
+
+# maximum number of new messages returned by a single chat poll
+MESSAGE_POLL_LIMIT = 50
+# number of conversations shown on each page of the messages inbox
+INBOX_PAGE_SIZE = 20
+# number of messages shown when a chat is opened and loaded each time older messages are fetched
+CHAT_PAGE_SIZE = 50
+# number of adverts shown on each page of the advert listing
+LISTING_PAGE_SIZE = 25
+# number of adverts shown on each page of search results
+SEARCH_PAGE_SIZE = 25
+# orders the advert listing can be sorted in: expiring soonest first or newest first
+LISTING_SORTS = ('expiry', 'newest')
+# default search radius and number of adverts returned when looking for adverts near a location
+NEAR_RADIUS_KM = 10
+NEAR_LIMIT = 50
+# adverts near a location are picked from at most this many times limit of the adverts nearest on a flat map
+NEAR_CANDIDATE_FACTOR = 4
+# most adverts sent for one view of the advert map
+MAP_ADVERT_LIMIT = 1000
+# the advert map shows clusters instead of single adverts when zoomed out further than this
+CLUSTER_MAX_ZOOM = 13
+# namespace of the cached advert pages, made out of date whenever the available adverts change
+ADVERTS_CACHE = 'adverts'
+# number of adverts marked as unavailable in each statement of the expiry sweep
+EXPIRY_BATCH_SIZE = 500
+# number of rows shown on each page of a section of the admin dashboard
+ADMIN_PAGE_SIZE = 20
+# sections of adverts on the admin dashboard
+ADMIN_ADVERT_SECTIONS = ('current', 'collected', 'deleted')
+# loader options the EAGER_LOADING setting chooses between
+EAGER_LOADERS = {'selectin': selectinload, 'joined': joinedload, 'lazy': lazyload}
+# days of statistics shown when no range is chosen, and the most days returned for one range
+STATS_DEFAULT_DAYS = 30
+STATS_MAX_DAYS = 366
 
 
 def _connect():
@@ -29,30 +73,163 @@ def create_user(user):
     db.session.commit()
 
 
+def update_user(user):
+    """saves changes made to a User object, e.g. their details or role,
+        and drops the copy of the user cached by the user loader so the next request sees the change
+    """
+    db.session.commit()
+    user_cache.invalidate(user.id)
+
+
 def create_advert(advert):
-    """Add a new advert row to advert table using an Advert object"""
+    """Add a new advert row to advert table using an Advert object,
+        add it to the advert map clusters, search index and daily statistics in the same transaction
+        and make the cached advert pages out of date
+    """
     db.session.add(advert)
+    if advert.available:
+        _adverts_listed([advert])
+    _count_stats(advert.created.date(), advert.owner, adverts_posted=1)
     db.session.commit()
+    fragment_cache.bump(ADVERTS_CACHE)
 
 
 def create_order(order):
-    """Add new order row to foodorder table"""
+    """Add new order row to foodorder table, counted in the daily statistics in the same transaction"""
     db.session.add(order)
+    _count_stats(order.date.date(), order.buyer, adverts_collected=1)
     db.session.commit()
 
 
+def _lock_or_create(model, key, create):
+    """returns the row of model with primary key key, locked until the transaction ends,
+        adding the row made by create() if there isn't one yet
+        - the new row is inserted in a savepoint, so if another transaction inserts the same row first only the
+          savepoint is rolled back and the other transaction's row is locked instead of the request failing
+    """
+    row = db.session.get(model, key, with_for_update=True)
+    if row is not None:
+        return row
+    try:
+        with db.session.begin_nested():
+            row = create()
+            db.session.add(row)
+    except IntegrityError:
+        row = db.session.get(model, key, with_for_update=True, populate_existing=True)
+    return row
+
+
 def create_message(message):
-    """Add a new message row to message table using an message object"""
+    """Add a new message row to message table using an message object,
+        update the conversation summary and daily statistics in the same transaction
+        and wake any chat requests waiting on the conversation
+    """
     db.session.add(message)
+    # get the id of the message for the summary
+    db.session.flush()
+    user_low, user_high = message.user_low, message.user_high
+
+    def new_conversation():
+        conversation = Conversation(user_low, user_high)
+        conversation.set_last_message(message)
+        return conversation
+    # lock the summary row so concurrent messages don't lose unread counts
+    conversation = _lock_or_create(Conversation, (user_low, user_high), new_conversation)
+    if conversation.last_timestamp is None or message.timestamp >= conversation.last_timestamp:
+        conversation.set_last_message(message)
+    if message.receiver == user_low:
+        conversation.unread_low += 1
+    else:
+        conversation.unread_high += 1
+    _count_stats(message.timestamp.date(), message.sender, messages=1)
     db.session.commit()
+    message_hub.publish(message.sender, message.receiver)
 
 
 def get_available_ads():
     """returns list of adverts that are currently available to collect
-        automatically marks out of date ads as unavailable
+        - out of date ads are left out here and marked as unavailable by the expiry sweep
+          in the background (see scheduler.py), so this only reads from the database
     """
-    check_expiry()
-    return Advert.query.filter_by(available=True).all()
+    return Advert.query.filter(Advert.available, Advert.expiry >= datetime.now()).all()
+
+
+def get_ads_page(sort='expiry', owner=None, text=None, after=None, after_id=None, limit=LISTING_PAGE_SIZE):
+    """return a page of the available adverts sorted by sort (see LISTING_SORTS),
+        only those of owner and whose title or description contain every word of text when they are given
+        - the page starts just after the advert with expiry after and id after_id ('expiry' sort) or just after
+          the advert with id after_id ('newest' sort), or at the start if they aren't given
+        - seeks straight to the page through the expiry index or the primary key, so later pages cost the
+          same as the first
+    """
+    query = Advert.query.filter(Advert.available, Advert.expiry >= datetime.now())
+    if owner is not None:
+        query = query.filter(Advert.owner == owner)
+    if text and _search_words(text):
+        query = query.filter(_text_filter(text))
+    if sort == 'newest':
+        # ids are given out in order, so the highest ids are the newest adverts
+        if after_id is not None:
+            query = query.filter(Advert.adID < after_id)
+        query = query.order_by(Advert.adID.desc())
+    elif sort == 'expiry':
+        if after is not None:
+            query = query.filter(or_(Advert.expiry > after, and_(Advert.expiry == after, Advert.adID > after_id)))
+        query = query.order_by(Advert.expiry, Advert.adID)
+    else:
+        raise ValueError(f"Unknown advert sort {sort}")
+    return query.limit(limit).all()
+
+
+def _in_box(min_lat, min_lon, max_lat, max_lon):
+    """returns the filter for available adverts inside a bounding box
+        - the geohash ranges covering the box are range scans of the geohash index (see geo.py),
+          the latitude and longitude checks then drop the adverts in those cells but outside the box
+    """
+    cells = [Advert.geohash >= first if after is None else and_(Advert.geohash >= first, Advert.geohash < after)
+             for first, after in geo.geohash_ranges(min_lat, min_lon, max_lat, max_lon)]
+    return and_(
+        or_(*cells),
+        Advert.latitude.between(min_lat, max_lat),
+        Advert.longitude.between(min_lon, max_lon),
+        Advert.available,
+        Advert.expiry >= datetime.now()
+    )
+
+
+def get_ads_near(latitude, longitude, radius_km=NEAR_RADIUS_KM, limit=NEAR_LIMIT):
+    """returns the available adverts within radius_km of a location, nearest first
+        - adverts in the bounding box of the circle are found through the geohash index, and the database returns
+          the limit * NEAR_CANDIDATE_FACTOR nearest of them by their distance on a flat map, so a crowded area is
+          never read in full; the exact distance is then worked out for just those adverts
+        - returns a list of (advert, distance in km) pairs
+    """
+    # squared distance in degrees, with degrees of longitude shortened to their length at this latitude
+    lon_scale = math.cos(math.radians(latitude)) ** 2
+    flat_distance = ((Advert.latitude - latitude) * (Advert.latitude - latitude)
+                     + (Advert.longitude - longitude) * (Advert.longitude - longitude) * lon_scale)
+    candidates = Advert.query.filter(_in_box(*geo.bounding_box(latitude, longitude, radius_km))).order_by(
+        flat_distance, Advert.adID
+    ).limit(limit * NEAR_CANDIDATE_FACTOR).all()
+    nearby = []
+    for advert in candidates:
+        distance = geo.haversine_km(latitude, longitude, advert.latitude, advert.longitude)
+        if distance <= radius_km:
+            nearby.append((advert, distance))
+    nearby.sort(key=lambda pair: (pair[1], pair[0].adID))
+    return nearby[:limit]
+
+
+def get_ads_in_box(min_lat, min_lon, max_lat, max_lon, limit=MAP_ADVERT_LIMIT):
+    """returns the id, title, contents, latitude and longitude of the available adverts inside a bounding box,
+        used to draw the part of the advert map being looked at
+        - at most limit rows are returned
+    """
+    return db.session.execute(
+        select(Advert.adID, Advert.title, Advert.contents, Advert.latitude, Advert.longitude)
+        .where(_in_box(min_lat, min_lon, max_lat, max_lon))
+        .limit(limit)
+    ).all()
 
 
 def get_user(email):
@@ -61,8 +238,18 @@ def get_user(email):
 
 
 def get_user_from_id(user_id):
-    """returns a User object from the database using their username"""
-    return User.query.filter_by(id=user_id).first()
+    """returns a User object from the database using their id, or None if there is no such user
+        - current_user is a read only copy that isn't in the session (see SessionUser), so views that change the
+          user load it with this, which queries the database
+    """
+    return db.session.get(User, int(user_id))
+
+
+def get_advert(ad_id):
+    """returns an Advert object from the database using its id, or None if there is no such advert
+        - an advert already loaded in this request is returned without querying the database again
+    """
+    return db.session.get(Advert, int(ad_id))
 
 
 def is_unique(email):
@@ -71,25 +258,221 @@ def is_unique(email):
 
 
 def set_advert_unavailable(ad_id):
-    """marks advert as unavailable using its ID"""
-    ad = Advert.query.filter_by(adID=ad_id).first()
+    """marks advert as unavailable using its ID, removes it from the advert map clusters and search index
+        and makes the cached advert pages out of date
+        - returns True if the advert was available, False if another request made it unavailable first
+    """
+    # lock the row and read it again even if the advert is already loaded, as it may have changed since
+    ad = db.session.get(Advert, ad_id, with_for_update=True, populate_existing=True)
+    was_available = ad.available
+    if was_available:
+        _adverts_unlisted([ad])
+        ad.unlisted = datetime.now()
     ad.available = False
     db.session.commit()
+    fragment_cache.bump(ADVERTS_CACHE)
+    return was_available
 
 
 def check_expiry():
-    """finds and marks all adverts past their expiry date as unavailable"""
-    # equivalent to UPDATE Advert SET available=False WHERE available AND expiry < now
-    Advert.query.filter(
-        and_(Advert.available, Advert.expiry < datetime.now())
-    ).update({Advert.available: False})
+    """finds and marks all adverts past their expiry date as unavailable
+        - run periodically by the expiry sweep job
+        - the adverts are removed from the advert map clusters and search index and counted as expired today in the
+          daily statistics in the same transaction
+        - returns the number of adverts marked
+    """
+    now = datetime.now()
+    expired = db.session.execute(
+        select(Advert.adID, Advert.latitude, Advert.longitude, Advert.geohash)
+        .where(Advert.available, Advert.expiry < now)
+        .with_for_update()
+    ).all()
+    for start in range(0, len(expired), EXPIRY_BATCH_SIZE):
+        ids = [row.adID for row in expired[start:start + EXPIRY_BATCH_SIZE]]
+        db.session.execute(update(Advert).where(Advert.adID.in_(ids)).values(available=False, unlisted=now))
+    _adverts_unlisted(expired)
+    _count_stats(now.date(), adverts_expired=len(expired))
     db.session.commit()
+    if expired:
+        fragment_cache.bump(ADVERTS_CACHE)
+    return len(expired)
+
+
+def _adverts_listed(adverts):
+    """adds adverts that have become available to the advert map clusters and the search index
+        - the caller commits, so they change in the same transaction as the adverts
+    """
+    # give new adverts their id
+    db.session.flush()
+    _update_clusters(adverts, 1)
+    if _dialect() == 'sqlite':
+        db.session.execute(insert(advert_fts), [{'rowid': advert.adID, 'title': advert.title,
+                                                 'contents': advert.contents} for advert in adverts])
+
+
+def _adverts_unlisted(adverts):
+    """removes adverts that are no longer available from the advert map clusters and the search index
+        - adverts can be Advert objects or rows with adID, latitude, longitude and geohash
+        - the caller commits, so they change in the same transaction as the adverts
+    """
+    if not adverts:
+        return
+    _update_clusters(adverts, -1)
+    if _dialect() == 'sqlite':
+        ids = [advert.adID for advert in adverts]
+        for start in range(0, len(ids), EXPIRY_BATCH_SIZE):
+            db.session.execute(delete(advert_fts).where(advert_fts.c.rowid.in_(ids[start:start + EXPIRY_BATCH_SIZE])))
+
+
+def _update_clusters(adverts, change):
+    """adds (change 1) or removes (change -1) adverts from the advert map clusters of their cells
+        - adverts can be Advert objects or rows with latitude, longitude and geohash
+        - the caller commits, so the clusters change in the same transaction as the adverts
+    """
+    changes = {}
+    for advert in adverts:
+        geohash = advert.geohash or geo.encode_geohash(advert.latitude, advert.longitude)
+        for precision in CLUSTER_PRECISIONS:
+            totals = changes.setdefault((precision, geohash[:precision]), [0, 0.0, 0.0])
+            totals[0] += change
+            totals[1] += change * advert.latitude
+            totals[2] += change * advert.longitude
+    # lock the rows in the same order every time, so concurrent changes can't deadlock
+    for key in sorted(changes):
+        count, lat_sum, lon_sum = changes[key]
+        if count > 0:
+            cluster = _lock_or_create(AdvertCluster, key, lambda: AdvertCluster(*key))
+        else:
+            cluster = db.session.get(AdvertCluster, key, with_for_update=True)
+            if cluster is None:
+                continue
+        cluster.count += count
+        cluster.lat_sum += lat_sum
+        cluster.lon_sum += lon_sum
+        if cluster.count <= 0:
+            db.session.delete(cluster)
+
+
+def _dialect():
+    """returns the name of the database the session uses, e.g. 'sqlite' or 'postgresql'"""
+    return db.session.get_bind().dialect.name
+
+
+def _search_words(text):
+    """returns the words of a search, so punctuation can't be read as search syntax"""
+    return re.findall(r"\w+", text.lower())
+
+
+def _fts_match(words):
+    """returns the filter for rows of advert_fts containing every word"""
+    return literal_column('advert_fts').op('MATCH')(" ".join(f'"{word}"' for word in words))
+
+
+def _text_filter(text):
+    """returns the filter for adverts whose title or description contain every word of text
+        - uses the Postgres search index or the SQLite advert_fts table, other databases scan the adverts
+    """
+    words = _search_words(text)
+    dialect = _dialect()
+    if dialect == 'postgresql':
+        return search_document(Advert.title, Advert.contents).op('@@')(
+            func.plainto_tsquery(literal_column("'english'"), " ".join(words)))
+    if dialect == 'sqlite':
+        return Advert.adID.in_(select(advert_fts.c.rowid).where(_fts_match(words)))
+    return and_(*[or_(Advert.title.icontains(word, autoescape=True), Advert.contents.icontains(word, autoescape=True))
+                  for word in words])
+
+
+def search_ads(text, limit=SEARCH_PAGE_SIZE, offset=0):
+    """return the available adverts whose title or description contain every word of text, best match first
+        - Postgres ranks with ts_rank and SQLite with bm25, other databases list the matches by expiry date
+    """
+    words = _search_words(text)
+    if not words:
+        return []
+    query = select(Advert).where(Advert.available, Advert.expiry >= datetime.now())
+    dialect = _dialect()
+    if dialect == 'postgresql':
+        document = search_document(Advert.title, Advert.contents)
+        search = func.plainto_tsquery(literal_column("'english'"), " ".join(words))
+        query = query.where(document.op('@@')(search)).order_by(func.ts_rank(document, search).desc())
+    elif dialect == 'sqlite':
+        query = query.join(advert_fts, advert_fts.c.rowid == Advert.adID).where(_fts_match(words)).order_by(
+            func.bm25(literal_column('advert_fts')))
+    else:
+        query = query.where(_text_filter(text)).order_by(Advert.expiry)
+    return db.session.scalars(query.order_by(Advert.adID).limit(limit).offset(offset)).all()
+
+
+def rebuild_search_index():
+    """rebuilds the SQLite advert_fts table from the available adverts, Postgres keeps its index up to date itself
+        - returns the number of adverts indexed
+    """
+    if _dialect() != 'sqlite':
+        return 0
+    db.session.execute(delete(advert_fts))
+    result = db.session.execute(
+        insert(advert_fts).from_select(['rowid', 'title', 'contents'],
+                                       select(Advert.adID, Advert.title, Advert.contents).where(Advert.available))
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def rebuild_clusters():
+    """rebuilds the advert_cluster table from the advert table, with one INSERT ... SELECT for each precision
+        - returns the number of clusters
+    """
+    db.session.execute(delete(AdvertCluster))
+    clusters = 0
+    for precision in CLUSTER_PRECISIONS:
+        cell = func.substr(Advert.geohash, 1, precision)
+        result = db.session.execute(
+            insert(AdvertCluster).from_select(
+                ['precision', 'cell', 'count', 'lat_sum', 'lon_sum'],
+                select(literal(precision), cell, func.count(), func.sum(Advert.latitude), func.sum(Advert.longitude))
+                .where(Advert.available, Advert.geohash.is_not(None))
+                .group_by(cell)
+            )
+        )
+        clusters += result.rowcount
+    db.session.commit()
+    return clusters
+
+
+def cluster_precision(zoom):
+    """returns the geohash length of the clusters shown on the advert map at a zoom level"""
+    return min(max(int(zoom) // 2, CLUSTER_PRECISIONS[0]), CLUSTER_PRECISIONS[-1])
+
+
+def cluster_cells(min_lat, min_lon, max_lat, max_lon, precision):
+    """returns the ranges of cells of one precision that overlap a bounding box, see geo.geohash_ranges
+        - views of the map that overlap the same cells are shown the same clusters
+    """
+    return geo.geohash_ranges(min_lat, min_lon, max_lat, max_lon, max_precision=precision)
+
+
+def get_clusters(precision, cells, limit=MAP_ADVERT_LIMIT):
+    """returns the advert map clusters of one precision in the ranges of cells from cluster_cells
+        - the cells are found with range scans of the advert_cluster primary key
+        - at most limit clusters are returned
+    """
+    ranges = [AdvertCluster.cell >= first if after is None
+              else and_(AdvertCluster.cell >= first, AdvertCluster.cell < after)
+              for first, after in cells]
+    return AdvertCluster.query.filter(AdvertCluster.precision == precision, or_(*ranges)).limit(limit).all()
+
+
+def get_clusters_in_box(min_lat, min_lon, max_lat, max_lon, precision, limit=MAP_ADVERT_LIMIT):
+    """returns the advert map clusters of one precision whose cells overlap a bounding box"""
+    return get_clusters(precision, cluster_cells(min_lat, min_lon, max_lat, max_lon, precision), limit)
 
 
 def update_details(database_user, updated_user):
     """updates old_user's details to have updated_user's attribtutes
         - note a new username must be unique
         - note role cannot be changed to admin here
+        - the copy of the user cached by the user loader is dropped, so the next request sees the change
     """
     if updated_user.role == "admin" and database_user.role != "admin":
         raise ValueError("Cannot change role to admin")
@@ -104,11 +487,160 @@ def update_details(database_user, updated_user):
     database_user.address = updated_user.address
     database_user.role = updated_user.role
     db.session.commit()
+    user_cache.invalidate(database_user.id)
+
+
+def _eager(*relationships):
+    """returns the loader option that loads a chain of relationships with the EAGER_LOADING strategy,
+        e.g. _eager(Advert.collections, Collection.buyer_user) loads the collections of adverts and who collected them
+    """
+    loader = EAGER_LOADERS[current_app.config.get('EAGER_LOADING', 'selectin')]
+    option = loader(relationships[0])
+    for relationship in relationships[1:]:
+        option = getattr(option, loader.__name__)(relationship)
+    return option
+
+
+def get_user_adverts(owner_id, available=None, with_collections=False):
+    """returns the adverts posted by a user, e.g. for their account page
+        - available True or False only returns the available or unavailable adverts
+        - with_collections loads the collection of each advert and who collected it with the adverts
+    """
+    query = select(Advert).where(Advert.owner == owner_id)
+    if available is not None:
+        query = query.where(Advert.available == available)
+    if with_collections:
+        query = query.options(_eager(Advert.collections, Collection.buyer_user))
+    return db.session.execute(query).unique().scalars().all()
 
 
 def get_user_collections(collector_id):
-    """return collections made by a user"""
-    return Collection.query.filter_by(buyer=collector_id)
+    """return collections made by a user, with the advert collected and who posted it loaded with them"""
+    return db.session.execute(
+        select(Collection).where(Collection.buyer == collector_id)
+        .options(_eager(Collection.collected_advert), _eager(Collection.seller_user))
+    ).unique().scalars().all()
+
+
+def _collected():
+    """returns the condition that an advert has been collected"""
+    return select(Collection.advert).where(Collection.advert == Advert.adID).exists()
+
+
+def get_admin_summary():
+    """returns the numbers shown at the top of the admin dashboard, counted by the database
+        - a dict of the number of current, collected and deleted (or expired) adverts, users and admins
+    """
+    unavailable = Advert.available == false()
+    adverts = db.session.execute(
+        select(func.coalesce(func.sum(case((Advert.available, 1), else_=0)), 0),
+               func.coalesce(func.sum(case((and_(unavailable, _collected()), 1), else_=0)), 0),
+               func.coalesce(func.sum(case((and_(unavailable, ~_collected()), 1), else_=0)), 0))
+    ).one()
+    roles = dict(db.session.execute(select(User.role, func.count()).group_by(User.role)).all())
+    return {'current': adverts[0], 'collected': adverts[1], 'deleted': adverts[2],
+            'users': roles.get('user', 0), 'admins': roles.get('admin', 0)}
+
+
+def get_admin_adverts(section, limit=ADMIN_PAGE_SIZE, offset=0):
+    """returns a page of the adverts in a section of the admin dashboard, one of ADMIN_ADVERT_SECTIONS
+        - 'current' adverts are available, soonest expiry first
+        - 'collected' adverts are unavailable and have a collection, 'deleted' adverts are unavailable without one
+          (deleted or expired), found with an anti-join, newest first
+        - limit and offset select a page of adverts
+    """
+    query = select(Advert)
+    if section == 'current':
+        query = query.where(Advert.available).order_by(Advert.expiry, Advert.adID)
+    elif section == 'collected':
+        query = query.where(Advert.available == false(), _collected()).order_by(Advert.adID.desc())
+    elif section == 'deleted':
+        query = query.where(Advert.available == false(), ~_collected()).order_by(Advert.adID.desc())
+    else:
+        raise ValueError(f"Unknown advert section {section}")
+    return db.session.execute(query.limit(limit).offset(offset)).scalars().all()
+
+
+def get_users_by_role(role, limit=ADMIN_PAGE_SIZE, offset=0):
+    """returns a page of the users with a role, in order of their id"""
+    return db.session.execute(
+        select(User).where(User.role == role).order_by(User.id).limit(limit).offset(offset)
+    ).scalars().all()
+
+
+def _count_stats(day, user_id=None, **changes):
+    """adds changes to the counters of a day's statistics, e.g. messages=1, creating the day if needed
+        - user_id is counted as an active user, once a day
+        - the caller commits, so the counters change in the same transaction as the rows they count
+    """
+    if user_id is not None and db.session.get(UserActivity, (day, user_id)) is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(UserActivity(day, user_id))
+            changes['active_users'] = changes.get('active_users', 0) + 1
+        except IntegrityError:
+            # another request from the user counted them first
+            pass
+    if not any(changes.values()):
+        return
+    # lock the day so concurrent changes don't lose counts
+    stat = _lock_or_create(DailyStat, day, lambda: DailyStat(day))
+    for counter, change in changes.items():
+        setattr(stat, counter, getattr(stat, counter) + change)
+
+
+def record_activity(user_id):
+    """counts a user as active today in the daily statistics, e.g. when they log in"""
+    _count_stats(date.today(), user_id)
+    db.session.commit()
+
+
+def get_daily_stats(first_day, last_day):
+    """returns the statistics of every day from first_day to last_day, in order
+        - read by primary key from daily_stat, days without a row have nothing counted
+    """
+    stats = {stat.day: stat for stat in db.session.execute(
+        select(DailyStat).where(DailyStat.day >= first_day, DailyStat.day <= last_day)
+    ).scalars()}
+    days = (first_day + timedelta(days=number) for number in range((last_day - first_day).days + 1))
+    return [stats.get(day) or DailyStat(day) for day in days]
+
+
+def reconcile_stats(first_day, last_day):
+    """recounts the statistics of every day from first_day to last_day from the advert, foodorder and message tables
+        - run every night by the statistics job for the last few days, in case a counter missed a change
+        - users who posted, collected or sent a message are added to the day's active users,
+          logins are only known from user_activity
+        - rows deleted since are no longer counted, so older days are best left as they were counted
+        - each day is committed on its own, returns the number of days recounted
+    """
+    day = first_day
+    while day <= last_day:
+        start = datetime.combine(day, time())
+        end = start + timedelta(days=1)
+        stat = _lock_or_create(DailyStat, day, lambda: DailyStat(day))
+        posted = and_(Advert.created >= start, Advert.created < end)
+        collected = and_(Collection.date >= start, Collection.date < end)
+        sent = and_(Message.timestamp >= start, Message.timestamp < end)
+        stat.adverts_posted = db.session.scalar(select(func.count(Advert.adID)).where(posted))
+        stat.adverts_collected = db.session.scalar(select(func.count()).select_from(Collection).where(collected))
+        # unlisted by the expiry sweep rather than collected or deleted before they expired
+        stat.adverts_expired = db.session.scalar(select(func.count(Advert.adID)).where(
+            Advert.unlisted >= start, Advert.unlisted < end, Advert.available == false(),
+            Advert.unlisted >= Advert.expiry, ~_collected()
+        ))
+        stat.messages = db.session.scalar(select(func.count(Message.id)).where(sent))
+
+        active = set(db.session.execute(
+            select(Advert.owner).where(posted)
+            .union(select(Collection.buyer).where(collected), select(Message.sender).where(sent))
+        ).scalars())
+        recorded = set(db.session.execute(select(UserActivity.user).where(UserActivity.day == day)).scalars())
+        db.session.add_all(UserActivity(day, user_id) for user_id in active - recorded)
+        stat.active_users = len(active | recorded)
+        db.session.commit()
+        day += timedelta(days=1)
+    return (last_day - first_day).days + 1 if last_day >= first_day else 0
 
 
 def get_conversations(user_id):
@@ -118,40 +650,261 @@ def get_conversations(user_id):
     return q1.union(q2).all()
 
 
+def get_inbox(user_id, limit=INBOX_PAGE_SIZE, offset=0):
+    """returns the users a user has had a conversation with and the summary of each conversation
+        as a list of (User, Conversation) pairs, most recent conversation first
+        - limit and offset select a page of conversations
+    """
+    partner_id = case((Conversation.user_low == user_id, Conversation.user_high), else_=Conversation.user_low)
+    return db.session.query(User, Conversation).join(
+        Conversation, User.id == partner_id
+    ).filter(
+        or_(Conversation.user_low == user_id, Conversation.user_high == user_id)
+    ).order_by(Conversation.last_timestamp.desc()).limit(limit).offset(offset).all()
+
+
+def mark_conversation_read(user_id, partner_id):
+    """marks every message a user has received in a conversation as read"""
+    user_low, user_high = Conversation.pair(user_id, partner_id)
+    unread = Conversation.unread_low if user_id == user_low else Conversation.unread_high
+    db.session.execute(
+        update(Conversation).where(
+            Conversation.user_low == user_low, Conversation.user_high == user_high, unread > 0
+        ).values({unread: 0})
+    )
+    db.session.commit()
+
+
+def queue_email(email):
+    """adds an OutboundEmail to the mail queue, it is sent in the background by the mail queue job"""
+    db.session.add(email)
+    db.session.commit()
+
+
+def claim_emails(limit, lease):
+    """returns up to limit queued emails that are due, oldest first, for the mailer to send
+        - their send_after is moved lease seconds on, so other mail workers don't send them too
+          and they are tried again if this worker stops before recording what happened
+        - returns rows of (id, recipient, subject, body, attempts), attempts not counting this one
+    """
+    now = datetime.now()
+    ids = db.session.execute(
+        select(OutboundEmail.id)
+        .where(OutboundEmail.status == 'queued', OutboundEmail.send_after <= now)
+        .order_by(OutboundEmail.send_after, OutboundEmail.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+    if not ids:
+        db.session.commit()
+        return []
+    # SQLite ignores the row locks, so another worker may have read the same ids: the update only leases the emails
+    # that are still due, and only the ones with this claim's token are sent
+    token = uuid.uuid4().hex
+    db.session.execute(
+        update(OutboundEmail)
+        .where(OutboundEmail.id.in_(ids), OutboundEmail.status == 'queued', OutboundEmail.send_after <= now)
+        .values(attempts=OutboundEmail.attempts + 1, send_after=now + timedelta(seconds=lease), claim=token)
+    )
+    rows = db.session.execute(
+        select(OutboundEmail.id, OutboundEmail.recipient, OutboundEmail.subject, OutboundEmail.body,
+               (OutboundEmail.attempts - 1).label('attempts'))
+        .where(OutboundEmail.claim == token)
+        .order_by(OutboundEmail.id)
+    ).all()
+    db.session.commit()
+    return rows
+
+
+def record_emails_sent(email_ids, sent):
+    """marks the emails with the given ids as sent at time sent"""
+    if email_ids:
+        db.session.execute(
+            update(OutboundEmail).where(OutboundEmail.id.in_(email_ids)).values(status='sent', sent=sent)
+        )
+        db.session.commit()
+
+
+def record_email_failure(email_id, error, retry_at):
+    """records why an email couldn't be sent
+        - it is tried again after retry_at, or marked as failed if retry_at is None
+    """
+    values = {'last_error': error}
+    if retry_at is None:
+        values['status'] = 'failed'
+    else:
+        values['send_after'] = retry_at
+    db.session.execute(update(OutboundEmail).where(OutboundEmail.id == email_id).values(values))
+    db.session.commit()
+
+
+def create_broadcast(broadcast):
+    """Add a new NewsletterBroadcast, its emails are queued in the background by the mail queue job"""
+    db.session.add(broadcast)
+    db.session.commit()
+
+
+def get_unfinished_broadcast_ids():
+    """returns the ids of the newsletter broadcasts that haven't been queued for every subscriber yet, oldest first"""
+    return db.session.execute(
+        select(NewsletterBroadcast.id).where(NewsletterBroadcast.finished.is_(None)).order_by(NewsletterBroadcast.id)
+    ).scalars().all()
+
+
+def count_waiting_broadcast_emails(broadcast_id):
+    """returns how many emails of a newsletter broadcast are queued and waiting to be sent"""
+    return db.session.execute(
+        select(func.count()).select_from(OutboundEmail)
+        .where(OutboundEmail.broadcast == broadcast_id, OutboundEmail.status == 'queued')
+    ).scalar_one()
+
+
+def queue_broadcast_batch(broadcast_id, batch_size):
+    """queues a newsletter broadcast for the next batch_size subscribers after its checkpoint
+        - subscribers are read in id order starting after the checkpoint (keyset pagination),
+          so only one batch of users is loaded at a time however many subscribers there are
+        - the emails and the new checkpoint are saved in the same transaction
+        - the broadcast is finished once there are no subscribers left
+        - returns the number of emails queued
+    """
+    # locked so 2 mail workers don't queue the same batch
+    broadcast = db.session.get(NewsletterBroadcast, broadcast_id, with_for_update=True, populate_existing=True)
+    if broadcast.finished is not None:
+        db.session.commit()
+        return 0
+    subscribers = db.session.execute(
+        select(User.id, User.email, User.first_name)
+        .where(User.newsletter == true(), User.role != 'off', User.id > broadcast.last_user_id)
+        .order_by(User.id)
+        .limit(batch_size)
+    ).all()
+    now = datetime.now()
+    if subscribers:
+        db.session.execute(insert(OutboundEmail), [
+            {'recipient': subscriber.email, 'subject': broadcast.subject,
+             'body': broadcast.render(subscriber.first_name), 'status': 'queued', 'attempts': 0,
+             'created': now, 'send_after': now, 'broadcast': broadcast.id}
+            for subscriber in subscribers
+        ])
+        broadcast.last_user_id = subscribers[-1].id
+        broadcast.queued += len(subscribers)
+    if len(subscribers) < batch_size:
+        broadcast.finished = now
+    db.session.commit()
+    return len(subscribers)
+
+
+def rebuild_conversations():
+    """rebuilds the conversation table from the message table in one INSERT ... SELECT
+        - messages sent before the rebuild are counted as read
+        - returns the number of conversations
+    """
+    ranked = select(
+        Message,
+        func.row_number().over(partition_by=(Message.user_low, Message.user_high),
+                               order_by=(Message.timestamp.desc(), Message.id.desc())).label('position')
+    ).subquery()
+    latest = aliased(Message, ranked)
+
+    db.session.execute(delete(Conversation))
+    result = db.session.execute(
+        insert(Conversation).from_select(
+            ['user_low', 'user_high', 'last_message_id', 'last_sender', 'last_timestamp', 'last_preview',
+             'unread_low', 'unread_high'],
+            select(latest.user_low, latest.user_high, latest.id, latest.sender, latest.timestamp,
+                   func.substr(latest.contents, 1, PREVIEW_LENGTH), 0, 0).where(ranked.c.position == 1)
+        )
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def _between(user1_id, user2_id):
+    """returns the filter for messages sent either way between 2 users, served by ix_message_conversation"""
+    user_low, user_high = Conversation.pair(user1_id, user2_id)
+    return and_(Message.user_low == user_low, Message.user_high == user_high)
+
+
 def get_latest_message(user1_id, user2_id):
     """return message object most recently send between 2 users"""
     return Message.query.filter(
-        or_(
-            and_(Message.sender == user1_id, Message.receiver == user2_id),
-            and_(Message.sender == user2_id, Message.receiver == user1_id),
-        )
-    ).order_by(Message.timestamp.desc()).first()
+        _between(user1_id, user2_id)
+    ).order_by(Message.timestamp.desc(), Message.id.desc()).first()
+
 
 def get_message_history(user1_id, user2_id):
     """return all messages sent to between 2 users"""
     return Message.query.filter(
-        or_(
-            and_(Message.sender == user1_id, Message.receiver == user2_id),
-            and_(Message.sender == user2_id, Message.receiver == user1_id),
+        _between(user1_id, user2_id)
+    ).order_by(Message.timestamp, Message.id).all()
+
+
+def get_message_page(user1_id, user2_id, before=None, before_id=None, limit=CHAT_PAGE_SIZE):
+    """return the limit messages sent between 2 users just before the message with timestamp before
+        and id before_id (or the latest limit messages if before isn't given), oldest first
+        - seeks straight to the page through ix_message_conversation, so older pages cost the same as the first
+    """
+    query = Message.query.filter(_between(user1_id, user2_id))
+    if before is not None:
+        query = query.filter(
+            or_(Message.timestamp < before, and_(Message.timestamp == before, Message.id < before_id))
         )
-    ).order_by(Message.timestamp).all()
+    page = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit).all()
+    page.reverse()
+    return page
+
+
+def get_messages_since(user1_id, user2_id, since, after_id=None, limit=MESSAGE_POLL_LIMIT):
+    """return at most limit messages sent between 2 users after the since timestamp, oldest first
+        - used by the chat poller so each poll only fetches what the client hasn't seen yet
+        - after_id is the id of the last message seen at the since timestamp, so messages sent
+          at the same time as it aren't skipped
+    """
+    if after_id is None:
+        newer = Message.timestamp > since
+    else:
+        newer = or_(Message.timestamp > since, and_(Message.timestamp == since, Message.id > after_id))
+    return Message.query.filter(
+        _between(user1_id, user2_id), newer
+    ).order_by(Message.timestamp, Message.id).limit(limit).all()
 
 
 def delete_user(user):
-    """removes user object's row in User table"""
+    """removes user object's row in User table, their adverts are removed with them,
+        taken off the advert map clusters and search index and the cached advert pages made out of date,
+        and the copy of the user cached by the user loader is dropped
+    """
+    _adverts_unlisted(Advert.query.filter_by(owner=user.id, available=True).all())
     db.session.delete(user)
     db.session.commit()
+    user_cache.invalidate(user.id)
+    fragment_cache.bump(ADVERTS_CACHE)
 
 
 def delete_advert(advert):
-    """removes advert object's row in Advert table"""
+    """removes advert object's row in Advert table, takes it off the advert map clusters and search index
+        and makes the cached advert pages out of date
+    """
+    if advert.available:
+        _adverts_unlisted([advert])
     db.session.delete(advert)
     db.session.commit()
+    fragment_cache.bump(ADVERTS_CACHE)
 
 
 def delete_message(message):
-    """removes message object's row in Message table"""
+    """removes message object's row in Message table
+        and updates the conversation summary to the latest remaining message
+    """
+    sender, receiver = message.sender, message.receiver
     db.session.delete(message)
+    conversation = db.session.get(Conversation, Conversation.pair(sender, receiver), with_for_update=True)
+    if conversation is not None:
+        latest = get_latest_message(sender, receiver)
+        if latest is None:
+            db.session.delete(conversation)
+        else:
+            conversation.set_last_message(latest)
     db.session.commit()
 
 
@@ -0,0 +1,275 @@
+"""
+This python file contains the mailer that sends the emails queued in the outbound_email table.
+
+Views don't talk to the mail server. They queue an email with datalink.queue_email, which only saves a row, so a
+slow or unreachable mail server never slows a request down or makes it fail. The mail queue job (see scheduler.py)
+calls Mailer.send_queued every MAIL_QUEUE_INTERVAL seconds, which claims the emails that are due and sends them from
+a pool of MAIL_WORKERS threads, at no more than MAIL_RATE_LIMIT emails a second. An email that can't be sent is tried
+again later, waiting twice as long after each failed attempt, until it has been tried MAIL_MAX_ATTEMPTS times.
+
+Connections to the mail server are kept open in an SMTPPool and reused for the next emails, so a batch doesn't pay
+for connecting, TLS and logging in for every email. A connection that has been idle is checked with NOOP before it is
+reused, one that fails is replaced, and each is closed after MAIL_POOL_MAX_MESSAGES emails or MAIL_POOL_IDLE_TIMEOUT
+idle seconds.
+
+The mail server is set with the MAIL_SERVER, MAIL_PORT, MAIL_USE_TLS, MAIL_USERNAME and MAIL_PASSWORD settings.
+During development a local debugging server can stand in for it, e.g. MAIL_SERVER=localhost, MAIL_PORT=1025,
+MAIL_USE_TLS=False and no MAIL_USERNAME, with: python -m aiosmtpd -n -l localhost:1025
+"""
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+# seconds a pooled connection can be idle before it is checked with NOOP when it is reused
+NOOP_AFTER_IDLE = 5
+
+
+class PooledConnection:
+    """Connection to the mail server kept by an SMTPPool, with how many emails it has sent and when it was last used"""
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.messages = 0
+        self.last_used = time.monotonic()
+
+    def is_alive(self):
+        """returns if the mail server still answers on the connection"""
+        try:
+            return self.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self):
+        """closes the connection, politely if the mail server is still there"""
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+
+
+class SMTPPool:
+    """Pool of logged in connections to the mail server, shared by the threads sending emails.
+    connect is called to open a new smtplib.SMTP connection when no idle connection can be reused."""
+
+    def __init__(self, connect, size=4, max_messages=100, idle_timeout=60):
+        self.connect = connect
+        self.size = size
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # most recently used last, so the connections used least are the ones left to time out
+        self._idle = []
+
+    def acquire(self):
+        """returns a connection for sending emails, reusing an idle one if it is still alive
+
+            Returns:
+                PooledConnection: the connection, give it back with release
+        """
+        while True:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                return PooledConnection(self.connect())
+            idle = time.monotonic() - connection.last_used
+            if idle < self.idle_timeout and (idle < NOOP_AFTER_IDLE or connection.is_alive()):
+                return connection
+            connection.close()
+
+    def release(self, connection, broken=False):
+        """gives a connection back to the pool, closing it if it is broken, has sent max_messages emails or the pool
+        is full"""
+        connection.last_used = time.monotonic()
+        if not broken and connection.messages < self.max_messages:
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append(connection)
+                    return
+        connection.close()
+
+    def close_idle(self, older_than=None):
+        """closes the idle connections that haven't been used for older_than seconds (idle_timeout by default),
+        pass 0 to close them all"""
+        older_than = self.idle_timeout if older_than is None else older_than
+        now = time.monotonic()
+        with self._lock:
+            expired = [connection for connection in self._idle if now - connection.last_used >= older_than]
+            self._idle = [connection for connection in self._idle if now - connection.last_used < older_than]
+        for connection in expired:
+            connection.close()
+
+
+class Mailer:
+    """Flask extension that sends the queued emails through the mail server set in the app config"""
+
+    def __init__(self, app=None):
+        self.server = 'localhost'
+        self.port = 25
+        self.use_tls = False
+        self.username = None
+        self.password = None
+        self.from_address = None
+        self.timeout = 10
+        self.workers = 4
+        self.batch_size = 50
+        self.max_attempts = 6
+        self.retry_delay = 60
+        self.rate_limit = 0
+        self.newsletter_batch_size = 500
+        self.connections = SMTPPool(self.connect)
+        self._next_send = 0.0
+        self._rate_lock = threading.Lock()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """reads the mail server and queue settings from the app config"""
+        self.server = app.config['MAIL_SERVER']
+        self.port = app.config['MAIL_PORT']
+        self.use_tls = app.config['MAIL_USE_TLS']
+        self.username = app.config['MAIL_USERNAME']
+        self.password = app.config['MAIL_PASSWORD']
+        self.from_address = app.config['MAIL_FROM']
+        self.timeout = app.config['MAIL_TIMEOUT']
+        self.workers = app.config['MAIL_WORKERS']
+        self.batch_size = app.config['MAIL_BATCH_SIZE']
+        self.max_attempts = app.config['MAIL_MAX_ATTEMPTS']
+        self.retry_delay = app.config['MAIL_RETRY_DELAY']
+        self.rate_limit = app.config['MAIL_RATE_LIMIT']
+        self.newsletter_batch_size = app.config['NEWSLETTER_BATCH_SIZE']
+        self.connections = SMTPPool(self.connect, app.config['MAIL_WORKERS'], app.config['MAIL_POOL_MAX_MESSAGES'],
+                                    app.config['MAIL_POOL_IDLE_TIMEOUT'])
+
+    def build_message(self, recipient, subject, body):
+        """Function that returns the email to send to recipient
+
+        Returns:
+            MIMEMultipart: the email, with a plain text body
+        """
+        msg = MIMEMultipart()
+        msg['From'] = self.from_address
+        msg['To'] = recipient
+        msg['Subject'] = subject
+        msg.attach(MIMEText(body, 'plain'))
+        return msg
+
+    def connect(self):
+        """opens a connection to the mail server, logged in if there is a MAIL_USERNAME"""
+        connection = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                connection.starttls()
+            if self.username:
+                connection.login(self.username, self.password)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    def send(self, msg):
+        """sends an email through a pooled connection, raising an exception if the mail server doesn't accept it.
+        If a reused connection turns out to have been closed by the mail server, it is sent again on a new one."""
+        for retry in (True, False):
+            connection = self.connections.acquire()
+            reused = connection.messages > 0
+            try:
+                connection.smtp.send_message(msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                self.connections.release(connection, broken=True)
+                if not (retry and reused):
+                    raise
+            except smtplib.SMTPResponseException as error:
+                # the server refused the email, the connection can still be used if it answered normally
+                self.connections.release(connection, broken=error.smtp_code == 421)
+                raise
+            except smtplib.SMTPRecipientsRefused:
+                self.connections.release(connection)
+                raise
+            except Exception:
+                self.connections.release(connection, broken=True)
+                raise
+            else:
+                connection.messages += 1
+                self.connections.release(connection)
+                return
+
+    def _wait_turn(self):
+        """waits until another email can be sent without going over MAIL_RATE_LIMIT emails a second"""
+        if not self.rate_limit:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            turn = max(now, self._next_send)
+            self._next_send = turn + 1 / self.rate_limit
+        time.sleep(turn - now)
+
+    def _send_row(self, row):
+        """sends a claimed email, returns None if it was sent or the error if it wasn't"""
+        self._wait_turn()
+        try:
+            self.send(self.build_message(row.recipient, row.subject, row.body))
+        except Exception as error:
+            return f"{type(error).__name__}: {error}"[:200]
+        return None
+
+    def _get_pool(self):
+        """returns the pool of threads sending the emails, started the first time it is needed"""
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='mailer')
+            return self._pool
+
+    def send_queued(self):
+        """Function that sends the queued emails that are due, a batch at a time until none are left.
+        Runs in an app context, the database is only used from this thread and the pool only talks to the mail server.
+
+        Returns:
+            int: the number of emails sent
+        """
+        import datalink
+        sent = 0
+        while True:
+            # the emails stay claimed for as long as the batch could take (each email waits at most MAIL_TIMEOUT
+            # for connecting, TLS, logging in and sending), after which they are tried again
+            lease = self.timeout * 4 * (self.batch_size // self.workers + 1)
+            rows = datalink.claim_emails(self.batch_size, lease)
+            errors = list(self._get_pool().map(self._send_row, rows))
+            now = datetime.now()
+            done = [row.id for row, error in zip(rows, errors) if error is None]
+            datalink.record_emails_sent(done, now)
+            for row, error in zip(rows, errors):
+                if error is not None:
+                    attempts = row.attempts + 1
+                    retry_at = None
+                    if attempts < self.max_attempts:
+                        retry_at = now + timedelta(seconds=self.retry_delay * 2 ** (attempts - 1))
+                    datalink.record_email_failure(row.id, error, retry_at)
+            sent += len(done)
+            # stop when the queue is empty, or when nothing could be sent as the mail server is probably down
+            if len(rows) < self.batch_size or not done:
+                self.connections.close_idle()
+                return sent
+
+    def run(self):
+        """Function that sends the queued emails, topping the queue up with the next batches of the newsletter
+        broadcasts (see email_folder/newsletter.py) until they have all been queued or nothing more can be sent.
+        Called by the mail queue job.
+
+        Returns:
+            int: the number of emails sent
+        """
+        import datalink
+        from email_folder.newsletter import queue_broadcasts
+        sent = 0
+        while True:
+            queue_broadcasts(self.newsletter_batch_size)
+            sent_now = self.send_queued()
+            sent += sent_now
+            if not sent_now or not datalink.get_unfinished_broadcast_ids():
+                return sent
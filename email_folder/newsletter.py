@@ -0,0 +1,27 @@
+"""
+This python file contains the newsletter broadcasts, which send a newsletter to every subscribed user.
+
+A broadcast is created with 'flask --app app send-newsletter' (see commands.py) and sent by the mail queue job.
+Instead of queueing an email for every subscriber at once, which would load every user and leave other emails (e.g.
+welcome emails) waiting behind the whole newsletter, queue_broadcasts tops up the mail queue a batch of
+NEWSLETTER_BATCH_SIZE subscribers at a time whenever less than a batch of the broadcast is still waiting to be sent.
+The emails are then sent like any other queued email, through the pooled connections of the mailer at no more than
+MAIL_RATE_LIMIT emails a second.
+
+Each batch saves the broadcast's checkpoint (the id of the last subscriber queued), so a broadcast interrupted by a
+restart carries on where it stopped.
+"""
+
+
+def queue_broadcasts(batch_size):
+    """Function that queues the next batch of each unfinished broadcast that has less than a batch waiting to be sent
+
+    Returns:
+        int: the number of emails queued
+    """
+    import datalink
+    queued = 0
+    for broadcast_id in datalink.get_unfinished_broadcast_ids():
+        if datalink.count_waiting_broadcast_emails(broadcast_id) < batch_size:
+            queued += datalink.queue_broadcast_batch(broadcast_id, batch_size)
+    return queued
@@ -0,0 +1,137 @@
+"""
+This python file contains the geographic helpers used to find adverts near a location.
+
+Adverts store the geohash of their location. A geohash is a string where each character narrows the location down to a
+smaller cell of a grid, so every advert inside a cell has a geohash starting with the cell's geohash. Searching an
+area therefore becomes a few range scans of the geohash index (one per cell covering the area), after which the exact
+distances are checked with the haversine formula.
+
+The file includes:
+- encode_geohash: Returns the geohash of a location.
+- bounding_box: Returns the box of latitudes and longitudes around a location that contains a circle of a radius.
+- geohash_ranges: Returns the ranges of geohashes covering a bounding box.
+- haversine_km: Returns the distance between 2 locations.
+"""
+from math import radians, degrees, sin, cos, asin, sqrt
+
+# characters of a geohash, in the order of the cells they stand for
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+# number of characters stored for each advert, a cell of about 5m by 5m
+GEOHASH_PRECISION = 9
+EARTH_RADIUS_KM = 6371.0
+
+
+def encode_geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    """Function that returns the geohash of a location
+
+    Returns:
+        str: the geohash with precision characters
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    # bits alternate between halving the longitude and the latitude range, starting with the longitude
+    use_longitude = True
+    while len(geohash) < precision:
+        value_range, value = (lon_range, longitude) if use_longitude else (lat_range, latitude)
+        middle = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        use_longitude = not use_longitude
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(geohash)
+
+
+def cell_size(precision):
+    """Function that returns the size of the cells of geohashes with precision characters
+
+    Returns:
+        tuple: the height of a cell in degrees of latitude and its width in degrees of longitude
+    """
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """Function that returns the smallest box of latitudes and longitudes containing every point within radius_km
+    of a location
+
+    Returns:
+        tuple: the minimum latitude, minimum longitude, maximum latitude and maximum longitude
+    """
+    lat_delta = degrees(radius_km / EARTH_RADIUS_KM)
+    min_lat, max_lat = max(latitude - lat_delta, -90.0), min(latitude + lat_delta, 90.0)
+    # a degree of longitude gets shorter away from the equator
+    if max(abs(min_lat), abs(max_lat)) >= 90.0:
+        return min_lat, -180.0, max_lat, 180.0
+    lon_delta = degrees(asin(min(sin(radius_km / EARTH_RADIUS_KM) / cos(radians(latitude)), 1.0)))
+    return min_lat, max(longitude - lon_delta, -180.0), max_lat, min(longitude + lon_delta, 180.0)
+
+
+def _next_geohash(geohash):
+    """returns the first geohash after every geohash starting with geohash, or None if there is none"""
+    for position in range(len(geohash) - 1, -1, -1):
+        index = GEOHASH_ALPHABET.index(geohash[position])
+        if index < len(GEOHASH_ALPHABET) - 1:
+            return geohash[:position] + GEOHASH_ALPHABET[index + 1]
+    return None
+
+
+def geohash_ranges(min_lat, min_lon, max_lat, max_lon, max_cells=16, max_precision=GEOHASH_PRECISION):
+    """Function that returns ranges of geohashes that together cover a bounding box, using the smallest cells (of at
+    most max_precision characters) that need at most max_cells cells. Ranges of neighbouring cells are joined together.
+
+    Returns:
+        list: (first, after) pairs where a geohash g is in the range if first <= g < after, after is None if the range
+        runs to the end
+    """
+    precision = max_precision
+    while precision > 1:
+        height, width = cell_size(precision)
+        rows = int((max_lat + 90.0) // height) - int((min_lat + 90.0) // height) + 1
+        columns = int((max_lon + 180.0) // width) - int((min_lon + 180.0) // width) + 1
+        if rows * columns <= max_cells:
+            break
+        precision -= 1
+    height, width = cell_size(precision)
+
+    # find the geohash of the middle of every cell the box touches
+    cells = set()
+    first_row = int((min_lat + 90.0) // height)
+    first_column = int((min_lon + 180.0) // width)
+    for row in range(first_row, int((max_lat + 90.0) // height) + 1):
+        for column in range(first_column, int((max_lon + 180.0) // width) + 1):
+            latitude = min((row + 0.5) * height - 90.0, 90.0)
+            longitude = min((column + 0.5) * width - 180.0, 180.0)
+            cells.add(encode_geohash(latitude, longitude, precision))
+
+    ranges = []
+    for cell in sorted(cells):
+        after = _next_geohash(cell)
+        if ranges and ranges[-1][1] == cell:
+            ranges[-1] = (ranges[-1][0], after)
+        else:
+            ranges.append((cell, after))
+    return ranges
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Function that returns the distance between 2 locations along the surface of the earth
+
+    Returns:
+        float: the distance in kilometres
+    """
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(sqrt(a))
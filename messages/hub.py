@@ -0,0 +1,187 @@
+"""
+This python file contains the message hub used to wake chat clients that are waiting for new messages.
+
+The hub keeps a version counter for every conversation. datalink.create_message publishes to the hub after a message
+is saved, which bumps the version of that conversation and wakes the requests waiting on it, so a waiting chat page
+costs nothing until a message for its conversation actually arrives.
+
+The hub includes the following backends:
+- InProcessBackend: wakes waiters in this process only, for when the app runs as a single worker.
+- RedisBackend: fans messages out to every worker through a Redis pub/sub channel.
+- PostgresBackend: fans messages out to every worker through Postgres LISTEN/NOTIFY.
+
+The backend is chosen with the MESSAGE_HUB setting: 'memory' (default), a redis:// url or 'postgres'.
+"""
+import select
+import threading
+import time
+
+# channel used by the Redis and Postgres backends to tell every worker a conversation has new messages
+HUB_CHANNEL = 'feedforward_chat'
+
+
+def conversation_key(user1_id, user2_id):
+    """returns the key of the conversation between 2 users, which is the same whoever sent the message"""
+    return f"{min(user1_id, user2_id)}:{max(user1_id, user2_id)}"
+
+
+class InProcessBackend:
+    """Backend that keeps the conversation versions in memory and wakes waiting threads of this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        # one condition per conversation being waited on, so a message only wakes the clients of its conversation
+        self._conditions = {}
+        self._waiters = {}
+
+    def version(self, key):
+        """returns the current version of a conversation"""
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def publish(self, key):
+        """tells the hub a conversation has a new message"""
+        self.notify(key)
+
+    def notify(self, key):
+        """bumps the version of a conversation and wakes the threads waiting on it"""
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            condition = self._conditions.get(key)
+            if condition:
+                condition.notify_all()
+
+    def wait(self, key, version, timeout):
+        """blocks until the version of a conversation is no longer version or timeout seconds have passed
+
+            Returns:
+                bool: True if the conversation has changed, False if the wait timed out
+        """
+        with self._lock:
+            condition = self._conditions.setdefault(key, threading.Condition(self._lock))
+            self._waiters[key] = self._waiters.get(key, 0) + 1
+            try:
+                return condition.wait_for(lambda: self._versions.get(key, 0) != version, timeout)
+            finally:
+                # forget the condition once nobody is waiting on the conversation
+                self._waiters[key] -= 1
+                if not self._waiters[key]:
+                    del self._waiters[key]
+                    del self._conditions[key]
+
+
+class RedisBackend(InProcessBackend):
+    """Backend that publishes to a Redis channel, every worker listens to the channel and wakes its own waiters"""
+
+    def __init__(self, url):
+        super().__init__()
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._error = redis.RedisError
+        threading.Thread(target=self._listen, name='message-hub-redis', daemon=True).start()
+
+    def publish(self, key):
+        """tells every worker a conversation has a new message"""
+        try:
+            self._redis.publish(HUB_CHANNEL, key)
+        except self._error:
+            # the message is already saved, waiters will pick it up when their wait times out
+            pass
+
+    def _listen(self):
+        """wakes the waiters of this worker for every key published on the channel"""
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(HUB_CHANNEL)
+                for message in pubsub.listen():
+                    self.notify(message['data'].decode())
+            except self._error:
+                # waiters fall back to their timeout while Redis is unavailable, so just reconnect
+                time.sleep(1)
+
+
+class PostgresBackend(InProcessBackend):
+    """Backend that sends a NOTIFY to the database, every worker LISTENs and wakes its own waiters"""
+
+    def __init__(self, dsn):
+        super().__init__()
+        import psycopg2
+        self._psycopg2 = psycopg2
+        self._dsn = dsn
+        self._publish_lock = threading.Lock()
+        self._connection = None
+        threading.Thread(target=self._listen, name='message-hub-postgres', daemon=True).start()
+
+    def _connect(self):
+        connection = self._psycopg2.connect(self._dsn)
+        connection.autocommit = True
+        return connection
+
+    def publish(self, key):
+        """tells every worker a conversation has a new message"""
+        with self._publish_lock:
+            try:
+                if self._connection is None or self._connection.closed:
+                    self._connection = self._connect()
+                with self._connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_notify(%s, %s)", (HUB_CHANNEL, key))
+            except self._psycopg2.Error:
+                # the message is already saved, waiters will pick it up when their wait times out
+                self._connection = None
+
+    def _listen(self):
+        """wakes the waiters of this worker for every notification sent on the channel"""
+        while True:
+            try:
+                connection = self._connect()
+                with connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {HUB_CHANNEL}")
+                while True:
+                    if select.select([connection], [], [], 60) != ([], [], []):
+                        connection.poll()
+                        while connection.notifies:
+                            self.notify(connection.notifies.pop(0).payload)
+            except self._psycopg2.Error:
+                time.sleep(1)
+
+
+class MessageHub:
+    """Flask extension that publishes new messages and lets requests wait for them.
+    The backend is set up from the app config by init_app, before that it works in process."""
+
+    def __init__(self, app=None):
+        self.backend = InProcessBackend()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """creates the backend named by the MESSAGE_HUB setting"""
+        setting = app.config.get('MESSAGE_HUB') or 'memory'
+        if setting == 'memory':
+            self.backend = InProcessBackend()
+        elif setting.startswith(('redis://', 'rediss://', 'unix://')):
+            self.backend = RedisBackend(setting)
+        elif setting == 'postgres':
+            # psycopg2 doesn't understand the driver part of an SQLAlchemy url
+            dsn = app.config['SQLALCHEMY_DATABASE_URI'].replace('+psycopg2', '')
+            self.backend = PostgresBackend(dsn)
+        else:
+            raise ValueError(f"Unknown message hub backend {setting}")
+
+    def version(self, user1_id, user2_id):
+        """returns the current version of the conversation between 2 users"""
+        return self.backend.version(conversation_key(user1_id, user2_id))
+
+    def publish(self, user1_id, user2_id):
+        """wakes the requests waiting on the conversation between 2 users"""
+        self.backend.publish(conversation_key(user1_id, user2_id))
+
+    def wait(self, user1_id, user2_id, version, timeout):
+        """waits until the conversation between 2 users is past version, or until the timeout
+
+            Returns:
+                bool: True if there may be new messages, False if the wait timed out
+        """
+        return self.backend.wait(conversation_key(user1_id, user2_id), version, timeout)
@@ -1,9 +1,11 @@
 from datetime import datetime
 
-from flask import Blueprint, render_template, jsonify, session, request
+from flask import Blueprint, render_template, jsonify, session, request, abort
 from flask_login import current_user, login_required
 
 import datalink
+from app import app, db
+from extensions import message_hub
 from messages.forms import MessageForm
 from models import Message
 
@@ -16,6 +18,7 @@ def view_messages():
     """Function that provides the functionality of the messages page form.
         Allows user to view all users they have a conversation with and their most recent message
         Clicking on any of these conversations will redirect to the appropriate chat page
+        Conversations are shown a page at a time, chosen with the 'page' query argument
         Requires user to be logged in
         Created by Rebecca
 
@@ -23,41 +26,39 @@ def view_messages():
             flask.Response: returns the messages.html template with appropriate conversation
             data passed
         """
-    # get users messaging current user
-    users = datalink.get_conversations(current_user.id)
-    # get most recent messages to or from each user
-    recent_messages = {u: datalink.get_latest_message(current_user.id, u.id)
-                       for u in users}
-    time_messages = {}
-    if recent_messages:
-        # sort so most recent messages at top
-        recent_messages = dict(sorted(recent_messages.items(),
-                                      key=lambda x: x[1].timestamp, reverse=True))
-
-        for u in users:
-            # find how long ago most recent message was sent
-            message = recent_messages[u]
-            time_diff = datetime.now() - message.timestamp
-            # get how long ago message sent in mins
-            time_diff = time_diff.total_seconds() // 60
-            # find appropriate message in mins, hours or days and add to dict
-            time_msg = ""
-            if time_diff < 1:
-                time_msg = "sent just now"
-            elif time_diff > 60:  # > 1 hour
-                time_diff //= 60
-                if time_diff > 24:  # > 1 day
-                    time_diff //= 24
-                    time_msg = f"sent {int(time_diff)} day(s) ago"
-                else:
-                    time_msg = f"sent {int(time_diff)} hours(s) ago"
-            else:
-                time_msg = f"sent {int(time_diff)} min(s) ago"
-
-            time_messages.update({u: time_msg})
+    page = max(request.args.get('page', 1, type=int), 1)
+    # get users messaging current user with the most recent message to or from each user,
+    # already sorted so most recent messages at top, fetching one extra to know if there is a next page
+    inbox = datalink.get_inbox(current_user.id, limit=datalink.INBOX_PAGE_SIZE + 1,
+                               offset=(page - 1) * datalink.INBOX_PAGE_SIZE)
+    has_next = len(inbox) > datalink.INBOX_PAGE_SIZE
+    recent_messages = dict(inbox[:datalink.INBOX_PAGE_SIZE])
+    # find how long ago most recent message was sent for each user
+    time_messages = {u: time_since(conversation.last_timestamp) for u, conversation in recent_messages.items()}
     return render_template('messages/messages.html',
                            recent_messages=recent_messages, time_messages=time_messages,
-                           current_page='view_messages')
+                           page=page, has_next=has_next, current_page='view_messages')
+
+
+def time_since(timestamp):
+    """Function that describes how long ago a message was sent
+
+        Returns:
+            str: how long ago the message was sent in mins, hours or days
+        """
+    time_diff = datetime.now() - timestamp
+    # get how long ago message sent in mins
+    time_diff = time_diff.total_seconds() // 60
+    # find appropriate message in mins, hours or days
+    if time_diff < 1:
+        return "sent just now"
+    if time_diff > 60:  # > 1 hour
+        time_diff //= 60
+        if time_diff > 24:  # > 1 day
+            time_diff //= 24
+            return f"sent {int(time_diff)} day(s) ago"
+        return f"sent {int(time_diff)} hours(s) ago"
+    return f"sent {int(time_diff)} min(s) ago"
 
 
 @messages_blueprint.route('/<int:messenger_id>/chat', methods=['GET', 'POST'])
@@ -66,6 +67,8 @@ def chat(messenger_id):
     """Function that provides the functionality of the chat page form.
             Allows user to view all messages they have with another user with id 'messanger_id' and
                 send a new one
+            Only the latest messages are shown at first, older ones are fetched from chat_history
+                when the user scrolls up
             Requires user to be logged in
             Created by Rebecca
 
@@ -81,25 +84,106 @@ def chat(messenger_id):
         datalink.create_message(new_msg)
         return jsonify(new_message=form.contents.data)
 
-    # show conversation
-    messages = datalink.get_message_history(current_user.id, messenger_id)
+    # show the latest messages of the conversation, fetching one extra to know if there are older ones
+    messages = datalink.get_message_page(current_user.id, messenger_id, limit=datalink.CHAT_PAGE_SIZE + 1)
+    has_older = len(messages) > datalink.CHAT_PAGE_SIZE
+    messages = messages[-datalink.CHAT_PAGE_SIZE:]
+    # read the name before marking the conversation read, as the commit expires the loaded user
     user = datalink.get_user_from_id(messenger_id)
     name = user.first_name
-    return render_template('messages/chat.html', form=form, conversation=messages, name=name)
+    datalink.mark_conversation_read(current_user.id, messenger_id)
+    return render_template('messages/chat.html', form=form, conversation=messages, name=name,
+                           has_older=has_older)
 
 
-@messages_blueprint.route('/update_chat', methods=['POST'])
+@messages_blueprint.route('/<int:messenger_id>/chat_history')
 @login_required
-def update_chat():
-    """Function that provides server side functionality to live updating messages with JS ajax
-            uses session data to find the 2 communicating users and new messages between them
+def chat_history(messenger_id):
+    """Function that provides the older messages of a chat when the user scrolls up the chat page
+            'before' and 'before_id' are the timestamp and id of the oldest message the page shows
 
-            NOTE: Not currently in use
+            Returns:
+                flask.Response: json storing the page of messages just before it, oldest first, under key
+                                'messages' and whether there are even older ones under key 'has_older'
+            """
+    before = request.args.get('before')
+    before_id = request.args.get('before_id', type=int)
+    if not before or before_id is None:
+        abort(400)
+    messages = datalink.get_message_page(current_user.id, messenger_id, parse_since(before), before_id,
+                                         limit=datalink.CHAT_PAGE_SIZE + 1)
+    has_older = len(messages) > datalink.CHAT_PAGE_SIZE
+    messages = messages[-datalink.CHAT_PAGE_SIZE:]
+    return jsonify({'messages': [message_to_dict(msg) for msg in messages], 'has_older': has_older})
+
+
+@messages_blueprint.route('/wait_chat')
+@login_required
+def wait_chat():
+    """Function that pushes new messages to the chat page with long polling
+            the client sends the timestamp of the last message it has seen as 'since' (and its id as 'after'),
+            and only the (bounded number of) messages newer than it are returned. If there are none the request
+            waits on the message hub until one arrives or CHAT_LONG_POLL_TIMEOUT seconds pass, so an idle chat page
+            only makes a request every timeout instead of every second
 
             Returns:
-                flask.Response: json storing replacement html for list of messages in chat.html
-                                with key 'messages'
+                flask.Response: json storing the new messages under key 'messages' (possibly none if the wait
+                                timed out) and the timestamp and id to ask from next under keys 'since'
+                                and 'after'
             """
     messanger_id = session['messager']
-    messages = datalink.get_message_history(current_user.id, messanger_id)
-    return jsonify({'messages': render_template('update_message.html', conversation=messages)})
+    user_id = current_user.id
+    since = parse_since(request.args.get('since', ''))
+    after_id = request.args.get('after', type=int)
+
+    # read the version before checking the database so a message sent in between still wakes the wait
+    version = message_hub.version(user_id, messanger_id)
+    messages = datalink.get_messages_since(user_id, messanger_id, since, after_id)
+    if not messages:
+        # give the database connection back to the pool while waiting
+        db.session.close()
+        if message_hub.wait(user_id, messanger_id, version, app.config['CHAT_LONG_POLL_TIMEOUT']):
+            messages = datalink.get_messages_since(user_id, messanger_id, since, after_id)
+    return messages_response(messages, since, after_id)
+
+
+def parse_since(since):
+    """Function that reads the timestamp of the last message a chat page has seen
+        aborts with 400 if it isn't a valid timestamp
+
+        Returns:
+            datetime: the timestamp, or datetime.min if the chat page hasn't seen any messages yet
+        """
+    try:
+        return datetime.fromisoformat(since) if since else datetime.min
+    except ValueError:
+        abort(400)
+
+
+def messages_response(messages, since, after_id):
+    """Function that builds the response sent to the chat page for a list of new messages
+
+        Returns:
+            flask.Response: json storing the messages under key 'messages' and the timestamp and id of
+                            the newest message seen under keys 'since' and 'after'
+        """
+    if messages:
+        since, after_id = messages[-1].timestamp, messages[-1].id
+        # the chat page shows the new messages straight away, so they have been read
+        if any(msg.sender != current_user.id for msg in messages):
+            datalink.mark_conversation_read(current_user.id, session['messager'])
+    return jsonify({'messages': [message_to_dict(msg) for msg in messages],
+                    'since': since.isoformat() if since != datetime.min else '',
+                    'after': after_id})
+
+
+def message_to_dict(message):
+    """Function that converts a message into the compact form sent to the chat page
+
+        Returns:
+            dict: the message id and contents, whether the current user sent it and when it was sent
+        """
+    return {'id': message.id,
+            'contents': message.contents,
+            'outgoing': message.sender == current_user.id,
+            'timestamp': message.timestamp.isoformat()}
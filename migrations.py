@@ -0,0 +1,191 @@
+"""
+This python file contains the migrations that bring a database created by an older version of the app up to date.
+
+Each migration checks whether the database still needs it, so run_migrations can safely be run any number of times.
+New tables are created by db.create_all(), the migrations handle changes to the tables that already exist.
+
+Migrations:
+- message_surrogate_key: Rebuilds the message table with an id primary key and the conversation columns.
+- add_missing_columns: Adds nullable columns that were added to existing models.
+- fill_conversation_last_message: Sets the latest message id of conversation summaries created without it.
+- fill_advert_geohash: Sets the geohash of adverts created before adverts had one.
+- fill_advert_clusters: Builds the advert map clusters of a database created before they were kept.
+- create_advert_search: Creates and fills the SQLite search table of a database created before adverts were searchable.
+- create_missing_indexes: Creates the indexes of the models that are missing from existing tables.
+
+Run with: flask --app app migrate-db
+"""
+from sqlalchemy import inspect, text, case, select, insert, update, bindparam, MetaData, Table
+from sqlalchemy.schema import CreateColumn
+
+from app import db
+from geo import encode_geohash
+from models import Advert, AdvertCluster, Message, Conversation, ADVERT_FTS_SQL
+
+
+def _columns(connection, table_name):
+    """returns the names of the columns a table has in the database"""
+    return {column['name'] for column in inspect(connection).get_columns(table_name)}
+
+
+def message_surrogate_key():
+    """Rebuilds the message table, which used (senderID, receiverID, timestamp) as its primary key, with an id
+    primary key and the user_low/user_high conversation columns, copying every message across in timestamp order.
+
+    Returns:
+        bool: True if the table was rebuilt
+    """
+    with db.engine.begin() as connection:
+        if 'id' in _columns(connection, 'message'):
+            return False
+        connection.execute(text("ALTER TABLE message RENAME TO message_old"))
+        if connection.dialect.name == 'postgresql':
+            # the primary key index keeps its name, which the new table needs
+            connection.execute(text("ALTER INDEX message_pkey RENAME TO message_old_pkey"))
+        Message.__table__.create(connection)
+
+        old = Table('message_old', MetaData(), autoload_with=connection)
+        sender, receiver = old.c.senderID, old.c.receiverID
+        connection.execute(
+            insert(Message.__table__).from_select(
+                ['senderID', 'receiverID', 'user_low', 'user_high', 'timestamp', 'contents'],
+                select(sender, receiver,
+                       case((sender < receiver, sender), else_=receiver),
+                       case((sender < receiver, receiver), else_=sender),
+                       old.c.timestamp, old.c.contents).order_by(old.c.timestamp)
+            )
+        )
+        old.drop(connection)
+    return True
+
+
+def add_missing_columns():
+    """Adds the columns of the models that are missing from existing tables. Only nullable columns (or ones with a
+    server default) can be added this way, other changes need their own migration.
+
+    Returns:
+        bool: True if any column was added
+    """
+    added = False
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = _columns(connection, table.name)
+            for column in table.columns:
+                if column.name not in existing:
+                    column_sql = CreateColumn(column).compile(dialect=connection.dialect)
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column_sql}"))
+                    added = True
+    return added
+
+
+def fill_conversation_last_message():
+    """Sets last_message_id of conversation summaries built before messages had an id.
+
+    Returns:
+        bool: True if any summary was updated
+    """
+    last_message = select(Message.id).where(
+        Message.user_low == Conversation.user_low,
+        Message.user_high == Conversation.user_high,
+        Message.timestamp == Conversation.last_timestamp
+    ).order_by(Message.id.desc()).limit(1).scalar_subquery()
+    with db.engine.begin() as connection:
+        result = connection.execute(
+            update(Conversation.__table__).where(Conversation.last_message_id.is_(None)).values(
+                last_message_id=last_message
+            )
+        )
+    return result.rowcount > 0
+
+
+def fill_advert_geohash():
+    """Sets the geohash of adverts created before the geohash column was added.
+
+    Returns:
+        bool: True if any advert was updated
+    """
+    advert = Advert.__table__
+    with db.engine.begin() as connection:
+        rows = connection.execute(
+            select(advert.c.adID, advert.c.latitude, advert.c.longitude).where(advert.c.geohash.is_(None))
+        ).all()
+        if rows:
+            connection.execute(
+                update(advert).where(advert.c.adID == bindparam('ad_id')).values(geohash=bindparam('new_geohash')),
+                [{'ad_id': ad_id, 'new_geohash': encode_geohash(latitude, longitude)}
+                 for ad_id, latitude, longitude in rows]
+            )
+    return bool(rows)
+
+
+def fill_advert_clusters():
+    """Builds the advert map clusters when there are available adverts but no clusters yet.
+
+    Returns:
+        bool: True if the clusters were built
+    """
+    import datalink
+    if db.session.query(AdvertCluster.cell).first() is not None:
+        return False
+    if db.session.query(Advert.adID).filter(Advert.available).first() is None:
+        return False
+    datalink.rebuild_clusters()
+    return True
+
+
+def create_advert_search():
+    """Creates the SQLite full text search table of the available adverts and fills it. The Postgres search index
+    is created by create_missing_indexes instead.
+
+    Returns:
+        bool: True if the table was created
+    """
+    import datalink
+    with db.engine.begin() as connection:
+        if connection.dialect.name != 'sqlite' or inspect(connection).has_table('advert_fts'):
+            return False
+        connection.execute(text(ADVERT_FTS_SQL))
+    datalink.rebuild_search_index()
+    return True
+
+
+def create_missing_indexes():
+    """Creates the indexes of the models that are missing from existing tables. Indexes that only apply to some
+    databases (see Advert) are skipped by index.create on the others.
+
+    Returns:
+        bool: True if any index was created
+    """
+    created = False
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {index['name'] for index in inspect(connection).get_indexes(table.name)}
+            missing = [index for index in table.indexes if index.name not in existing]
+            for index in missing:
+                index.create(connection)
+            if missing:
+                now_existing = {index['name'] for index in inspect(connection).get_indexes(table.name)}
+                created = created or bool(now_existing - existing)
+    return created
+
+
+# migrations in the order they are run
+MIGRATIONS = [
+    message_surrogate_key,
+    add_missing_columns,
+    fill_conversation_last_message,
+    fill_advert_geohash,
+    fill_advert_clusters,
+    create_advert_search,
+    create_missing_indexes,
+]
+
+
+def run_migrations():
+    """Function that creates any new tables and runs every migration the database still needs.
+
+    Returns:
+        list: the names of the migrations that changed the database
+    """
+    db.create_all()
+    return [migration.__name__ for migration in MIGRATIONS if migration()]
@@ -1,10 +1,38 @@
 """python file that contains all the models for the project"""
+from dataclasses import dataclass
 from datetime import datetime
+from string import Template
 
 from flask_login import UserMixin
-import bcrypt
+from sqlalchemy import true, func, literal_column, table, column, event, DDL
+from sqlalchemy.orm import validates
 
 from app import db, app
+from extensions import password_hasher
+from geo import encode_geohash, GEOHASH_PRECISION
+
+# number of characters of the latest message shown in the messages inbox
+PREVIEW_LENGTH = 100
+# geohash lengths the advert map clusters are kept for, from the most to the least zoomed out
+CLUSTER_PRECISIONS = (2, 3, 4, 5, 6)
+
+
+def supports_partial_indexes(dialect):
+    """Returns if a database can create indexes of only the rows that match a condition"""
+    return dialect.name in ('postgresql', 'sqlite')
+
+
+def search_document(title, contents):
+    """Returns the Postgres text search document of an advert's title and contents, which the search index is built
+    on. Queries must use the same expression for Postgres to use the index."""
+    return func.to_tsvector(literal_column("'english'"), title + literal_column("' '") + contents)
+
+
+# SQLite full text search table holding the title and contents of the available adverts, with the advert id as its
+# rowid. It is created with the advert table and kept up to date by datalink.
+advert_fts = table('advert_fts', column('rowid'), column('title'), column('contents'))
+ADVERT_FTS_SQL = ("CREATE VIRTUAL TABLE IF NOT EXISTS advert_fts "
+                  "USING fts5(title, contents, tokenize='porter unicode61')")
 
 
 class User(db.Model, UserMixin):
@@ -24,21 +52,31 @@ class User(db.Model, UserMixin):
     phone = db.Column(db.String(11), nullable=False)
     newsletter = db.Column(db.Boolean, nullable=False)
 
-    adverts = db.relationship('Advert', cascade="all,delete")
+    # the users and admins sections of the admin dashboard
+    __table_args__ = (
+        db.Index('ix_user_role', 'role', 'id'),
+    )
+
+    adverts = db.relationship('Advert', back_populates='owner_user', cascade="all,delete")
     sent_messages = db.relationship('Message', foreign_keys='[Message.sender]',
                                     cascade="all,delete")
     received_messages = db.relationship('Message', foreign_keys='[Message.receiver]',
                                         cascade="all,delete")
-    collected_orders = db.relationship('Collection', foreign_keys='[Collection.buyer]',
+    collected_orders = db.relationship('Collection', foreign_keys='[Collection.buyer]', back_populates='buyer_user',
                                        cascade="all,delete")
-    sold_orders = db.relationship('Collection', foreign_keys='[Collection.seller]',
+    sold_orders = db.relationship('Collection', foreign_keys='[Collection.seller]', back_populates='seller_user',
                                   cascade="all,delete")
+    low_conversations = db.relationship('Conversation', foreign_keys='[Conversation.user_low]',
+                                        cascade="all,delete")
+    high_conversations = db.relationship('Conversation', foreign_keys='[Conversation.user_high]',
+                                         cascade="all,delete")
+    activity = db.relationship('UserActivity', cascade="all,delete")
 
     def __init__(self, email, password, first_name, surname, dob, address, phone,
                  role="user", newsletter=False):
         """Constructor for User class. Created by Alex"""
         self.email = email
-        self.password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        self.password = password_hasher.hash(password)
         self.first_name = first_name
         self.surname = surname
         self.dob = dob
@@ -110,10 +148,39 @@ class User(db.Model, UserMixin):
 
     def verify_password(self, plain_password):
         """Function to check submitted password matches with the database password
-        (compared after encrypting the submitted password). Created by Emmanouel"""
-        password_byte_enc = plain_password.encode('utf-8')
-        hashed_password = self.password.encode('utf-8')
-        return bcrypt.checkpw(password_byte_enc, hashed_password)
+        (compared after encrypting the submitted password). Created by Emmanouel
+        The check runs on the password hasher's pool, see passwords.py"""
+        return password_hasher.verify(plain_password, self.password)
+
+    def rehash_password(self, plain_password):
+        """Hashes the password again if it was hashed with a different cost than BCRYPT_ROUNDS, call after
+        verify_password succeeded and commit the change.
+        Returns True if the password was hashed again"""
+        if not password_hasher.needs_rehash(self.password):
+            return False
+        self.password = password_hasher.hash(plain_password)
+        return True
+
+    def snapshot(self):
+        """Returns a SessionUser copy of the user's details, kept by the user loader between requests"""
+        return SessionUser(self.id, self.email, self.first_name, self.surname, self.dob, self.address, self.phone,
+                           self.role, self.newsletter)
+
+
+@dataclass(frozen=True, eq=False)
+class SessionUser(UserMixin):
+    """Read only copy of a user's details (without their password), which is what current_user is on requests after
+    the user logged in, see load_user in app.py. It isn't attached to the database, so views that change the user
+    load the User object with datalink.get_user_from_id and save it with datalink.update_user."""
+    id: int
+    email: str
+    first_name: str
+    surname: str
+    dob: datetime
+    address: str
+    phone: str
+    role: str
+    newsletter: bool
 
 
 class Advert(db.Model):
@@ -131,6 +198,35 @@ class Advert(db.Model):
     owner = db.Column(db.ForeignKey(User.id), nullable=False)
     expiry = db.Column(db.DateTime, nullable=False)
     available = db.Column(db.Boolean, nullable=False)
+    # geohash of the location, kept in step with latitude and longitude, used to find adverts near a location
+    geohash = db.Column(db.String(GEOHASH_PRECISION), index=True)
+    # when the advert was posted and when it stopped being available, used by the daily statistics (see DailyStat).
+    # Adverts created before the statistics were kept have neither
+    created = db.Column(db.DateTime)
+    unlisted = db.Column(db.DateTime)
+
+    __table_args__ = (
+        # available adverts by expiry date, used to list adverts and by the expiry sweep: a partial index of just
+        # the available adverts where the database supports it, a composite index otherwise
+        db.Index('ix_advert_expiry_where_available', 'expiry',
+                 postgresql_where=available == true(), sqlite_where=available == true()
+                 ).ddl_if(callable_=lambda ddl, target, bind, **kw: supports_partial_indexes(kw['dialect'])),
+        db.Index('ix_advert_available_expiry', 'available', 'expiry'
+                 ).ddl_if(callable_=lambda ddl, target, bind, **kw: not supports_partial_indexes(kw['dialect'])),
+        # a user's adverts, available or not
+        db.Index('ix_advert_owner_available', 'owner', 'available'),
+        # full text search of the available adverts on Postgres, SQLite uses the advert_fts table instead
+        db.Index('ix_advert_search', search_document(title, contents), postgresql_using='gin',
+                 postgresql_where=available == true()).ddl_if(dialect='postgresql'),
+        # adverts posted and unlisted each day, recounted by the statistics reconcile job
+        db.Index('ix_advert_created', 'created'),
+        db.Index('ix_advert_unlisted', 'unlisted'),
+    )
+
+    # the user who posted the advert and the collection of it, if it has been collected. Pages that show them load
+    # them up front with datalink's loader options instead of one query per advert
+    owner_user = db.relationship('User', back_populates='adverts')
+    collections = db.relationship('Collection', back_populates='collected_advert', cascade="all,delete")
 
     def __init__(self, title, address, latitude, longitude, contents, owner,
                  expiry, available=True):
@@ -143,6 +239,16 @@ class Advert(db.Model):
         self.owner = owner
         self.expiry = expiry
         self.available = available
+        self.created = datetime.now()
+
+    @validates('latitude', 'longitude')
+    def validate_location(self, key, value):
+        """Keeps geohash in step with the latitude and longitude"""
+        latitude = value if key == 'latitude' else self.latitude
+        longitude = value if key == 'longitude' else self.longitude
+        if latitude is not None and longitude is not None:
+            self.geohash = encode_geohash(latitude, longitude)
+        return value
 
     def set_title(self, new_title):
         """Setter for title variable. Created by Alex"""
@@ -218,6 +324,19 @@ class Collection(db.Model):
     seller = db.Column('sellerID', db.ForeignKey(User.id), nullable=False)
     date = db.Column('timestamp', db.DateTime, nullable=False)
 
+    # orders collected by a user and orders collected from a user
+    __table_args__ = (
+        db.Index('ix_foodorder_buyer', 'buyerID'),
+        db.Index('ix_foodorder_seller', 'sellerID'),
+        # orders collected each day, recounted by the statistics reconcile job
+        db.Index('ix_foodorder_timestamp', 'timestamp'),
+    )
+
+    # the advert collected, the user who collected it and the user who posted it
+    collected_advert = db.relationship('Advert', back_populates='collections')
+    buyer_user = db.relationship('User', foreign_keys=[buyer], back_populates='collected_orders')
+    seller_user = db.relationship('User', foreign_keys=[seller], back_populates='sold_orders')
+
     def __init__(self, advert, seller, buyer, date):
         """Constructor for Collection class. Created by Alex"""
         self.advert = advert
@@ -229,16 +348,29 @@ class Collection(db.Model):
 class Message(db.Model):
     """Message class that acts as a template for all Message objects.
     When a user sends a message to another user, a message object is
-    created and then added to that users Messages list. Created by Alex, amended by Rebecca"""
+    created and then added to that users Messages list. Created by Alex, amended by Rebecca
+
+    user_low and user_high store the 2 users lowest id first (set whenever the sender or
+    receiver is set), so both directions of a conversation are read from one range of
+    ix_message_conversation in timestamp order."""
 
     __tablename__ = 'message'
-    sender = db.Column('senderID', db.ForeignKey(User.id), primary_key=True,
-                       nullable=False)
-    receiver = db.Column('receiverID', db.ForeignKey(User.id), primary_key=True,
-                         nullable=False)
-    timestamp = db.Column(db.DateTime, primary_key=True, nullable=False)
+    id = db.Column(db.Integer, primary_key=True)
+    sender = db.Column('senderID', db.ForeignKey(User.id), nullable=False)
+    receiver = db.Column('receiverID', db.ForeignKey(User.id), nullable=False)
+    user_low = db.Column(db.Integer, nullable=False)
+    user_high = db.Column(db.Integer, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
     contents = db.Column(db.String(200), nullable=False)
 
+    # covers chat history reads, on Postgres the sender and contents are stored in the index too,
+    # and the messages sent each day, recounted by the statistics reconcile job
+    __table_args__ = (
+        db.Index('ix_message_conversation', 'user_low', 'user_high', 'timestamp', 'id',
+                 postgresql_include=['senderID', 'contents']),
+        db.Index('ix_message_timestamp', 'timestamp'),
+    )
+
     def __init__(self, sender, receiver, timestamp, contents):
         """Constructor for Message class. Created by Alex"""
         self.sender = sender
@@ -246,6 +378,206 @@ class Message(db.Model):
         self.timestamp = timestamp
         self.contents = contents
 
+    @validates('sender', 'receiver')
+    def validate_users(self, key, user_id):
+        """Keeps user_low and user_high in step with the sender and receiver"""
+        other_id = self.receiver if key == 'sender' else self.sender
+        if user_id is not None and other_id is not None:
+            self.user_low, self.user_high = min(user_id, other_id), max(user_id, other_id)
+        return user_id
+
+
+class Conversation(db.Model):
+    """Conversation class that stores a summary of all the messages between 2 users: the latest
+    message and how many messages each of them hasn't read yet. The 2 users are stored lowest id
+    first, so there is one row per pair whoever sent the message. The row is updated by
+    datalink.create_message in the same transaction as the message, so the messages inbox only
+    has to read one row per conversation."""
+
+    __tablename__ = 'conversation'
+    user_low = db.Column(db.ForeignKey(User.id), primary_key=True, nullable=False)
+    user_high = db.Column(db.ForeignKey(User.id), primary_key=True, nullable=False)
+    last_message_id = db.Column(db.Integer)
+    last_sender = db.Column(db.ForeignKey(User.id), nullable=False)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    last_preview = db.Column(db.String(PREVIEW_LENGTH), nullable=False)
+    unread_low = db.Column(db.Integer, nullable=False, default=0)
+    unread_high = db.Column(db.Integer, nullable=False, default=0)
+
+    # the inbox of a user is found from either side of the pair, most recent first
+    __table_args__ = (
+        db.Index('ix_conversation_user_low', 'user_low', 'last_timestamp'),
+        db.Index('ix_conversation_user_high', 'user_high', 'last_timestamp'),
+    )
+
+    def __init__(self, user1, user2):
+        """Constructor for Conversation class, takes the ids of the 2 users in either order"""
+        self.user_low, self.user_high = Conversation.pair(user1, user2)
+        self.unread_low = 0
+        self.unread_high = 0
+
+    @staticmethod
+    def pair(user1, user2):
+        """Returns the ids of 2 users in the order they are stored in a conversation"""
+        return min(user1, user2), max(user1, user2)
+
+    def set_last_message(self, message):
+        """Makes a message the latest message of the conversation"""
+        self.last_message_id = message.id
+        self.last_sender = message.sender
+        self.last_timestamp = message.timestamp
+        self.last_preview = message.contents[:PREVIEW_LENGTH]
+
+    def get_partner(self, user):
+        """Returns the id of the other user in the conversation"""
+        return self.user_high if user == self.user_low else self.user_low
+
+    def get_unread(self, user):
+        """Returns how many messages in the conversation a user hasn't read"""
+        return self.unread_low if user == self.user_low else self.unread_high
+
+
+event.listen(Advert.__table__, 'after_create', DDL(ADVERT_FTS_SQL).execute_if(dialect='sqlite'))
+event.listen(Advert.__table__, 'after_drop', DDL("DROP TABLE IF EXISTS advert_fts").execute_if(dialect='sqlite'))
+
+
+class AdvertCluster(db.Model):
+    """AdvertCluster class that stores how many available adverts there are in a geohash cell and the sum of
+    their locations, so the advert map can draw one marker at the middle of the adverts of each cell when zoomed
+    out. There is a row for every cell with adverts at each of CLUSTER_PRECISIONS. The rows are updated by
+    datalink in the same transaction as the adverts they count."""
+
+    __tablename__ = 'advert_cluster'
+    precision = db.Column(db.Integer, primary_key=True, nullable=False)
+    cell = db.Column(db.String(GEOHASH_PRECISION), primary_key=True, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    lat_sum = db.Column(db.Float, nullable=False, default=0.0)
+    lon_sum = db.Column(db.Float, nullable=False, default=0.0)
+
+    def __init__(self, precision, cell):
+        """Constructor for AdvertCluster class, an empty cell"""
+        self.precision = precision
+        self.cell = cell
+        self.count = 0
+        self.lat_sum = 0.0
+        self.lon_sum = 0.0
+
+    def get_centre(self):
+        """Returns the average latitude and longitude of the adverts in the cell"""
+        return self.lat_sum / self.count, self.lon_sum / self.count
+
+
+class OutboundEmail(db.Model):
+    """OutboundEmail class for the emails waiting to be sent. Views queue emails through datalink.queue_email
+    instead of sending them during the request, and the mail queue job (see scheduler.py) sends them in the
+    background, trying again later if the mail server can't be reached.
+    An email is sent once send_after has passed, and is 'queued' until it is 'sent' or has 'failed' too many times."""
+
+    __tablename__ = 'outbound_email'
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(60), nullable=False)
+    subject = db.Column(db.String(100), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(6), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created = db.Column(db.DateTime, nullable=False)
+    send_after = db.Column(db.DateTime, nullable=False)
+    sent = db.Column(db.DateTime)
+    last_error = db.Column(db.String(200))
+    # random token of the last mail worker claim, so a worker only sends the emails its own claim updated
+    claim = db.Column(db.String(32))
+    # the newsletter broadcast the email is part of, if any
+    broadcast = db.Column(db.ForeignKey('newsletter_broadcast.id'))
+
+    # the queued emails that are due, oldest first, and the emails of a broadcast still waiting to be sent
+    __table_args__ = (
+        db.Index('ix_outbound_email_due', 'status', 'send_after'),
+        db.Index('ix_outbound_email_broadcast', 'broadcast', 'status'),
+    )
+
+    def __init__(self, recipient, subject, body, broadcast=None):
+        """Constructor for OutboundEmail class, an email to be sent straight away"""
+        self.recipient = recipient
+        self.subject = subject
+        self.body = body
+        self.broadcast = broadcast
+        self.status = 'queued'
+        self.attempts = 0
+        self.created = datetime.now()
+        self.send_after = self.created
+
+
+class NewsletterBroadcast(db.Model):
+    """NewsletterBroadcast class for a newsletter being sent to every subscribed user. The newsletter is queued a
+    batch of subscribers at a time (see email_folder/newsletter.py), in order of their id. last_user_id is the
+    checkpoint: it is saved in the same transaction as the emails of each batch, so a broadcast that was interrupted
+    carries on from the next subscriber without emailing anyone twice.
+    The body can include $first_name, which is replaced with the first name of each subscriber."""
+
+    __tablename__ = 'newsletter_broadcast'
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(100), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    created = db.Column(db.DateTime, nullable=False)
+    last_user_id = db.Column(db.Integer, nullable=False, default=0)
+    queued = db.Column(db.Integer, nullable=False, default=0)
+    finished = db.Column(db.DateTime)
+
+    def __init__(self, subject, body):
+        """Constructor for NewsletterBroadcast class, a broadcast that hasn't started"""
+        self.subject = subject
+        self.body = body
+        self.created = datetime.now()
+        self.last_user_id = 0
+        self.queued = 0
+
+    def render(self, first_name):
+        """Returns the body of the newsletter for a subscriber"""
+        return Template(self.body).safe_substitute(first_name=first_name)
+
+
+class DailyStat(db.Model):
+    """DailyStat class that stores the platform totals of a day for the admin statistics: the adverts posted,
+    collected and expired, the users who were active and the messages sent. The counters are added to by datalink in
+    the same transaction as the adverts, collections and messages they count, so a range of days is read from this
+    table by its primary key however much history there is. The reconcile job (see datalink.reconcile_stats)
+    recounts the most recent days from the tables themselves, in case a counter missed a change."""
+
+    __tablename__ = 'daily_stat'
+    day = db.Column(db.Date, primary_key=True, nullable=False)
+    adverts_posted = db.Column(db.Integer, nullable=False, default=0)
+    adverts_collected = db.Column(db.Integer, nullable=False, default=0)
+    adverts_expired = db.Column(db.Integer, nullable=False, default=0)
+    active_users = db.Column(db.Integer, nullable=False, default=0)
+    messages = db.Column(db.Integer, nullable=False, default=0)
+
+    # the counters, in the order they are shown
+    COUNTERS = ('adverts_posted', 'adverts_collected', 'adverts_expired', 'active_users', 'messages')
+
+    def __init__(self, day):
+        """Constructor for DailyStat class, a day with nothing counted yet"""
+        self.day = day
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+
+    def to_dict(self):
+        """Returns the day and its counters, as sent by the statistics endpoint"""
+        return {'day': self.day.isoformat(), **{counter: getattr(self, counter) for counter in self.COUNTERS}}
+
+
+class UserActivity(db.Model):
+    """UserActivity class that records which users were active on each day, so DailyStat.active_users counts each
+    user once a day. A user is active on a day they log in, post an advert, collect an order or send a message."""
+
+    __tablename__ = 'user_activity'
+    day = db.Column(db.Date, primary_key=True, nullable=False)
+    user = db.Column('userID', db.ForeignKey(User.id), primary_key=True, nullable=False)
+
+    def __init__(self, day, user):
+        """Constructor for UserActivity class"""
+        self.day = day
+        self.user = user
+
 
 def init_db():
     """Function to reset and initialise the database.
@@ -0,0 +1,96 @@
+"""
+This python file contains the password hasher, which hashes and checks passwords with bcrypt away from the request
+threads.
+
+bcrypt is slow on purpose, so a burst of logins or sign ups can keep every request thread busy hashing. The hasher
+runs bcrypt on a pool of PASSWORD_WORKERS threads (bcrypt doesn't hold the GIL while it works, so they run in
+parallel), with at most PASSWORD_QUEUE_LIMIT more passwords waiting for a thread. When the queue is full the request
+is answered straight away with 503 Service Unavailable instead of waiting behind everyone else.
+
+The cost of new hashes is set with BCRYPT_ROUNDS. Hashes made with a different cost still work, and are replaced with
+a hash at the current cost the next time the user logs in (see needs_rehash).
+
+The file includes:
+- PasswordHasherBusy: Exception raised when too many passwords are waiting to be hashed, shown as a 503 error page.
+- PasswordHasher: Flask extension that hashes and checks passwords on the pool.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+from werkzeug.exceptions import ServiceUnavailable
+
+
+class PasswordHasherBusy(ServiceUnavailable):
+    """Raised when the password queue is full, Flask answers it with the 503 error handler"""
+    description = "Too many people are logging in right now, please try again in a moment."
+
+
+class PasswordHasher:
+    """Flask extension that hashes and checks passwords with bcrypt on a bounded pool of threads"""
+
+    def __init__(self, app=None):
+        self.rounds = 12
+        self.workers = os.cpu_count() or 1
+        self.queue_limit = self.workers * 4
+        self._pool = None
+        self._slots = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """reads the cost and pool settings from the app config"""
+        self.rounds = app.config['BCRYPT_ROUNDS']
+        self.workers = app.config['PASSWORD_WORKERS'] or os.cpu_count() or 1
+        self.queue_limit = app.config['PASSWORD_QUEUE_LIMIT']
+        with self._lock:
+            self._pool = None
+            self._slots = None
+
+    def _run(self, function, *args):
+        """runs function on the pool and returns its result, raising PasswordHasherBusy if the queue is full"""
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='passwords')
+                # a slot for every password being hashed and every one waiting
+                self._slots = threading.BoundedSemaphore(self.workers + self.queue_limit)
+            pool, slots = self._pool, self._slots
+        if not slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            return pool.submit(function, *args).result()
+        finally:
+            slots.release()
+
+    def hash(self, password):
+        """Function that returns the bcrypt hash of a password, made with BCRYPT_ROUNDS
+
+        Returns:
+            str: the hash, which includes its salt and cost
+        """
+        salt = bcrypt.gensalt(self.rounds)
+        return self._run(bcrypt.hashpw, password.encode('utf-8'), salt).decode('utf-8')
+
+    def verify(self, password, hashed):
+        """Function that checks a password against a bcrypt hash
+
+        Returns:
+            bool: True if the password matches
+        """
+        if isinstance(hashed, str):
+            hashed = hashed.encode('utf-8')
+        return self._run(bcrypt.checkpw, password.encode('utf-8'), hashed)
+
+    def needs_rehash(self, hashed):
+        """Function that returns if a hash was made with a different cost than BCRYPT_ROUNDS
+
+        Returns:
+            bool: True if the password should be hashed again
+        """
+        if isinstance(hashed, bytes):
+            hashed = hashed.decode('utf-8')
+        # bcrypt hashes look like $2b$12$..., where 12 is the cost
+        parts = hashed.split('$')
+        return len(parts) < 4 or not parts[2].isdigit() or int(parts[2]) != self.rounds
@@ -0,0 +1,136 @@
+"""
+This python file contains the rate limiter that throttles login attempts before any password is checked.
+
+Every login attempt takes a token from 2 token buckets: one for the IP address it came from and one for the email
+address it is for. A bucket holds up to a number of attempts and refills steadily over a period, so it behaves like a
+sliding window: a client can make a few attempts in a row, but no more than the limit over any period. When either
+bucket is empty the attempt is refused straight away, without loading the user or running bcrypt, which is what
+credential stuffing and brute force attacks would otherwise spend our CPU on.
+
+The buckets are kept by one of the following stores:
+- MemoryBucketStore: keeps the buckets in this process, for when the app runs as a single worker.
+- RedisBucketStore: keeps the buckets in Redis, so every worker process shares them.
+
+The store is chosen with the RATE_LIMIT_STORAGE setting: 'memory' (default), a redis:// url or 'none' to turn the
+limits off.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# prefix of the keys the Redis store uses
+RATE_LIMIT_PREFIX = 'feedforward:ratelimit:'
+
+# updates a bucket in Redis in one step, so workers taking tokens at the same time can't both take the last one
+REDIS_TAKE_SCRIPT = """
+local capacity, rate, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens, updated = tonumber(bucket[1]), tonumber(bucket[2])
+if tokens == nil then
+    tokens, updated = capacity, now
+end
+tokens = math.min(capacity, tokens + math.max(now - updated, 0) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+def _retry_after(tokens, rate):
+    """returns how many seconds until a bucket with tokens left, refilling at rate a second, has a whole token"""
+    return max(1.0 - tokens, 0.0) / rate
+
+
+class MemoryBucketStore:
+    """Store that keeps up to max_keys token buckets in memory, dropping the ones used least recently"""
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        # key -> (tokens, time the tokens were counted)
+        self._buckets = OrderedDict()
+
+    def take(self, key, capacity, rate, now=None):
+        """takes a token from the bucket for key, which holds up to capacity tokens and refills at rate tokens a second
+
+            Returns:
+                float: 0 if a token was taken, otherwise the seconds until the bucket has one
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + max(now - updated, 0) * rate)
+            retry_after = _retry_after(tokens, rate)
+            if retry_after == 0:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return retry_after
+
+
+class RedisBucketStore:
+    """Store that keeps the token buckets in Redis, shared by every worker"""
+
+    def __init__(self, url):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._take = self._redis.register_script(REDIS_TAKE_SCRIPT)
+
+    def take(self, key, capacity, rate, now=None):
+        """takes a token from the bucket for key, which holds up to capacity tokens and refills at rate tokens a second
+
+            Returns:
+                float: 0 if a token was taken, otherwise the seconds until the bucket has one
+        """
+        now = time.time() if now is None else now
+        allowed, tokens = self._take(keys=[RATE_LIMIT_PREFIX + key], args=[capacity, rate, now])
+        return 0.0 if allowed else _retry_after(float(tokens), rate)
+
+
+class RateLimiter:
+    """Flask extension that limits how often logins are attempted from each IP address and for each email address"""
+
+    def __init__(self, app=None):
+        self.store = MemoryBucketStore()
+        self.ip_attempts = 20
+        self.email_attempts = 5
+        self.period = 300
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """creates the store named by the RATE_LIMIT_STORAGE setting and reads the login limits"""
+        setting = app.config.get('RATE_LIMIT_STORAGE') or 'memory'
+        if setting == 'memory':
+            self.store = MemoryBucketStore()
+        elif setting.startswith(('redis://', 'rediss://', 'unix://')):
+            self.store = RedisBucketStore(setting)
+        elif setting == 'none':
+            self.store = None
+        else:
+            raise ValueError(f"Unknown rate limit storage {setting}")
+        self.ip_attempts = app.config['LOGIN_IP_ATTEMPTS']
+        self.email_attempts = app.config['LOGIN_EMAIL_ATTEMPTS']
+        self.period = app.config['LOGIN_RATE_PERIOD']
+
+    def limit_login(self, ip_address, email):
+        """Function that counts a login attempt from ip_address for email, call before checking the password
+
+        Returns:
+            float: 0 if the attempt is allowed, otherwise how many seconds to wait before trying again
+        """
+        if self.store is None:
+            return 0.0
+        # each bucket refills completely over the period
+        retry_after = self.store.take(f"login:ip:{ip_address}", self.ip_attempts, self.ip_attempts / self.period)
+        if retry_after:
+            return retry_after
+        email = (email or '').strip().lower()
+        return self.store.take(f"login:email:{email}", self.email_attempts, self.email_attempts / self.period)
@@ -0,0 +1,95 @@
+"""
+This python file contains the background jobs that run alongside the website, so requests don't have to do the work.
+
+The file includes:
+- PeriodicJob: Thread that runs a function every interval seconds inside an app context.
+- start_background_jobs: Starts the jobs that are enabled in the app config in this process.
+
+Jobs:
+- expiry sweep: Marks adverts past their expiry date as unavailable every EXPIRY_SWEEP_INTERVAL seconds.
+- statistics reconcile: Recounts the daily statistics of the last STATS_RECONCILE_DAYS days every
+  STATS_RECONCILE_INTERVAL seconds (once a day by default).
+- mail queue: Sends the queued emails and newsletter broadcasts every MAIL_QUEUE_INTERVAL seconds
+  (see email_folder/mailer.py).
+
+Each job can instead run in its own process as a flask command (see commands.py), e.g. when the website runs as several
+worker processes and the job should only run once.
+"""
+import threading
+from datetime import date, timedelta
+
+from extensions import db, mailer
+
+
+class PeriodicJob(threading.Thread):
+    """Thread that runs a function every interval seconds until it is stopped.
+    Each run gets an app context and its own database session, errors are logged and the job carries on."""
+
+    def __init__(self, app, name, function, interval):
+        super().__init__(name=name, daemon=True)
+        self.app = app
+        self.function = function
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        """runs the function straight away and then every interval seconds"""
+        while not self._stopped.is_set():
+            self.run_once()
+            self._stopped.wait(self.interval)
+
+    def run_once(self):
+        """runs the function once"""
+        with self.app.app_context():
+            try:
+                self.function()
+            except Exception:
+                self.app.logger.exception("Background job %s failed", self.name)
+            finally:
+                db.session.remove()
+
+    def stop(self):
+        """stops the job after the current run"""
+        self._stopped.set()
+
+
+def expiry_sweep_job(app):
+    """returns the job that marks out of date adverts as unavailable"""
+    import datalink
+    return PeriodicJob(app, 'expiry-sweep', datalink.check_expiry, app.config['EXPIRY_SWEEP_INTERVAL'])
+
+
+def reconcile_latest_stats(app):
+    """recounts the daily statistics of the last STATS_RECONCILE_DAYS days, up to today"""
+    import datalink
+    today = date.today()
+    return datalink.reconcile_stats(today - timedelta(days=app.config['STATS_RECONCILE_DAYS'] - 1), today)
+
+
+def stats_reconcile_job(app):
+    """returns the job that recounts the latest daily statistics"""
+    return PeriodicJob(app, 'stats-reconcile', lambda: reconcile_latest_stats(app),
+                       app.config['STATS_RECONCILE_INTERVAL'])
+
+
+def mail_queue_job(app):
+    """returns the job that sends the queued emails and newsletter broadcasts"""
+    return PeriodicJob(app, 'mail-queue', mailer.run, app.config['MAIL_QUEUE_INTERVAL'])
+
+
+def start_background_jobs(app):
+    """Function that starts the background jobs enabled in the app config as threads of this process
+
+    Returns:
+        list: the started jobs
+    """
+    jobs = []
+    if app.config['EXPIRY_SWEEP_THREAD']:
+        jobs.append(expiry_sweep_job(app))
+    if app.config['STATS_RECONCILE_THREAD']:
+        jobs.append(stats_reconcile_job(app))
+    if app.config['MAIL_QUEUE_THREAD']:
+        jobs.append(mail_queue_job(app))
+    for job in jobs:
+        job.start()
+    return jobs
@@ -0,0 +1,121 @@
+import time
+import unittest
+
+from cache import FragmentCache, LRUCache, NullCache, UserCache
+
+
+class TestFragmentCache(unittest.TestCase):
+    """Test suite for the in memory fragment cache"""
+    def setUp(self):
+        self.cache = FragmentCache()
+        self.renders = 0
+
+    def render(self):
+        self.renders += 1
+        return f"render {self.renders}"
+
+    def test_cached(self):
+        """test a fragment is only rendered once while its namespace doesn't change"""
+        self.assertEqual(self.cache.cached('adverts', 'page', self.render), "render 1")
+        self.assertEqual(self.cache.cached('adverts', 'page', self.render), "render 1")
+        self.assertEqual(self.cache.cached('adverts', 'other page', self.render), "render 2")
+
+    def test_bump(self):
+        """test bumping a namespace makes its fragments out of date but leaves other namespaces alone"""
+        self.cache.cached('adverts', 'page', self.render)
+        self.cache.cached('users', 'page', self.render)
+        self.cache.bump('adverts')
+        self.assertEqual(self.cache.cached('adverts', 'page', self.render), "render 3")
+        self.assertEqual(self.cache.cached('users', 'page', self.render), "render 2")
+
+    def test_lru(self):
+        """test the least recently used fragment is dropped when the cache is full"""
+        self.cache.backend = LRUCache(max_entries=2)
+        self.cache.cached('adverts', 'a', self.render)
+        self.cache.cached('adverts', 'b', self.render)
+        self.cache.cached('adverts', 'a', self.render)
+        self.cache.cached('adverts', 'c', self.render)
+        self.assertEqual(self.cache.cached('adverts', 'a', self.render), "render 1")
+        self.assertEqual(self.cache.cached('adverts', 'b', self.render), "render 4")
+
+    def test_ttl(self):
+        """test fragments expire after the ttl"""
+        self.cache.backend = LRUCache(ttl=0.05)
+        self.cache.cached('adverts', 'page', self.render)
+        time.sleep(0.1)
+        self.assertEqual(self.cache.cached('adverts', 'page', self.render), "render 2")
+
+    def test_version_tag(self):
+        """test the ETag tag changes when the namespace is bumped, and after the ttl for a cache kept in memory"""
+        self.cache.backend = LRUCache(ttl=0.05)
+        tag = self.cache.version_tag('adverts')
+        self.cache.bump('adverts')
+        self.assertNotEqual(self.cache.version_tag('adverts'), tag)
+        tag = self.cache.version_tag('adverts')
+        time.sleep(0.1)
+        self.assertNotEqual(self.cache.version_tag('adverts'), tag)
+        self.cache.backend = NullCache()
+        self.assertIsNone(self.cache.version_tag('adverts'))
+
+    def test_null_cache(self):
+        """test the null backend renders every time"""
+        self.cache.backend = NullCache()
+        self.cache.cached('adverts', 'page', self.render)
+        self.assertEqual(self.cache.cached('adverts', 'page', self.render), "render 2")
+
+
+class TestUserCache(unittest.TestCase):
+    """Test suite for the cache used by the user loader"""
+    def setUp(self):
+        self.cache = UserCache()
+        self.loads = []
+
+    def load(self, user_id):
+        self.loads.append(user_id)
+        return None if user_id == 0 else f"user {user_id} load {len(self.loads)}"
+
+    def test_get(self):
+        """test a user is only loaded once, and users that don't exist aren't cached"""
+        self.assertEqual(self.cache.get(1, self.load), "user 1 load 1")
+        self.assertEqual(self.cache.get(1, self.load), "user 1 load 1")
+        self.assertIsNone(self.cache.get(0, self.load))
+        self.assertIsNone(self.cache.get(0, self.load))
+        self.assertEqual(self.loads, [1, 0, 0])
+
+    def test_invalidate(self):
+        """test an invalidated user is loaded again, other users stay cached"""
+        self.cache.get(1, self.load)
+        self.cache.get(2, self.load)
+        self.cache.invalidate(1)
+        self.assertEqual(self.cache.get(1, self.load), "user 1 load 3")
+        self.assertEqual(self.cache.get(2, self.load), "user 2 load 2")
+
+    def test_invalidate_while_loading(self):
+        """test a user loaded before a change was committed isn't cached"""
+        def load_then_change(user_id):
+            user = self.load(user_id)
+            self.cache.invalidate(user_id)
+            return user
+        self.assertEqual(self.cache.get(1, load_then_change), "user 1 load 1")
+        self.assertEqual(self.cache.get(1, self.load), "user 1 load 2")
+
+    def test_shared_versions(self):
+        """test a user changed through one worker is loaded again by every worker sharing the versions"""
+        other = UserCache()
+        self.cache.versions = other.versions = LRUCache()
+        self.cache.get(1, self.load)
+        other.get(1, self.load)
+        other.invalidate(1)
+        self.assertEqual(self.cache.get(1, self.load), "user 1 load 3")
+        self.assertEqual(self.cache.get(1, self.load), "user 1 load 3")
+
+    def test_ttl(self):
+        """test users are loaded again after the ttl"""
+        self.cache.backend = LRUCache(ttl=0.05)
+        self.cache.get(1, self.load)
+        time.sleep(0.1)
+        self.assertEqual(self.cache.get(1, self.load), "user 1 load 2")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+from datetime import datetime
+import unittest
+
+from flask import Flask, flash
+
+from conditional import conditional, make_etag
+
+
+class TestConditional(unittest.TestCase):
+    """Test suite for the conditional request decorator"""
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.secret_key = 'test'
+        self.version = 1
+        self.last_modified = datetime(2024, 1, 1, 12, 0, 0)
+        self.renders = 0
+
+        def validator():
+            return make_etag(self.version), self.last_modified
+
+        @self.app.route('/page', methods=['GET', 'POST'])
+        @conditional(validator)
+        def page():
+            self.renders += 1
+            return f"version {self.version}"
+
+        @self.app.route('/flash')
+        def flash_message():
+            flash("hello")
+            return ""
+
+        self.client = self.app.test_client()
+
+    def test_etag(self):
+        """test a request with the current ETag gets a 304 without running the view"""
+        response = self.client.get('/page')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+        etag = response.headers['ETag']
+
+        response = self.client.get('/page', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(self.renders, 1)
+
+        self.version = 2
+        response = self.client.get('/page', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'version 2')
+
+    def test_last_modified(self):
+        """test a request with an up to date If-Modified-Since gets a 304"""
+        last_modified = self.client.get('/page').headers['Last-Modified']
+        response = self.client.get('/page', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+        self.last_modified = datetime(2024, 1, 1, 12, 0, 1)
+        response = self.client.get('/page', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 200)
+
+    def test_skipped(self):
+        """test POST requests and pages with flashed messages are always built"""
+        etag = self.client.get('/page').headers['ETag']
+        self.assertEqual(self.client.post('/page', headers={'If-None-Match': etag}).status_code, 200)
+        self.client.get('/flash')
+        self.assertEqual(self.client.get('/page', headers={'If-None-Match': etag}).status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
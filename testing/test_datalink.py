@@ -1,8 +1,14 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import unittest
+from unittest.mock import patch
 
-from models import User, Advert, Collection, Message
-from app import app
+import sqlalchemy
+from sqlalchemy import select, update, delete
+
+from models import User, Advert, Collection, Message, Conversation, AdvertCluster, DailyStat, UserActivity
+from models import supports_partial_indexes
+from app import app, db, load_user
+from extensions import fragment_cache
 import datalink
 
 # test values for each table
@@ -49,6 +55,20 @@ test_collections = [
 ]
 
 
+def explain(statement):
+    """returns the query plan the database uses for a statement as text"""
+    connection = db.session.connection()
+    compiled = statement.compile(connection)
+    if connection.dialect.name == 'sqlite':
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+        plan = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + compiled.string, params)
+        return "\n".join(row[-1] for row in plan)
+    # stop postgres choosing a full scan just because the test tables are small
+    connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+    plan = connection.exec_driver_sql("EXPLAIN " + compiled.string, compiled.params)
+    return "\n".join(row[0] for row in plan)
+
+
 class TestDatabase(unittest.TestCase):
     """Test suite for datalink.py functions
         Created by Rebecca
@@ -292,6 +312,635 @@ class TestDatabase(unittest.TestCase):
             for u in users:
                 datalink.delete_user(u)
 
+    def test_get_messages_since(self):
+        """test that get_messages_since only returns newer messages, in order and up to the limit"""
+        with app.app_context():
+            users = [User(*u) for u in test_users]
+            for u in users:
+                datalink.create_user(u)
+            messages = [Message(*m) for m in test_messages]
+            for i in range(len(messages)):
+                messages[i].sender = users[test_messages[i][0] - 1].id
+                messages[i].receiver = users[test_messages[i][1] - 1].id
+                datalink.create_message(messages[i])
+
+            # only the messages after the first one should be returned
+            newer = datalink.get_messages_since(users[0].id, users[1].id, test_messages[0][2])
+            self.assertEqual([m.contents for m in newer], ["2", "3"])
+            # check the number of messages returned is bounded
+            newer = datalink.get_messages_since(users[0].id, users[1].id, datetime.min, limit=2)
+            self.assertEqual([m.contents for m in newer], ["1", "2"])
+            # nothing newer than the latest message
+            newer = datalink.get_messages_since(users[0].id, users[1].id, test_messages[2][2])
+            self.assertEqual(len(newer), 0)
+
+            # a message sent at the same time as the latest one isn't skipped when its id is given
+            same_time = Message(users[1].id, users[0].id, test_messages[2][2], "4")
+            datalink.create_message(same_time)
+            self.assertEqual(len(datalink.get_message_history(users[0].id, users[1].id)), 4)
+            newer = datalink.get_messages_since(users[0].id, users[1].id, test_messages[2][2], messages[2].id)
+            self.assertEqual([m.contents for m in newer], ["4"])
+
+            for u in users:
+                datalink.delete_user(u)
+
+    def test_get_message_page(self):
+        """test get_message_page returns the latest messages first and then pages back through older ones"""
+        with app.app_context():
+            users = [User(*u) for u in test_users]
+            for u in users:
+                datalink.create_user(u)
+            messages = [Message(*m) for m in test_messages]
+            for i in range(len(messages)):
+                messages[i].sender = users[test_messages[i][0] - 1].id
+                messages[i].receiver = users[test_messages[i][1] - 1].id
+                datalink.create_message(messages[i])
+
+            # the latest messages, oldest first
+            page = datalink.get_message_page(users[1].id, users[0].id, limit=2)
+            self.assertEqual([m.contents for m in page], ["2", "3"])
+            # the page before the oldest message shown
+            page = datalink.get_message_page(users[1].id, users[0].id, page[0].timestamp, page[0].id, limit=2)
+            self.assertEqual([m.contents for m in page], ["1"])
+
+            for u in users:
+                datalink.delete_user(u)
+
+    def test_get_inbox(self):
+        """test get_inbox returns each conversation partner with the latest message, most recent first"""
+        with app.app_context():
+            users = [User(*u) for u in test_users]
+            for u in users:
+                datalink.create_user(u)
+            messages = [Message(*m) for m in test_messages]
+            for i in range(len(messages)):
+                messages[i].sender = users[test_messages[i][0] - 1].id
+                messages[i].receiver = users[test_messages[i][1] - 1].id
+                datalink.create_message(messages[i])
+
+            inbox = datalink.get_inbox(users[0].id)
+            self.assertEqual([(u.email, c.last_preview) for u, c in inbox],
+                             [("testemail2@gmail.com", "3"), ("testemail3@gmail.com", "lorem ipsum")])
+            # check pagination
+            inbox = datalink.get_inbox(users[0].id, limit=1, offset=1)
+            self.assertEqual([u.email for u, m in inbox], ["testemail3@gmail.com"])
+            # a message received counts as part of the conversation too
+            inbox = datalink.get_inbox(users[3].id)
+            self.assertEqual([(u.email, c.last_preview) for u, c in inbox], [("testemail3@gmail.com", "hello world")])
+
+            for u in users:
+                datalink.delete_user(u)
+
+    def test_conversation_summary(self):
+        """test the conversation summary follows new messages and can be rebuilt from the message table"""
+        with app.app_context():
+            users = [User(*u) for u in test_users]
+            for u in users:
+                datalink.create_user(u)
+            messages = [Message(*m) for m in test_messages]
+            for i in range(len(messages)):
+                messages[i].sender = users[test_messages[i][0] - 1].id
+                messages[i].receiver = users[test_messages[i][1] - 1].id
+                datalink.create_message(messages[i])
+
+            conversation = Conversation.query.get(Conversation.pair(users[1].id, users[0].id))
+            self.assertEqual(conversation.last_preview, "3")
+            self.assertEqual(conversation.last_sender, users[0].id)
+            # user 2 hasn't read the 3 messages from user 1
+            self.assertEqual(conversation.get_unread(users[1].id), 3)
+            self.assertEqual(conversation.get_unread(users[0].id), 0)
+            datalink.mark_conversation_read(users[1].id, users[0].id)
+            self.assertEqual(conversation.get_unread(users[1].id), 0)
+
+            # deleting the latest message goes back to the one before it
+            datalink.delete_message(messages[2])
+            self.assertEqual(conversation.last_preview, "2")
+
+            # the rebuilt summaries match the message table
+            datalink.rebuild_conversations()
+            conversation = Conversation.query.get(Conversation.pair(users[0].id, users[1].id))
+            self.assertEqual(conversation.last_preview, "2")
+            self.assertEqual(conversation.last_timestamp, test_messages[1][2])
+            self.assertEqual([u.email for u, c in datalink.get_inbox(users[0].id)],
+                             ["testemail2@gmail.com", "testemail3@gmail.com"])
+
+            for u in users:
+                datalink.delete_user(u)
+            self.assertIsNone(Conversation.query.get(Conversation.pair(users[0].id, users[1].id)))
+
+    def test_first_messages_at_once(self):
+        """test a message sent while another request creates the conversation summary and the day's statistics is
+        added to them instead of failing"""
+        with app.app_context():
+            users = [User(*u) for u in test_users[:2]]
+            for u in users:
+                datalink.create_user(u)
+            sender, receiver = users[0].id, users[1].id
+            datalink.create_message(Message(sender, receiver, datetime(2001, 1, 1, 1, 1, 1), "1"))
+            stats_before = datalink.get_daily_stats(date(2001, 1, 1), date(2001, 1, 1))[0].to_dict()
+            # start again like a new request would
+            db.session.expunge_all()
+
+            real_get = db.session.get
+            missed = []
+            def get(model, key, **kwargs):
+                # the first lookup of each row runs before the other request has committed it
+                if model in (Conversation, DailyStat, UserActivity) and model not in missed:
+                    missed.append(model)
+                    return None
+                return real_get(model, key, **kwargs)
+            with patch.object(db.session, 'get', get):
+                datalink.create_message(Message(sender, receiver, datetime(2001, 1, 1, 1, 1, 2), "2"))
+            self.assertEqual(len(missed), 3)
+            stats = datalink.get_daily_stats(date(2001, 1, 1), date(2001, 1, 1))[0].to_dict()
+            self.assertEqual(stats['messages'], stats_before['messages'] + 1)
+            self.assertEqual(stats['active_users'], stats_before['active_users'])
+
+            conversation = real_get(Conversation, Conversation.pair(sender, receiver))
+            self.assertEqual(conversation.get_unread(receiver), 2)
+            self.assertEqual(conversation.last_preview, "2")
+
+            for user_id in (sender, receiver):
+                datalink.delete_user(datalink.get_user_from_id(user_id))
+            db.session.execute(delete(DailyStat).where(DailyStat.day == date(2001, 1, 1)))
+            db.session.commit()
+
+    def test_get_ads_page(self):
+        """test get_ads_page pages through the available adverts in order, with the owner and text filters"""
+        with app.app_context():
+            users = [User(*u) for u in test_users[:2]]
+            for u in users:
+                datalink.create_user(u)
+            # several adverts share an expiry date, so the id has to break the tie between pages
+            expiries = [tomorrow, tomorrow, tomorrow + timedelta(days=1), tomorrow, tomorrow + timedelta(days=2)]
+            adverts = []
+            for i, expiry in enumerate(expiries):
+                adverts.append(Advert(f"ad {i}", "Test Ad", 55.0, 1.6, f"{i}% off", users[0].id, expiry))
+                datalink.create_advert(adverts[-1])
+            datalink.create_advert(Advert("other", "Test Ad", 55.0, 1.6, "lorem ipsum", users[1].id, tomorrow))
+            datalink.create_advert(Advert("gone", "Test Ad", 55.0, 1.6, "lorem ipsum", users[0].id, tomorrow, False))
+
+            def pages(sort, **filters):
+                titles, after, after_id = [], None, None
+                while True:
+                    page = datalink.get_ads_page(sort, users[0].id, after=after, after_id=after_id, limit=2,
+                                                 **filters)
+                    titles.append([advert.title for advert in page])
+                    if len(page) < 2:
+                        return titles
+                    after, after_id = page[-1].expiry, page[-1].adID
+
+            self.assertEqual(pages('expiry'), [["ad 0", "ad 1"], ["ad 3", "ad 2"], ["ad 4"]])
+            self.assertEqual(pages('newest'), [["ad 4", "ad 3"], ["ad 2", "ad 1"], ["ad 0"]])
+            # % in the text is matched literally and the match ignores case
+            self.assertEqual(pages('expiry', text="3% OFF"), [["ad 3"]])
+            self.assertEqual(pages('expiry', text="%"), [["ad 0", "ad 1"], ["ad 3", "ad 2"], ["ad 4"]])
+            self.assertIn("other", [advert.title for advert in datalink.get_ads_page(limit=1000)])
+            with self.assertRaises(ValueError):
+                datalink.get_ads_page('cheapest')
+
+            for u in users:
+                datalink.delete_user(u)
+
+    def test_search_ads(self):
+        """test search_ads finds available adverts containing every word, best match first,
+            and stops finding adverts that are collected, expire or are deleted
+        """
+        with app.app_context():
+            user = User(*test_users[0])
+            datalink.create_user(user)
+            adverts = []
+            for title, contents in [("Bread", "a loaf of fresh bread"), ("Cake", "chocolate cake with bread crumbs"),
+                                    ("Soup", "tomato soup"),
+                                    ("Breads", "rolls and baguettes from the bakery down the road")]:
+                adverts.append(Advert(title, "Test Ad", 55.0, 1.6, contents, user.id, tomorrow))
+                datalink.create_advert(adverts[-1])
+
+            def search(text):
+                return [advert.title for advert in datalink.search_ads(text, limit=1000) if advert.owner == user.id]
+
+            # the advert mentioning bread most comes first, words are matched in any form and case
+            self.assertEqual(search("bread")[0], "Bread")
+            self.assertEqual(sorted(search("BREAD")), ["Bread", "Breads", "Cake"])
+            self.assertEqual(search("fresh bread"), ["Bread"])
+            # punctuation isn't treated as search syntax
+            self.assertEqual(search('tomato" OR "cake'), [])
+            self.assertEqual(search("***"), [])
+            # pagination
+            self.assertEqual(len(datalink.search_ads("bread", limit=1, offset=1)), 1)
+            # the listing's text filter uses the search too
+            self.assertEqual([a.title for a in datalink.get_ads_page(owner=user.id, text="soup")], ["Soup"])
+
+            datalink.set_advert_unavailable(adverts[0].adID)
+            adverts[1].expiry = yesterday
+            db.session.commit()
+            datalink.check_expiry()
+            datalink.delete_advert(adverts[3])
+            self.assertEqual(search("bread"), [])
+            self.assertEqual(search("soup"), ["Soup"])
+
+            datalink.delete_user(user)
+            self.assertEqual(search("soup"), [])
+
+    def test_advert_changes_bump_cache(self):
+        """test every change to the available adverts makes the cached advert pages out of date"""
+        with app.app_context():
+            user = User(*test_users[0])
+            datalink.create_user(user)
+
+            def bumps(change):
+                version = fragment_cache.backend.version(datalink.ADVERTS_CACHE)
+                change()
+                return fragment_cache.backend.version(datalink.ADVERTS_CACHE) != version
+
+            adverts = [Advert("ad", "Test Ad", 55.0, 1.6, "lorem ipsum", user.id, tomorrow) for _ in range(3)]
+            self.assertTrue(bumps(lambda: datalink.create_advert(adverts[0])))
+            datalink.create_advert(adverts[1])
+            datalink.create_advert(adverts[2])
+            self.assertTrue(bumps(lambda: datalink.set_advert_unavailable(adverts[0].adID)))
+            self.assertTrue(bumps(lambda: datalink.delete_advert(adverts[1])))
+            # the expiry sweep only makes the pages out of date if it finds expired adverts
+            self.assertFalse(bumps(datalink.check_expiry))
+            adverts[2].expiry = yesterday
+            db.session.commit()
+            self.assertTrue(bumps(datalink.check_expiry))
+            self.assertTrue(bumps(lambda: datalink.delete_user(user)))
+
+    def test_lookups_use_identity_map(self):
+        """test looking up a user or advert already loaded in the session doesn't query the database again"""
+        with app.app_context():
+            user = User(*test_users[0])
+            datalink.create_user(user)
+            advert = Advert(*test_adverts[0])
+            advert.owner = user.id
+            datalink.create_advert(advert)
+            # start again like a new request would
+            user_id, ad_id = user.id, advert.adID
+            db.session.expunge_all()
+
+            statements = []
+            def count(*args):
+                statements.append(args[2])
+            sqlalchemy.event.listen(db.engine, "before_cursor_execute", count)
+            try:
+                loaded = datalink.get_user_from_id(user_id)
+                self.assertEqual(len(statements), 1)
+                # ids from urls are strings
+                self.assertIs(datalink.get_user_from_id(str(user_id)), loaded)
+                self.assertIs(datalink.get_advert(ad_id), datalink.get_advert(str(ad_id)))
+                self.assertEqual(len(statements), 2)
+            finally:
+                sqlalchemy.event.remove(db.engine, "before_cursor_execute", count)
+            self.assertIsNone(datalink.get_advert(0))
+
+            datalink.delete_advert(datalink.get_advert(ad_id))
+            datalink.delete_user(loaded)
+
+    def test_account_pages_query_count(self):
+        """test the account pages load their adverts and orders, with the related adverts and users they show, in a
+        fixed number of queries however many rows there are"""
+        with app.app_context():
+            seller = User(*test_users[0])
+            datalink.create_user(seller)
+            collectors = [User(*test_users[1]), User(*test_users[2])]
+            for collector in collectors:
+                datalink.create_user(collector)
+            for number in range(4):
+                advert = Advert(*test_adverts[0])
+                advert.owner = seller.id
+                datalink.create_advert(advert)
+                datalink.create_order(Collection(advert.adID, seller.id, collectors[number % 2].id, datetime.now()))
+            seller_id, collector_ids = seller.id, [collector.id for collector in collectors]
+
+            def overview_page():
+                # what admin/account_overview.html shows of the adverts
+                return [(advert.title, [collection.buyer_user.first_name for collection in advert.collections])
+                        for advert in datalink.get_user_adverts(seller_id, with_collections=True)]
+
+            def orders_page():
+                # what the order history tables show
+                return [(order.collected_advert.title, order.seller_user.first_name)
+                        for order in datalink.get_user_collections(collector_ids[0])]
+
+            statements = []
+            def count(*args):
+                statements.append(args[2])
+            expected = {'selectin': 3, 'joined': 1}
+            sqlalchemy.event.listen(db.engine, "before_cursor_execute", count)
+            try:
+                for strategy, queries in expected.items():
+                    app.config['EAGER_LOADING'] = strategy
+                    for page, rows in ((overview_page, 4), (orders_page, 2)):
+                        # start again like a new request would
+                        db.session.expunge_all()
+                        statements.clear()
+                        self.assertEqual(len(page()), rows)
+                        self.assertEqual(len(statements), queries, (strategy, page.__name__))
+                # loading lazily makes a query for each row
+                app.config['EAGER_LOADING'] = 'lazy'
+                db.session.expunge_all()
+                statements.clear()
+                overview_page()
+                self.assertGreater(len(statements), expected['selectin'])
+            finally:
+                sqlalchemy.event.remove(db.engine, "before_cursor_execute", count)
+                app.config['EAGER_LOADING'] = 'selectin'
+
+            for user_id in [seller_id] + collector_ids:
+                datalink.delete_user(datalink.get_user_from_id(user_id))
+
+    def test_update_user(self):
+        """test the user loader caches a copy of the user until they are changed"""
+        with app.app_context():
+            user = User(*test_users[0])
+            datalink.create_user(user)
+            self.assertEqual(load_user(str(user.id)).role, 'user')
+            # the cached copy is returned even if the database changes behind datalink's back
+            db.session.execute(update(User).where(User.id == user.id).values(first_name="Changed"))
+            self.assertNotEqual(load_user(str(user.id)).first_name, "Changed")
+
+            user.role = 'off'
+            datalink.update_user(user)
+            copy = load_user(str(user.id))
+            self.assertEqual((copy.role, copy.first_name), ('off', "Changed"))
+
+            # and when the details are replaced
+            updated = User(*test_users[1][:-1], "off")
+            datalink.update_details(user, updated)
+            self.assertEqual(load_user(str(user.id)).email, test_users[1][0])
+
+            datalink.delete_user(user)
+            self.assertIsNone(load_user(str(copy.id)))
+
+    def test_admin_dashboard(self):
+        """test the admin dashboard counts and pages through the current, collected and deleted adverts and users"""
+        with app.app_context():
+            before = datalink.get_admin_summary()
+            seller = User(*test_users[0])
+            datalink.create_user(seller)
+            collector = User(*test_users[1])
+            datalink.create_user(collector)
+            admin = User(*test_users[2][:-1], "admin")
+            datalink.create_user(admin)
+            adverts = []
+            for ad in test_adverts:
+                advert = Advert(*ad)
+                advert.owner = seller.id
+                datalink.create_advert(advert)
+                adverts.append(advert)
+            collected = Advert(*test_adverts[4])
+            collected.owner = seller.id
+            datalink.create_advert(collected)
+            datalink.create_order(Collection(collected.adID, seller.id, collector.id, datetime.now()))
+
+            summary = datalink.get_admin_summary()
+            changes = {key: summary[key] - before[key] for key in summary}
+            self.assertEqual(changes, {'current': 4, 'collected': 1, 'deleted': 1, 'users': 2, 'admins': 1})
+
+            ids = {section: [advert.adID for advert in datalink.get_admin_adverts(section, limit=1000)]
+                   for section in datalink.ADMIN_ADVERT_SECTIONS}
+            self.assertTrue({advert.adID for advert in adverts[:4]} <= set(ids['current']))
+            self.assertIn(collected.adID, ids['collected'])
+            self.assertNotIn(collected.adID, ids['deleted'])
+            self.assertIn(adverts[4].adID, ids['deleted'])
+            # pages follow on from each other
+            pages = datalink.get_admin_adverts('current', limit=2) + datalink.get_admin_adverts('current', limit=2,
+                                                                                                  offset=2)
+            self.assertEqual([advert.adID for advert in pages], ids['current'][:4])
+            with self.assertRaises(ValueError):
+                datalink.get_admin_adverts('unknown')
+
+            self.assertIn(admin.id, [user.id for user in datalink.get_users_by_role('admin', limit=1000)])
+            user_ids = [user.id for user in datalink.get_users_by_role('user', limit=1000)]
+            self.assertIn(seller.id, user_ids)
+            self.assertNotIn(admin.id, user_ids)
+
+            datalink.delete_user(seller)
+            datalink.delete_user(collector)
+            datalink.delete_user(admin)
+
+    def test_daily_stats(self):
+        """test adverts, collections and messages are counted in the statistics of their day as they are created,
+        and the reconcile job counts the same from the tables"""
+        with app.app_context():
+            day = date(2001, 1, 1)
+            db.session.execute(delete(DailyStat).where(DailyStat.day == day))
+            seller = User(*test_users[0])
+            datalink.create_user(seller)
+            collector = User(*test_users[1])
+            datalink.create_user(collector)
+
+            advert = Advert(*test_adverts[0])
+            advert.owner = seller.id
+            advert.created = datetime(2001, 1, 1, 10)
+            datalink.create_advert(advert)
+            datalink.create_order(Collection(advert.adID, seller.id, collector.id, datetime(2001, 1, 1, 11)))
+            datalink.create_message(Message(collector.id, seller.id, datetime(2001, 1, 1, 12), "hello"))
+            datalink.create_message(Message(seller.id, collector.id, datetime(2001, 1, 1, 13), "hi"))
+
+            stats = datalink.get_daily_stats(day - timedelta(days=1), day + timedelta(days=1))
+            self.assertEqual([stat.day for stat in stats], [day - timedelta(days=1), day, day + timedelta(days=1)])
+            counted = {'day': '2001-01-01', 'adverts_posted': 1, 'adverts_collected': 1, 'adverts_expired': 0,
+                       'active_users': 2, 'messages': 2}
+            self.assertEqual(stats[1].to_dict(), counted)
+            self.assertEqual(stats[0].to_dict(), {**dict.fromkeys(DailyStat.COUNTERS, 0), 'day': '2000-12-31'})
+
+            # expired adverts are counted on the day the sweep marks them
+            expired_before = datalink.get_daily_stats(date.today(), date.today())[0].adverts_expired
+            expired = Advert(*test_adverts[2])
+            expired.owner = seller.id
+            expired.created = datetime(2001, 1, 1, 10)
+            datalink.create_advert(expired)
+            swept = datalink.check_expiry()
+            self.assertGreaterEqual(swept, 1)
+            self.assertIsNotNone(expired.unlisted)
+            self.assertEqual(datalink.get_daily_stats(date.today(), date.today())[0].adverts_expired,
+                             expired_before + swept)
+
+            # the reconcile job counts the same from the tables, even when the counters and activity are lost
+            db.session.execute(update(Advert).where(Advert.adID == expired.adID).values(
+                expiry=datetime(2001, 1, 1, 9), unlisted=datetime(2001, 1, 1, 14)))
+            db.session.execute(update(DailyStat).where(DailyStat.day == day).values(
+                **dict.fromkeys(DailyStat.COUNTERS, 0)))
+            db.session.execute(delete(UserActivity).where(UserActivity.day == day))
+            db.session.commit()
+            self.assertEqual(datalink.reconcile_stats(day, day), 1)
+            self.assertEqual(datalink.get_daily_stats(day, day)[0].to_dict(),
+                             {**counted, 'adverts_posted': 2, 'adverts_expired': 1})
+
+            datalink.delete_user(seller)
+            datalink.delete_user(collector)
+            db.session.execute(delete(DailyStat).where(DailyStat.day == day))
+            db.session.commit()
+
+    def test_get_ads_near(self):
+        """test get_ads_near returns the available adverts within the radius, nearest first"""
+        with app.app_context():
+            user = User(*test_users[0])
+            datalink.create_user(user)
+            # distances from (54.9741, -1.6151), the first 2 straddle a geohash cell border
+            locations = [
+                ("1km", 54.9831, -1.6151, tomorrow, True),
+                ("0km", 54.9741, -1.6151, tomorrow, True),
+                ("8km", 54.9741, -1.4911, tomorrow, True),
+                ("30km", 55.2439, -1.6151, tomorrow, True),
+                ("out of date", 54.9741, -1.6150, yesterday, True),
+                ("unavailable", 54.9741, -1.6152, tomorrow, False),
+            ]
+            for title, latitude, longitude, expiry, available in locations:
+                datalink.create_advert(Advert(title, "Test Ad", latitude, longitude, "lorem ipsum", user.id,
+                                              expiry, available))
+
+            nearby = [(advert.title, round(distance)) for advert, distance in datalink.get_ads_near(54.9741, -1.6151)
+                      if advert.owner == user.id]
+            self.assertEqual(nearby, [("0km", 0), ("1km", 1), ("8km", 8)])
+            nearby = [advert.title for advert, distance in datalink.get_ads_near(54.9741, -1.6151, 50)
+                      if advert.owner == user.id]
+            self.assertEqual(nearby, ["0km", "1km", "8km", "30km"])
+            self.assertEqual(len(datalink.get_ads_near(54.9741, -1.6151, 50, limit=2)), 2)
+            # the database only returns the adverts nearest the location when there are more than the limit
+            nearest = datalink.get_ads_near(54.9741, -1.6151, 50, limit=1)
+            self.assertEqual([advert.title for advert, distance in nearest], ["0km"])
+            # moving an advert moves its geohash with it
+            advert = Advert.query.filter_by(owner=user.id, title="30km").first()
+            advert.latitude = 54.9741
+            db.session.commit()
+            self.assertIn("30km", [advert.title for advert, distance in datalink.get_ads_near(54.9741, -1.6151, 1)])
+
+            datalink.delete_user(user)
+
+    def test_get_ads_in_box(self):
+        """test get_ads_in_box returns the available adverts inside the box and respects the limit"""
+        with app.app_context():
+            user = User(*test_users[0])
+            datalink.create_user(user)
+            for title, latitude, longitude, available in [("inside", 54.97, -1.61, True),
+                                                          ("edge", 55.0, -1.5, True),
+                                                          ("outside", 51.5, -0.12, True),
+                                                          ("unavailable", 54.97, -1.61, False)]:
+                datalink.create_advert(Advert(title, "Test Ad", latitude, longitude, "lorem ipsum", user.id,
+                                              tomorrow, available))
+
+            rows = datalink.get_ads_in_box(54.9, -1.7, 55.0, -1.5)
+            self.assertEqual(sorted(row.title for row in rows if row.adID in
+                                    {advert.adID for advert in Advert.query.filter_by(owner=user.id)}),
+                             ["edge", "inside"])
+            self.assertEqual(len(datalink.get_ads_in_box(54.9, -1.7, 55.0, -1.5, limit=1)), 1)
+
+            datalink.delete_user(user)
+
+    def test_advert_clusters(self):
+        """test the advert map clusters follow adverts being created, collected, expiring and deleted,
+            and match the clusters rebuilt from the advert table
+        """
+        def clusters():
+            return {(c.precision, c.cell): (c.count, round(c.lat_sum, 6), round(c.lon_sum, 6))
+                    for c in AdvertCluster.query.filter(AdvertCluster.cell.like('gc%'))}
+
+        with app.app_context():
+            users = [User(*u) for u in test_users[:2]]
+            for u in users:
+                datalink.create_user(u)
+            adverts = []
+            for title, latitude, longitude, owner in [("a", 54.97, -1.61, 0), ("b", 54.98, -1.62, 0),
+                                                      ("c", 54.90, -1.55, 1), ("d", 54.97, -1.61, 1)]:
+                adverts.append(Advert(title, "Test Ad", latitude, longitude, "lorem ipsum", users[owner].id,
+                                      tomorrow))
+                datalink.create_advert(adverts[-1])
+            # unavailable adverts aren't counted
+            datalink.create_advert(Advert("e", "Test Ad", 54.97, -1.61, "lorem ipsum", users[0].id, tomorrow, False))
+
+            cluster = AdvertCluster.query.get((4, adverts[0].geohash[:4]))
+            self.assertEqual(cluster.count, 4)
+            self.assertAlmostEqual(cluster.get_centre()[0], (54.97 + 54.98 + 54.90 + 54.97) / 4)
+            clusters_before = clusters()
+            datalink.rebuild_clusters()
+            self.assertEqual(clusters(), clusters_before)
+
+            # collected, expired and deleted adverts are taken off the map
+            datalink.set_advert_unavailable(adverts[0].adID)
+            adverts[1].expiry = yesterday
+            db.session.commit()
+            self.assertEqual(datalink.check_expiry(), 1)
+            datalink.delete_advert(adverts[2])
+            self.assertEqual(AdvertCluster.query.get((4, adverts[0].geohash[:4])).count, 1)
+            clusters_before = clusters()
+            datalink.rebuild_clusters()
+            self.assertEqual(clusters(), clusters_before)
+
+            # finding clusters on the map
+            found = datalink.get_clusters_in_box(54.9, -1.7, 55.0, -1.5, 4)
+            self.assertIn(adverts[0].geohash[:4], [c.cell for c in found])
+            self.assertEqual(datalink.get_clusters_in_box(51.4, -0.2, 51.6, 0.0, 4), [])
+
+            # a deleted user's adverts go with them
+            datalink.delete_user(users[1])
+            self.assertIsNone(AdvertCluster.query.get((4, adverts[0].geohash[:4])))
+            datalink.delete_user(users[0])
+
+    def test_unlist_advert_once(self):
+        """test an advert made unavailable by another request while it was loaded is only taken off the map once"""
+        with app.app_context():
+            user = User(*test_users[0])
+            datalink.create_user(user)
+            advert = Advert("a", "Test Ad", 54.97, -1.61, "lorem ipsum", user.id, tomorrow)
+            datalink.create_advert(advert)
+            user_id, ad_id, key = user.id, advert.adID, (4, advert.geohash[:4])
+            count_before = AdvertCluster.query.get(key).count
+            # start again like a new request would, and load the advert like the collect view does
+            db.session.expunge_all()
+            loaded = datalink.get_advert(ad_id)
+            self.assertTrue(loaded.available)
+
+            # another request collects the advert first, with its own session
+            with app.app_context():
+                self.assertTrue(datalink.set_advert_unavailable(ad_id))
+            self.assertTrue(loaded.available)
+            self.assertFalse(datalink.set_advert_unavailable(ad_id))
+            self.assertFalse(loaded.available)
+            cluster = AdvertCluster.query.get(key)
+            self.assertEqual(cluster.count if cluster else 0, count_before - 1)
+
+            datalink.delete_user(datalink.get_user_from_id(user_id))
+
+    def test_hot_queries_use_indexes(self):
+        """test the most frequent queries are answered through an index instead of scanning the table"""
+        with app.app_context():
+            if db.engine.dialect.name not in ('sqlite', 'postgresql'):
+                self.skipTest("query plans are only checked on SQLite and Postgres")
+            now = datetime.now()
+            available_index = ('ix_advert_expiry_where_available' if supports_partial_indexes(db.engine.dialect)
+                               else 'ix_advert_available_expiry')
+            user_low, user_high = Conversation.pair(1, 2)
+            hot_queries = [
+                # listing available adverts
+                (select(Advert).where(Advert.available, Advert.expiry >= now), available_index),
+                (select(Advert).where(Advert.available, Advert.expiry >= now).order_by(Advert.expiry, Advert.adID)
+                 .limit(25), available_index),
+                # expiry sweep
+                (update(Advert).where(Advert.available, Advert.expiry < now).values(available=False),
+                 available_index),
+                # account pages
+                (select(Advert).filter_by(owner=1, available=True), 'ix_advert_owner_available'),
+                (select(Advert).filter_by(owner=1), 'ix_advert_owner_available'),
+                (select(Collection).filter_by(buyer=1), 'ix_foodorder_buyer'),
+                (select(Collection).filter_by(seller=1), 'ix_foodorder_seller'),
+                # chat history
+                (select(Message).filter_by(user_low=user_low, user_high=user_high).order_by(Message.timestamp),
+                 'ix_message_conversation'),
+                # messages inbox
+                (select(Conversation).filter_by(user_low=1).order_by(Conversation.last_timestamp.desc()),
+                 'ix_conversation_user_low'),
+                # statistics reconcile job
+                (select(Message.id).where(Message.timestamp >= now, Message.timestamp < now + timedelta(days=1)),
+                 'ix_message_timestamp'),
+                # admin dashboard
+                (select(User).where(User.role == 'admin').order_by(User.id).limit(20), 'ix_user_role'),
+            ]
+            for statement, index in hot_queries:
+                self.assertIn(index, explain(statement), str(statement))
+            db.session.rollback()
+
 
 if __name__ == '__main__':
     unittest.main()
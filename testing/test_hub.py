@@ -0,0 +1,49 @@
+import threading
+import time
+import unittest
+
+from messages.hub import MessageHub, conversation_key
+
+
+class TestMessageHub(unittest.TestCase):
+    """Test suite for the in process message hub"""
+    def setUp(self):
+        self.hub = MessageHub()
+
+    def test_conversation_key(self):
+        """test both users of a conversation get the same key"""
+        self.assertEqual(conversation_key(1, 2), conversation_key(2, 1))
+        self.assertNotEqual(conversation_key(1, 2), conversation_key(1, 3))
+
+    def test_wait_times_out(self):
+        """test waiting on a conversation with no new messages times out"""
+        version = self.hub.version(1, 2)
+        self.assertFalse(self.hub.wait(1, 2, version, 0.05))
+
+    def test_wait_after_publish(self):
+        """test a message published before the wait starts isn't missed"""
+        version = self.hub.version(1, 2)
+        self.hub.publish(2, 1)
+        self.assertTrue(self.hub.wait(1, 2, version, 0))
+
+    def test_publish_wakes_waiter(self):
+        """test publishing a message wakes a request waiting on its conversation only"""
+        results = {}
+
+        def wait(user1_id, user2_id):
+            version = self.hub.version(user1_id, user2_id)
+            results[(user1_id, user2_id)] = self.hub.wait(user1_id, user2_id, version, 1)
+
+        threads = [threading.Thread(target=wait, args=(1, 2)), threading.Thread(target=wait, args=(1, 3))]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        self.hub.publish(2, 1)
+        for thread in threads:
+            thread.join()
+        self.assertTrue(results[(1, 2)])
+        self.assertFalse(results[(1, 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
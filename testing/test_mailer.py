@@ -0,0 +1,232 @@
+from datetime import datetime, timedelta
+import socket
+import socketserver
+import threading
+import time
+import unittest
+from unittest.mock import patch
+import uuid
+
+from app import app, db
+from email_folder.mailer import SMTPPool
+from extensions import mailer
+from models import OutboundEmail, NewsletterBroadcast, User
+import datalink
+
+
+class DebuggingSMTPHandler(socketserver.StreamRequestHandler):
+    """Handles a connection to the DebuggingSMTPServer, speaking just enough SMTP for smtplib"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.server.connections += 1
+        self.server.open.append(self.connection)
+        self.reply("220 localhost debugging server")
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode().rstrip("\r\n")
+            command = line[:4].upper()
+            if command == 'EHLO':
+                self.reply("250 localhost")
+            elif command == 'HELO':
+                self.reply("250 localhost")
+            elif command == 'MAIL':
+                recipients = []
+                self.reply("250 OK")
+            elif command == 'RCPT':
+                recipients.append(line.split(':', 1)[1].strip(' <>'))
+                self.reply("250 OK")
+            elif command == 'DATA':
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    data_line = self.rfile.readline().decode().rstrip("\r\n")
+                    if data_line == '.':
+                        break
+                    data.append(data_line)
+                self.server.received.extend((recipient, "\n".join(data)) for recipient in recipients)
+                self.reply("250 OK")
+            elif command in ('NOOP', 'RSET'):
+                self.reply("250 OK")
+            elif not line:
+                return
+            elif command == 'QUIT':
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class DebuggingSMTPServer(socketserver.ThreadingTCPServer):
+    """Local SMTP server that keeps the emails it receives, standing in for the real mail server"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('localhost', 0), DebuggingSMTPHandler)
+        self.received = []
+        self.connections = 0
+        self.open = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def drop_connections(self):
+        """closes the open connections, like a mail server timing out idle clients"""
+        for connection in self.open:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TestMailer(unittest.TestCase):
+    """Test suite for the mail queue and the mailer sending it"""
+    def setUp(self):
+        self.server = DebuggingSMTPServer()
+        self.settings = mailer.__dict__.copy()
+        mailer.server, mailer.port = self.server.server_address
+        mailer.use_tls, mailer.username, mailer.timeout = False, None, 5
+        mailer.workers, mailer._pool = 2, None
+        mailer.connections = SMTPPool(mailer.connect, size=2)
+        self.clear()
+
+    def tearDown(self):
+        mailer.connections.close_idle(0)
+        self.server.close()
+        mailer.__dict__.update(self.settings)
+        self.clear()
+
+    def clear(self):
+        """removes the test emails, broadcasts and subscribers"""
+        with app.app_context():
+            db.session.execute(db.delete(OutboundEmail))
+            db.session.execute(db.delete(NewsletterBroadcast))
+            db.session.execute(db.delete(User).where(User.email.like('newsletter%@email.com')))
+            db.session.commit()
+
+    def test_send_queued(self):
+        """test queued emails are sent in batches, and only once"""
+        mailer.batch_size = 2
+        with app.app_context():
+            for number in range(5):
+                datalink.queue_email(OutboundEmail(f"test{number}@email.com", "Test", f"email {number}"))
+            self.assertEqual(mailer.send_queued(), 5)
+            self.assertEqual(mailer.send_queued(), 0)
+            self.assertEqual(sorted(recipient for recipient, data in self.server.received),
+                             [f"test{number}@email.com" for number in range(5)])
+            self.assertIn("email 0", self.server.received[0][1] + self.server.received[1][1])
+            statuses = db.session.execute(db.select(OutboundEmail.status, OutboundEmail.attempts)).all()
+            self.assertEqual(set(statuses), {('sent', 1)})
+
+    def test_claim_once(self):
+        """test two mail workers that read the same due emails at once don't both claim them"""
+        with app.app_context():
+            for number in range(3):
+                datalink.queue_email(OutboundEmail(f"test{number}@email.com", "Test", f"email {number}"))
+            other_claim = []
+            real_uuid4 = uuid.uuid4
+
+            def claim_in_other_worker():
+                # the first worker has read the ids but not leased them yet
+                with patch('datalink.uuid.uuid4', real_uuid4), app.app_context():
+                    other_claim.extend(datalink.claim_emails(10, 60))
+                return real_uuid4()
+
+            with patch('datalink.uuid.uuid4', side_effect=claim_in_other_worker):
+                self.assertEqual(datalink.claim_emails(10, 60), [])
+            self.assertEqual([row.attempts for row in other_claim], [0, 0, 0])
+            attempts = db.session.execute(db.select(OutboundEmail.attempts)).scalars().all()
+            self.assertEqual(attempts, [1, 1, 1])
+
+    def test_connections_reused(self):
+        """test emails are sent through the pooled connections instead of a connection each"""
+        with app.app_context():
+            for number in range(6):
+                datalink.queue_email(OutboundEmail(f"test{number}@email.com", "Test", f"email {number}"))
+            self.assertEqual(mailer.send_queued(), 6)
+            self.assertLessEqual(self.server.connections, 2)
+
+            # connections are replaced after max_messages emails
+            mailer.connections.close_idle(0)
+            mailer.connections.max_messages = 2
+            opened = self.server.connections
+            for number in range(6):
+                mailer.send(mailer.build_message(f"test{number}@email.com", "Test", "email"))
+            self.assertEqual(self.server.connections - opened, 3)
+
+    def test_reconnect(self):
+        """test an email is sent on a new connection if the mail server closed the pooled one"""
+        mailer.send(mailer.build_message("test@email.com", "Test", "email"))
+        self.server.drop_connections()
+        mailer.send(mailer.build_message("test@email.com", "Test", "email"))
+        self.assertEqual((len(self.server.received), self.server.connections), (2, 2))
+
+        # connections idle for a while are checked before they are used
+        self.server.drop_connections()
+        mailer.connections._idle[0].last_used -= 10
+        mailer.send(mailer.build_message("test@email.com", "Test", "email"))
+        self.assertEqual((len(self.server.received), self.server.connections), (3, 3))
+
+    def test_broadcast(self):
+        """test a newsletter is sent once to each subscriber, a batch at a time, carrying on after an interruption"""
+        mailer.newsletter_batch_size = 2
+        with app.app_context():
+            for number in range(7):
+                user = User(f"newsletter{number}@email.com", "Password1!", f"Name{number}", "Surname",
+                            datetime(2000, 1, 1), "Address", "07123456789", newsletter=number < 6)
+                if number == 5:
+                    user.role = 'off'
+                datalink.create_user(user)
+            broadcast = NewsletterBroadcast("News", "Hi $first_name, $unknown stays")
+            datalink.create_broadcast(broadcast)
+
+            # interrupted after the first batch was queued
+            self.assertEqual(datalink.queue_broadcast_batch(broadcast.id, 2), 2)
+            self.assertEqual(mailer.run(), 5)
+            self.assertEqual(sorted(recipient for recipient, data in self.server.received),
+                             [f"newsletter{number}@email.com" for number in range(5)])
+            self.assertTrue(any("Hi Name3, $unknown stays" in data for recipient, data in self.server.received))
+
+            broadcast = db.session.get(NewsletterBroadcast, broadcast.id)
+            self.assertIsNotNone(broadcast.finished)
+            self.assertEqual(broadcast.queued, 5)
+            self.assertEqual(mailer.run(), 0)
+
+    def test_rate_limit(self):
+        """test emails aren't sent faster than the rate limit"""
+        mailer.rate_limit = 20
+        with app.app_context():
+            for number in range(5):
+                datalink.queue_email(OutboundEmail(f"test{number}@email.com", "Test", f"email {number}"))
+            start = time.monotonic()
+            self.assertEqual(mailer.send_queued(), 5)
+            self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_retry(self):
+        """test emails that can't be sent are tried again later, until they have failed too many times"""
+        mailer.port = 1
+        mailer.max_attempts = 2
+        with app.app_context():
+            datalink.queue_email(OutboundEmail("test@email.com", "Test", "email"))
+            self.assertEqual(mailer.send_queued(), 0)
+            email = db.session.execute(db.select(OutboundEmail)).scalar_one()
+            self.assertEqual((email.status, email.attempts), ('queued', 1))
+            self.assertGreater(email.send_after, datetime.now() + timedelta(seconds=mailer.retry_delay - 5))
+            self.assertIsNotNone(email.last_error)
+            # not due yet
+            self.assertEqual(datalink.claim_emails(10, 60), [])
+
+            email.send_after = datetime.now()
+            db.session.commit()
+            mailer.send_queued()
+            email = db.session.execute(db.select(OutboundEmail)).scalar_one()
+            self.assertEqual((email.status, email.attempts), ('failed', 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import threading
+import unittest
+
+from passwords import PasswordHasher, PasswordHasherBusy
+
+
+class TestPasswordHasher(unittest.TestCase):
+    """Test suite for hashing and checking passwords on the bounded pool"""
+    def setUp(self):
+        self.hasher = PasswordHasher()
+        self.hasher.rounds = 4
+
+    def test_hash_verify(self):
+        """test a hashed password can be checked, and other passwords don't match"""
+        hashed = self.hasher.hash("Password1!")
+        self.assertIsInstance(hashed, str)
+        self.assertTrue(self.hasher.verify("Password1!", hashed))
+        self.assertTrue(self.hasher.verify("Password1!", hashed.encode('utf-8')))
+        self.assertFalse(self.hasher.verify("Password2!", hashed))
+
+    def test_needs_rehash(self):
+        """test a password needs hashing again once the cost has changed"""
+        hashed = self.hasher.hash("Password1!")
+        self.assertFalse(self.hasher.needs_rehash(hashed))
+        self.hasher.rounds = 5
+        self.assertTrue(self.hasher.needs_rehash(hashed))
+        self.assertTrue(self.hasher.verify("Password1!", hashed))
+
+    def test_busy(self):
+        """test passwords are refused straight away with a 503 error when the queue is full"""
+        self.hasher.workers, self.hasher.queue_limit = 1, 0
+        started, finish = threading.Event(), threading.Event()
+
+        def slow(password, salt):
+            started.set()
+            finish.wait(5)
+            return b"hash"
+        thread = threading.Thread(target=self.hasher._run, args=(slow, b"", b""))
+        thread.start()
+        started.wait(5)
+        try:
+            with self.assertRaises(PasswordHasherBusy) as raised:
+                self.hasher.hash("Password1!")
+            self.assertEqual(raised.exception.code, 503)
+        finally:
+            finish.set()
+            thread.join()
+        self.assertTrue(self.hasher.verify("Password1!", self.hasher.hash("Password1!")))
+
+
+if __name__ == '__main__':
+    unittest.main()
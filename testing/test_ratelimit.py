@@ -0,0 +1,52 @@
+import unittest
+
+from ratelimit import MemoryBucketStore, RateLimiter
+
+
+class TestRateLimiter(unittest.TestCase):
+    """Test suite for the token buckets throttling login attempts"""
+    def setUp(self):
+        self.store = MemoryBucketStore()
+
+    def test_bucket(self):
+        """test a bucket allows capacity attempts in a row, then refills steadily"""
+        for _ in range(3):
+            self.assertEqual(self.store.take('key', 3, 0.5, now=100.0), 0)
+        self.assertAlmostEqual(self.store.take('key', 3, 0.5, now=100.0), 2.0)
+        # half a token after a second, a whole one after 2
+        self.assertAlmostEqual(self.store.take('key', 3, 0.5, now=101.0), 1.0)
+        self.assertEqual(self.store.take('key', 3, 0.5, now=102.0), 0)
+        # never holds more than capacity
+        for _ in range(3):
+            self.assertEqual(self.store.take('key', 3, 0.5, now=1000.0), 0)
+        self.assertGreater(self.store.take('key', 3, 0.5, now=1000.0), 0)
+        # other keys have their own bucket
+        self.assertEqual(self.store.take('other key', 3, 0.5, now=1000.0), 0)
+
+    def test_max_keys(self):
+        """test the least recently used buckets are dropped when the store is full"""
+        self.store.max_keys = 2
+        self.store.take('a', 1, 1, now=0)
+        self.store.take('b', 1, 1, now=0)
+        self.store.take('c', 1, 1, now=0)
+        self.assertEqual(list(self.store._buckets), ['b', 'c'])
+
+    def test_limit_login(self):
+        """test logins are limited per email address, whichever IP address they come from, and per IP address"""
+        limiter = RateLimiter()
+        limiter.store = self.store
+        limiter.ip_attempts, limiter.email_attempts, limiter.period = 4, 2, 60
+        self.assertEqual(limiter.limit_login('1.1.1.1', 'test@email.com'), 0)
+        self.assertEqual(limiter.limit_login('2.2.2.2', ' Test@Email.com'), 0)
+        self.assertGreater(limiter.limit_login('3.3.3.3', 'test@email.com'), 0)
+
+        for number in range(3):
+            self.assertEqual(limiter.limit_login('1.1.1.1', f'test{number}@email.com'), 0)
+        self.assertGreater(limiter.limit_login('1.1.1.1', 'test3@email.com'), 0)
+
+        limiter.store = None
+        self.assertEqual(limiter.limit_login('1.1.1.1', 'test@email.com'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,16 @@
+import math
+
 from flask_login import login_user, logout_user, current_user, login_required
 
 import users.views
 from users.forms import SignUpForm, LoginForm, ChangeCredentialsForm
 import bcrypt
-from flask import Blueprint, flash, render_template, session, redirect, url_for
-from models import User, Advert, Collection
-from app import db, app
+from flask import Blueprint, flash, render_template, session, redirect, url_for, request
+from models import User, Advert
+import datalink
+from app import db
+from extensions import rate_limiter
+from passwords import PasswordHasherBusy
 from email_folder.views import send_welcome_email
 from markupsafe import Markup
 
@@ -27,33 +32,32 @@ def signup():
     if current_user.is_anonymous:
         # if request method is POST or form is valid
         if form.validate_on_submit():
-            with app.app_context():
-                user = User.query.filter_by(email=form.email.data).first()
-                # if this returns a user, then the email already exists in database
-                # if email already exists redirect user back to signup page with error message so user can try again
-                if user:
-                    flash('Email address already exists')
-                    return render_template('users/signup.html', form=form)
-
-                # create a new user with the form data
-                new_user = User(email=form.email.data,
-                                first_name=form.first_name.data,
-                                surname=form.last_name.data,
-                                password=form.password.data,
-                                role='user',
-                                dob=form.dob.data,
-                                address=form.address.data,
-                                phone=form.phone.data)
-
-                # add the new user to the database
-
-                db.session.add(new_user)
-                db.session.commit()
-
-                # create session variable
-                session['email'] = new_user.email
-                send_welcome_email(new_user)
-                return redirect(url_for('users.login'))
+            user = User.query.filter_by(email=form.email.data).first()
+            # if this returns a user, then the email already exists in database
+            # if email already exists redirect user back to signup page with error message so user can try again
+            if user:
+                flash('Email address already exists')
+                return render_template('users/signup.html', form=form)
+
+            # create a new user with the form data
+            new_user = User(email=form.email.data,
+                            first_name=form.first_name.data,
+                            surname=form.last_name.data,
+                            password=form.password.data,
+                            role='user',
+                            dob=form.dob.data,
+                            address=form.address.data,
+                            phone=form.phone.data)
+
+            # add the new user to the database
+
+            db.session.add(new_user)
+            db.session.commit()
+
+            # create session variable
+            session['email'] = new_user.email
+            send_welcome_email(new_user)
+            return redirect(url_for('users.login'))
 
     else:
         # if user is already logged in
@@ -80,29 +84,40 @@ def login():
     if current_user.is_anonymous:
         # if request method is POST or form is valid
         if form.validate_on_submit():
-            with app.app_context():
-                from models import User
-                user = User.query.filter_by(email=form.email.data).first()
-
-                # check user exists, password/pin/postcode are all correct
-                if not user or not user.verify_password(form.password.data):
-                    flash('Incorrect details')
-                    return render_template('users/login.html', form=form)
-                # check if user account is still active
-                if user.role == 'off':
-                    flash('This account no longer exists')
-                    return render_template('users/login.html', form=form)
-
+            # refuse attempts over the rate limit before the password is checked, see ratelimit.py
+            retry_after = rate_limiter.limit_login(request.remote_addr, form.email.data)
+            if retry_after:
+                flash(f'Too many login attempts, please try again in {math.ceil(retry_after)} seconds')
+                return render_template('users/login.html', form=form), 429
+
+            user = User.query.filter_by(email=form.email.data).first()
+
+            # check user exists, password/pin/postcode are all correct
+            if not user or not user.verify_password(form.password.data):
+                flash('Incorrect details')
+                return render_template('users/login.html', form=form)
+            # check if user account is still active
+            if user.role == 'off':
+                flash('This account no longer exists')
+                return render_template('users/login.html', form=form)
+
+            else:
+                # hash the password again if BCRYPT_ROUNDS has changed since it was hashed. It can wait for the
+                # next login if the hasher is busy, the login has already succeeded
+                try:
+                    if user.rehash_password(form.password.data):
+                        db.session.commit()
+                except PasswordHasherBusy:
+                    pass
+                # create user
+                login_user(user)
+                datalink.record_activity(user.id)
+
+                # redirect to correct page depending on role
+                if current_user.role == 'user':
+                    return redirect(url_for('users.account'))
                 else:
-                    # create user
-                    login_user(user)
-                    db.session.commit()
-
-                    # redirect to correct page depending on role
-                    if current_user.role == 'user':
-                        return redirect(url_for('users.account'))
-                    else:
-                        return redirect(url_for('admin.admin_account'))
+                    return redirect(url_for('admin.admin_account'))
     else:
         # if user is already logged in
         adverts = Advert.query.filter_by(owner=current_user.id).all()
@@ -134,8 +149,9 @@ def account():
         'role': current_user.role
     }
 
-    adverts = Advert.query.filter_by(owner=current_user.id, available=True).all()
-    orders = Collection.query.filter_by(buyer=current_user.id).all()
+    adverts = datalink.get_user_adverts(current_user.id, available=True)
+    # the orders come with the adverts collected and who posted them, see EAGER_LOADING
+    orders = datalink.get_user_collections(current_user.id)
 
     return render_template('users/account.html', current_user=user_details, adverts=adverts, orders=orders, current_page='account')
 
@@ -149,19 +165,20 @@ def change_details():
     """
     form = ChangeCredentialsForm(object=current_user)
     if form.validate_on_submit():
-        with app.app_context():
-            current_user.email = form.email.data
-            current_user.first_name = form.first_name.data
-            current_user.last_name = form.last_name.data
-            current_user.dob = form.dob.data
-            current_user.address = form.address.data
-            current_user.phone = form.phone.data
-            db.session.commit()
-            if current_user.role == 'admin':
-                # if current user changing details is an admin, redirect them to the admin account page
-                return redirect(url_for('admin.admin_account'))
-            # redirect user to account page
-            return redirect(url_for('users.account'))
+        # current_user is a read only copy, so load the user to change them
+        user = datalink.get_user_from_id(current_user.id)
+        user.email = form.email.data
+        user.first_name = form.first_name.data
+        user.surname = form.last_name.data
+        user.dob = form.dob.data
+        user.address = form.address.data
+        user.phone = form.phone.data
+        datalink.update_user(user)
+        if user.role == 'admin':
+            # if current user changing details is an admin, redirect them to the admin account page
+            return redirect(url_for('admin.admin_account'))
+        # redirect user to account page
+        return redirect(url_for('users.account'))
 
 
     return render_template('users/change_details.html', form=form)
@@ -192,9 +209,10 @@ def delete_account():
         flask.Response: Redirects to the index page after account deletion.
     """
     # set the user's role to off
-    current_user.role = 'off'
-    # update the database
-    db.session.commit()
+    user = datalink.get_user_from_id(current_user.id)
+    user.role = 'off'
+    # update the database, the user loader stops returning the user at once
+    datalink.update_user(user)
     # log the user out
     logout_user()
     # inform user about account deletion and redirect them to main page.